@@ -0,0 +1,70 @@
+# admission.py
+
+import os
+import shutil
+import threading
+
+from utils import LOGGER
+
+class DiskAdmission:
+    """Admission control for the scheduler. A queued job starts only when its expected size (options['size'],
+    from the HEAD or the torrent metadata) fits into the free space of `path` minus `floor` and minus what the
+    already admitted jobs still have to write. A job's outstanding amount is its reservation less the disk
+    blocks its files occupy, so preallocated and partly written files are not counted twice.
+    try_admit() runs under the scheduler's lock, so it only uses the figure refresh() measured; the scheduler
+    calls refresh(), which stats the disk and walks the reserved files, once per dispatch pass outside that lock."""
+    def __init__(self, path, floor):
+        self.path = path
+        self.floor = floor
+        self._lock = threading.Lock()
+        self._reservations = {}
+        self._available = None
+
+    def _paths(self, job):
+        names = {job.filename, job.options.get('disk_name')}
+        return [os.path.join(self.path, name) for name in names if name]
+
+    @staticmethod
+    def _allocated(paths):
+        total = 0
+        for path in paths:
+            try:
+                if os.path.isdir(path):
+                    for root, _, names in os.walk(path):
+                        total += sum(os.lstat(os.path.join(root, name)).st_blocks * 512 for name in names)
+                elif os.path.exists(path): total += os.lstat(path).st_blocks * 512
+            except OSError: pass
+        return total
+
+    def _free(self):
+        return shutil.disk_usage(self.path).free if os.path.isdir(self.path) else 0
+
+    def outstanding(self):
+        with self._lock: reservations = list(self._reservations.values())
+        return sum(max(size - self._allocated(paths), 0) for size, paths in reservations)
+
+    def available(self):
+        return self._free() - self.floor - self.outstanding()
+
+    def capacity(self):
+        """Space a job could get once every admitted job has finished and removed its files."""
+        with self._lock: reservations = list(self._reservations.values())
+        return self._free() - self.floor + sum(self._allocated(paths) for _, paths in reservations)
+
+    def refresh(self):
+        available = self.available()
+        with self._lock: self._available = available
+
+    def try_admit(self, job):
+        size = int(job.options.get('size') or 0)
+        # Unknown sizes are admitted as long as the floor is intact; they simply cannot be reserved.
+        with self._lock:
+            available = self._available
+            if available is None or available <= 0 or size > available: return False
+            # Until the next refresh() the new reservation is counted as entirely outstanding.
+            self._available -= size; self._reservations[job.job_id] = (size, self._paths(job))
+        LOGGER.info(f"[USER:{job.user_id}] Reserved {size} bytes of disk space for job {job.job_id}")
+        return True
+
+    def release(self, job):
+        with self._lock: self._reservations.pop(job.job_id, None)
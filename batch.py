@@ -0,0 +1,98 @@
+# batch.py
+
+import os
+import re
+import random
+import string
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from utils import parse_filename, LOGGER
+from tasks import probe_http, fetch_torrent_info
+from torrent import list_torrent_files
+from config import BATCH_RESOLVE_WORKERS
+
+POLICIES = ('full', 'smart', 'short')
+_LINK = re.compile(r'(?:https?://|magnet:\?)\S+', re.IGNORECASE)
+
+_resolver = ThreadPoolExecutor(max_workers=BATCH_RESOLVE_WORKERS, thread_name_prefix="resolve")
+
+def extract_links(text):
+    """URLs and magnets found in `text` (a pasted message or an uploaded list), in order and without duplicates."""
+    return list(dict.fromkeys(match.group(0).rstrip('.,;)') for match in _LINK.finditer(text)))
+
+def resolve_link(url):
+    """What submitting `url` on its own would learn before the name choice: its original filename plus the probe or
+    torrent details the job needs. Sets 'error' instead of raising."""
+    item = {'url': url, 'name': None, 'probe': None, 'options': None, 'size': 0, 'disk_name': None, 'error': None}
+    if url.lower().startswith('magnet:'):
+        info = fetch_torrent_info(url)
+        if info is None: item['error'] = "no torrent metadata"; return item
+        name = re.sub(r'[<>:"/\\|?*]', '_', info.name()); files = list_torrent_files(info)
+        item.update(size=sum(size for _, _, size in files), disk_name=files[0][1].split(os.sep)[0] if files else info.name())
+        # Batches cannot ask for a file selection, so multi-file torrents are uploaded whole as one tar.
+        if len(files) > 1: name = f"{name}.tar"; item['options'] = {'mode': 'tar'}
+        item['name'] = name
+        return item
+    probe = item['probe'] = probe_http(url)
+    if not probe or not probe['filename']: item['error'] = "could not fetch file details"; return item
+    item.update(name=probe['filename'], size=probe['size'])
+    return item
+
+def resolve_links(urls, on_progress=None):
+    """Resolves every URL on the shared bounded pool, so one slow HEAD or metadata fetch does not hold up the rest.
+    on_progress(done, total) is called on the caller's thread after each result. Returns items in input order."""
+    futures = {_resolver.submit(resolve_link, url): index for index, url in enumerate(urls)}
+    items = [None] * len(urls)
+    for done, future in enumerate(as_completed(futures), 1):
+        index = futures[future]
+        try: items[index] = future.result()
+        except Exception as e:
+            LOGGER.error(f"Resolving {urls[index]} failed: {e}")
+            items[index] = {'url': urls[index], 'name': None, 'error': str(e)}
+        if on_progress: on_progress(done, len(urls))
+    return items
+
+def apply_policy(items, policy):
+    """Final filenames for resolved items under one naming policy (the same choices /send offers), made unique
+    within the batch so two jobs never share a download path."""
+    names = []; taken = set()
+    for item in items:
+        base, ext = os.path.splitext(item['name'])
+        if policy == 'smart': name = f"{parse_filename(base)}{ext}"
+        elif policy == 'short': name = f"{''.join(random.choices(string.ascii_letters + string.digits, k=8))}{ext}"
+        else: name = item['name']
+        stem, counter = os.path.splitext(name)[0], 2
+        while name.lower() in taken: name = f"{stem} ({counter}){ext}"; counter += 1
+        taken.add(name.lower()); names.append(name)
+    return names
+
+def status_outcome(final_status):
+    """Classifies worker_task's final status text."""
+    if final_status.startswith("✅"): return 'done'
+    if final_status.startswith("⚠️"): return 'partial'
+    if final_status.startswith("🚫"): return 'cancelled'
+    return 'failed'
+
+class Batch:
+    """Jobs submitted together by one /batch. Tracks each job's outcome for the aggregate status message;
+    it lives in memory only, so after a restart the jobs resume individually."""
+    def __init__(self, batch_id, user_id, chat_id, message_id):
+        self.batch_id = batch_id; self.user_id = user_id; self.chat_id = chat_id; self.message_id = message_id
+        self.entries = []   # [job_id or None, filename, size, outcome or None]
+        self._lock = threading.Lock()
+
+    def add(self, job_id, filename, size, outcome=None):
+        with self._lock: self.entries.append([job_id, filename, size, outcome])
+
+    def finish(self, job_id, outcome):
+        with self._lock:
+            for entry in self.entries:
+                if entry[0] == job_id: entry[3] = outcome
+
+    def snapshot(self):
+        with self._lock: return [tuple(entry) for entry in self.entries]
+
+    @property
+    def done(self):
+        with self._lock: return all(entry[3] for entry in self.entries)
@@ -0,0 +1,258 @@
+# bench.py
+
+"""Local benchmark for the download -> upload pipeline. Starts a synthetic HTTP source and the BuzzHeavier
+stand-in in a separate process, then drives download_http, upload_file and worker_task against them with a
+stubbed Telegram bot, one freshly spawned process per measurement so pools, RSS and CPU time are not shared.
+
+    python bench.py --size 256M --concurrency 1,2,4 --out bench.json
+    STREAM_UPLOADS=0 DOWNLOAD_CONNECTIONS=8 python bench.py --scenarios pipeline --source-rate 20M
+
+Tuning knobs from config.py are read from the environment as usual, so two builds or two settings are compared
+by running the same command twice and diffing the JSON. Status-callback overhead is the time spent rendering
+status text (escape_markdown, format_bytes, format_time, progress_bar as called from tasks.py) plus the time
+inside the callback itself, which here only stores the latest status the way the broadcaster does. Download
+progress is reported as a callable that renders on read, so its formatting is only paid for the statuses that are
+actually shown; the benchmark renders the last one of each job when it finishes.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+import importlib
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from standin import StandInServer, ROOT_DIR_ID
+from utils import parse_rate, setup_logger, LOGGER
+
+SCENARIOS = ('download', 'upload', 'pipeline')
+PATTERN_SIZE = 1024 * 1024
+BENCH_ACCOUNT_ID = "bench-account"
+
+class SourceServer(ThreadingHTTPServer):
+    """Serves `size` bytes of a repeating pseudo-random pattern at every path. `latency` seconds are added
+    before each response, `ranges` toggles Range support and `rate` caps each connection in bytes per second."""
+    daemon_threads = True
+
+    def __init__(self, address, size, latency=0.0, ranges=True, rate=0):
+        super().__init__(address, SourceHandler)
+        self.size = size; self.latency = latency; self.ranges = ranges; self.rate = rate
+        self.pattern = random.Random(size).randbytes(PATTERN_SIZE)
+
+class SourceHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args): pass
+
+    def _span(self):
+        """Returns (start, end) of the requested bytes (end exclusive), or None when the Range is unsatisfiable."""
+        size = self.server.size; header = self.headers.get('Range', '')
+        if not self.server.ranges or not header.startswith('bytes='): return 0, size
+        first, _, last = header[6:].split(',')[0].partition('-')
+        try:
+            if not first: start, end = max(size - int(last), 0), size
+            else: start, end = int(first), min(int(last) + 1, size) if last else size
+        except ValueError: return 0, size
+        return (start, end) if start < end else None
+
+    def _headers(self):
+        if self.server.latency: time.sleep(self.server.latency)
+        span = self._span()
+        if span is None:
+            self.send_response(416); self.send_header('Content-Range', f"bytes */{self.server.size}")
+            self.send_header('Content-Length', '0'); self.end_headers(); return None
+        start, end = span; partial = (end - start) != self.server.size
+        self.send_response(206 if partial else 200)
+        self.send_header('Content-Type', 'application/octet-stream'); self.send_header('Content-Length', str(end - start))
+        self.send_header('ETag', f'"bench-{self.server.size}"')
+        if self.server.ranges: self.send_header('Accept-Ranges', 'bytes')
+        if partial: self.send_header('Content-Range', f"bytes {start}-{end - 1}/{self.server.size}")
+        self.end_headers()
+        return start, end
+
+    def do_HEAD(self):
+        self._headers()
+
+    def do_GET(self):
+        span = self._headers()
+        if span is None: return
+        position, end = span; pattern = memoryview(self.server.pattern); rate = self.server.rate
+        started = time.monotonic(); sent = 0
+        try:
+            while position < end:
+                offset = position % PATTERN_SIZE
+                n = min(PATTERN_SIZE - offset, end - position, 256 * 1024)
+                self.wfile.write(pattern[offset:offset + n]); position += n; sent += n
+                if rate:
+                    ahead = sent / rate - (time.monotonic() - started)
+                    if ahead > 0: time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+def _serve(args, ports, stop):
+    source = SourceServer(('127.0.0.1', 0), args.size, args.latency, not args.no_ranges, args.source_rate)
+    standin = StandInServer(('127.0.0.1', 0))
+    for server in (source, standin): threading.Thread(target=server.serve_forever, daemon=True).start()
+    ports.put((source.server_port, standin.server_port))
+    stop.wait()
+
+class CallbackMeter:
+    """Counts status updates and the seconds spent producing and delivering them, across threads."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0; self.seconds = 0.0; self.latest = {}
+
+    def add(self, seconds, calls=0):
+        with self.lock: self.seconds += seconds; self.calls += calls
+
+    def timed(self, func):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try: return func(*args, **kwargs)
+            finally: self.add(time.perf_counter() - start)
+        return wrapper
+
+    def callback(self, key):
+        def update_status_callback(text):
+            start = time.perf_counter()
+            with self.lock: self.latest[key] = text
+            self.add(time.perf_counter() - start, 1)
+        return update_status_callback
+
+    def render_latest(self):
+        # What the broadcaster would still have to show; lazily reported statuses are rendered only here.
+        with self.lock: latest = list(self.latest.values())
+        for text in latest:
+            if callable(text): self.timed(text)()
+
+class StubBot:
+    def __init__(self): self.sent = []
+    def send_message(self, chat_id, text, **kwargs): self.sent.append((chat_id, text))
+
+def _source_file(workdir, size):
+    """A file of `size` bytes for the upload scenario, written once per benchmark."""
+    path = os.path.join(workdir, 'upload-source.bin'); pattern = random.Random(size).randbytes(PATTERN_SIZE)
+    with open(path, 'wb') as f:
+        for offset in range(0, size, PATTERN_SIZE): f.write(pattern[:min(PATTERN_SIZE, size - offset)])
+    return path
+
+def _measure(scenario, level, run, args, source_url, upload_path, conn):
+    """Runs one scenario with `level` concurrent jobs in this (spawned) process and sends the result to `conn`."""
+    if args.verbose: setup_logger()
+    else: LOGGER.setLevel('WARNING')
+    tasks = importlib.import_module('tasks'); scheduler = importlib.import_module('scheduler'); store_module = importlib.import_module('store')
+    meter = CallbackMeter()
+    for name in ('escape_markdown', 'format_bytes', 'format_time', 'progress_bar'): setattr(tasks, name, meter.timed(getattr(tasks, name)))
+    store = store_module.Store(os.path.join(args.workdir, f"bench-{scenario}-{level}-{run}.db"))
+    bot = StubBot()
+    results = [None] * level
+
+    def job(i):
+        name = f"{scenario}-{level}-{run}-{i}.bin"; url = f"{source_url}/{name}"; status = meter.callback(i)
+        if scenario == 'download':
+            filepath, size = tasks.download_http(url, name, status, user_id=i)
+            results[i] = size if filepath and size == args.size else None
+            if filepath: tasks.discard_partial_download(filepath)
+        elif scenario == 'upload':
+            size, link = tasks.upload_file(upload_path, name, status, BENCH_ACCOUNT_ID, ROOT_DIR_ID, user_id=i)
+            results[i] = size if link else None
+        else:
+            final = []
+            scheduler.run_inline(tasks.worker_task(url, name, i, i, store, bot.send_message, BENCH_ACCOUNT_ID, ROOT_DIR_ID, status, final.append, options={}))
+            results[i] = args.size if final and final[0].startswith("✅") else None
+
+    usage = resource.getrusage(resource.RUSAGE_SELF); started = time.perf_counter()
+    threads = [threading.Thread(target=job, args=(i,)) for i in range(level)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    meter.render_latest()
+    wall = time.perf_counter() - started; after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+    moved = sum(size for size in results if size)
+    client = importlib.import_module('netclient').get_client().stats()
+    conn.send({
+        'scenario': scenario, 'concurrency': level, 'run': run, 'jobs_ok': sum(1 for size in results if size), 'bytes': moved,
+        'wall_seconds': round(wall, 4), 'mb_per_s': round(moved / wall / 1e6, 2) if wall else 0.0,
+        'cpu_seconds': round(cpu, 4), 'cpu_seconds_per_gb': round(cpu / (moved / 1e9), 3) if moved else None,
+        'peak_rss_mb': round(after.ru_maxrss / 1024, 1),  # ru_maxrss is in KiB on Linux
+        'status_calls': meter.calls, 'status_seconds': round(meter.seconds, 4),
+        'status_share': round(meter.seconds / cpu, 4) if cpu else None,
+        'http_requests': client['requests'], 'http_connections': client['connections'],
+    })
+    conn.close(); store.close()
+
+def _build_info():
+    try: commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                 capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError): commit = None
+    knobs = ('STREAM_UPLOADS', 'SEGMENTED_DOWNLOADS', 'DOWNLOAD_CONNECTIONS', 'UPLOAD_BLOCK_SIZE', 'UPLOAD_SENDFILE', 'PREALLOCATE_FILES')
+    config = importlib.import_module('config')
+    return {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(),
+            'config': {name: getattr(config, name) for name in knobs}}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the download -> upload pipeline against local stand-ins.")
+    parser.add_argument('--size', type=parse_rate, default=parse_rate('64M'), help="bytes per job, e.g. 64M or 1G")
+    parser.add_argument('--concurrency', default='1,2,4', help="comma-separated numbers of concurrent jobs")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"comma-separated subset of {','.join(SCENARIOS)}")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per scenario and concurrency level")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds the source waits before each response")
+    parser.add_argument('--source-rate', type=parse_rate, default=0, help="per-connection source rate, e.g. 20M (0 = unlimited)")
+    parser.add_argument('--no-ranges', action='store_true', help="source ignores Range requests")
+    parser.add_argument('--workdir', default=None, help="scratch directory (default: a temporary one, removed afterwards)")
+    parser.add_argument('--out', default='bench.json', help="where to write the JSON results")
+    parser.add_argument('--verbose', action='store_true', help="keep the pipeline's INFO logging")
+    args = parser.parse_args()
+    scenarios = [name for name in args.scenarios.split(',') if name]
+    if any(name not in SCENARIOS for name in scenarios): parser.error(f"unknown scenario in {args.scenarios!r}")
+    levels = [int(level) for level in args.concurrency.split(',') if level]
+    out = os.path.abspath(args.out); scratch = args.workdir is None
+    args.workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='bench-'))
+    os.makedirs(args.workdir, exist_ok=True)
+
+    ctx = multiprocessing.get_context('fork'); spawn = multiprocessing.get_context('spawn')
+    ports = ctx.Queue(); stop = ctx.Event()
+    servers = ctx.Process(target=_serve, args=(args, ports, stop), daemon=True); servers.start()
+    source_port, standin_port = ports.get(timeout=10)
+    source_url = f"http://127.0.0.1:{source_port}"
+    # config.py and utils.DOWNLOAD_PATH are evaluated at import time, so measurements run in spawned interpreters
+    # that inherit this environment and working directory and import the pipeline from scratch.
+    os.environ['BUZZHEAVIER_UPLOAD_URL'] = os.environ['BUZZHEAVIER_API_URL'] = f"http://127.0.0.1:{standin_port}"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__))); os.chdir(args.workdir)
+    os.makedirs(os.path.join(args.workdir, 'downloads'), exist_ok=True)
+    upload_path = _source_file(args.workdir, args.size) if 'upload' in scenarios else None
+
+    report = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'build': _build_info(),
+              'params': {'size': args.size, 'latency': args.latency, 'source_rate': args.source_rate, 'ranges': not args.no_ranges},
+              'results': []}
+    try:
+        for scenario in scenarios:
+            for level in levels:
+                for run in range(args.repeat):
+                    receiver, sender = spawn.Pipe(duplex=False)
+                    worker = spawn.Process(target=_measure, args=(scenario, level, run, args, source_url, upload_path, sender))
+                    worker.start(); sender.close()
+                    try: result = receiver.recv()
+                    except EOFError: result = {'scenario': scenario, 'concurrency': level, 'run': run, 'error': f"exit code {worker.exitcode}"}
+                    worker.join(); report['results'].append(result)
+                    if 'error' in result: print(f"{scenario:<9} x{level:<3} failed ({result['error']})"); continue
+                    print(f"{scenario:<9} x{level:<3} {result['mb_per_s']:>9.2f} MB/s  cpu {result['cpu_seconds']:>7.2f}s  "
+                          f"rss {result['peak_rss_mb']:>7.1f} MB  status {result['status_calls']:>5} calls / {result['status_seconds']:.3f}s  "
+                          f"ok {result['jobs_ok']}/{level}")
+    finally:
+        stop.set(); servers.join(timeout=5)
+        if scratch: shutil.rmtree(args.workdir, ignore_errors=True)
+    with open(out, 'w') as f: json.dump(report, f, indent=2)
+    print(f"Results written to {out}")
+
+if __name__ == '__main__':
+    main()
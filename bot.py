@@ -3,13 +3,13 @@
 import os
 import sys
 import shutil
-import json
+import re
 import random
 import string
+import subprocess
 import threading
 import time
-import atexit # NEW: Import atexit for clean shutdown saving
-from concurrent.futures import ThreadPoolExecutor
+import uuid
 
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
@@ -18,9 +18,26 @@ from telegram.ext import (Updater, CommandHandler, CallbackContext, Conversation
                           MessageHandler, Filters, CallbackQueryHandler)
 
 from text import (get_welcome_message, get_stats_message, get_server_status_message,
-                  get_filename_choice_message)
-from tasks import get_http_filename, worker_task
-from utils import escape_markdown, parse_filename, DOWNLOAD_PATH, fetch_root_dir_id, setup_logger, LOGGER
+                  get_filename_choice_message, get_file_selection_message, get_jobs_message, get_cached_upload_message, get_limits_message,
+                  get_saved_links_message, get_batch_prompt_message, get_batch_resolving_message, get_batch_choice_message,
+                  get_batch_status_message)
+from tasks import probe_http, fetch_torrent_info, cache_key, prune_staged_downloads, worker_task
+from torrent import list_torrent_files
+from scheduler import Job, JobScheduler, QueueFull, PRIORITY_NORMAL, PRIORITY_RESUMED
+from jobqueue import QueueScheduler, LIMITS_SETTING
+from store import Store
+from admission import DiskAdmission
+from batch import Batch, POLICIES, extract_links, resolve_links, apply_policy, status_outcome
+from broadcaster import StatusBroadcaster
+from netclient import init_client, get_client
+from shaper import get_shaper, DIRECTIONS
+from metrics import Gauge, start_metrics_server
+from config import (DOWNLOAD_WORKERS, UPLOAD_WORKERS, GLOBAL_JOB_SLOTS, PER_USER_JOB_SLOTS, MAX_QUEUED_JOBS, MAX_JOBS_PER_USER,
+                    BROADCAST_GLOBAL_RATE, BROADCAST_CHAT_INTERVAL, DEDUP_CACHE, DEDUP_TTL, STAGED_FILE_TTL, ADMIN_USER_IDS,
+                    DISK_FREE_FLOOR, DISK_RECHECK_INTERVAL, METRICS_HOST, METRICS_PORT,
+                    BATCH_MAX_LINKS, DB_FILE, MAX_JOB_RESUMES, JOB_QUEUE, LOCAL_WORKERS, QUEUE_POLL_INTERVAL,
+                    ROOT_ID_CACHE_FILE, ROOT_ID_TTL, ROOT_ID_RETRY)
+from utils import escape_markdown, format_bytes, parse_filename, parse_rate, DOWNLOAD_PATH, resolve_root_dir_id, setup_logger, LOGGER
 
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -28,33 +45,25 @@ BUZZHEAVIER_ACCOUNT_ID = os.getenv("BUZZHEAVIER_ACCOUNT_ID")
 BUZZHEAVIER_ROOT_DIR_ID = None
 
 STATS_FILE = os.path.join(os.getcwd(), "stats.json")
-executor = ThreadPoolExecutor(max_workers=4)
+JOBS_FILE = os.path.join(os.getcwd(), "jobs.json")
+ADMISSION = DiskAdmission(DOWNLOAD_PATH, DISK_FREE_FLOOR)
+SCHEDULER = None   # JobScheduler running jobs in this process, or QueueScheduler handing them to worker.py processes
+WORKER_RESTART_DELAY = 5
+ROOT_DIR_HOLD = "BuzzHeavier"   # what held jobs show they are waiting for until the root directory ID is known
 
-ACTIVE_TASKS = {}
+BROADCASTER = None
+INFO_MESSAGES = {}
 task_lock = threading.Lock()
-(AWAIT_LINK, AWAIT_FILENAME_CHOICE, AWAIT_CUSTOM_NAME) = range(3)
+(AWAIT_LINK, AWAIT_FILENAME_CHOICE, AWAIT_CUSTOM_NAME, AWAIT_FILE_SELECTION, AWAIT_BATCH, AWAIT_BATCH_POLICY) = range(6)
+FILES_PER_PAGE = 8
+LINKS_PER_PAGE = 10
+MAX_SEARCHES_PER_CHAT = 20
 
 def load_data(context: CallbackContext):
-    # CHANGED: Use RLock to prevent deadlocks when a thread needs to acquire the same lock multiple times.
-    context.bot_data['data_lock'] = threading.RLock()
-    stats_data = {"downloaded": 0, "uploaded": 0}; links_data = {}
-    if os.path.exists(STATS_FILE):
-        try:
-            with open(STATS_FILE, 'r') as f: data = json.load(f)
-            stats_data = data.get("stats", stats_data); links_data = data.get("saved_links", links_data)
-        except (json.JSONDecodeError, IOError) as e: LOGGER.warning(f"Could not load stats file: {e}")
-    context.bot_data['stats'] = stats_data; context.bot_data['saved_links'] = links_data
-    def save_stats_func():
-        with context.bot_data['data_lock']:
-            try:
-                with open(STATS_FILE, 'w') as f:
-                    json.dump({"stats": context.bot_data['stats'], 
-                               "saved_links": context.bot_data['saved_links']}, f, indent=4)
-                LOGGER.info("Stats data saved to disk.") # NEW
-            except IOError as e: LOGGER.error(f"Could not save stats file: {e}")
-    context.bot_data['save_stats'] = save_stats_func
-    # NEW: Register the save function to be called on program exit
-    atexit.register(save_stats_func)
+    store = Store(DB_FILE)
+    store.migrate_legacy(STATS_FILE, JOBS_FILE)
+    context.bot_data['store'] = store
+    LOGGER.info(f"Opened data store at {DB_FILE} ({store.count_links()} saved links).")
 
 def start(update: Update, context: CallbackContext) -> None:
     LOGGER.info(f"User {update.effective_user.id} triggered /start")
@@ -63,128 +72,337 @@ def start(update: Update, context: CallbackContext) -> None:
 def send_command(update: Update, context: CallbackContext) -> int:
     user_id = update.effective_user.id
     LOGGER.info(f"User {user_id} triggered /send")
-    with task_lock:
-        if user_id in ACTIVE_TASKS:
-            LOGGER.warning(f"User {user_id} tried to start a new task while one is already active.")
-            update.message.reply_text("You already have an active task\. Please wait for it to complete\.")
-            return ConversationHandler.END
+    if len(SCHEDULER.jobs_for_user(user_id)) >= MAX_JOBS_PER_USER:
+        LOGGER.warning(f"User {user_id} tried to queue more than {MAX_JOBS_PER_USER} jobs.")
+        update.message.reply_text(f"You already have {MAX_JOBS_PER_USER} queued or running jobs\. Please wait for some to complete\.")
+        return ConversationHandler.END
     update.message.reply_text("Please send me the URL or magnet link to process\.")
     return AWAIT_LINK
 
-def info_updater_thread(context: CallbackContext, user_id: int, chat_id: int, message_id: int): # MODIFIED: Signature changed
-    last_text = ""
-    while True:
-        with task_lock:
-            if user_id not in ACTIVE_TASKS: break
-            current_text = ACTIVE_TASKS[user_id].get('status_text', "")
-        if current_text and current_text != last_text:
-            try:
-                context.bot.edit_message_text(chat_id=chat_id, message_id=message_id,
-                                              text=current_text, parse_mode=ParseMode.MARKDOWN_V2)
-                last_text = current_text
-            except BadRequest as e:
-                if "Message is not modified" not in str(e): LOGGER.error(f"Info update error: {e}"); break
-            except Exception as e: LOGGER.error(f"Unexpected info update error: {e}"); break
-        time.sleep(2)
+def render_user_status(user_id: int) -> str:
+    jobs = SCHEDULER.jobs_for_user(user_id)
+    return get_jobs_message([(job, SCHEDULER.position(job.job_id)) for job in jobs]) if jobs else ""
+
+def publish_user_status(user_id: int):
+    # Called from every progress update: only a dict lookup and a dict store, rendering happens in the broadcaster.
+    info_message = INFO_MESSAGES.get(user_id)
+    if info_message: BROADCASTER.publish(info_message['chat_id'], info_message['message_id'], lambda: render_user_status(user_id))
+
+def forget_info_message(chat_id, message_id):
+    # The broadcaster gave up on this message, so a later /info has to be able to open a new one.
+    with task_lock:
+        for user_id, info_message in list(INFO_MESSAGES.items()):
+            if (info_message['chat_id'], info_message['message_id']) == (chat_id, message_id): del INFO_MESSAGES[user_id]
 
 def info_command(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     LOGGER.info(f"User {user_id} triggered /info")
+    if not SCHEDULER.jobs_for_user(user_id):
+        update.message.reply_text("You have no active tasks\\."); return
     with task_lock:
-        if user_id in ACTIVE_TASKS:
-            if not ACTIVE_TASKS[user_id].get('info_message_id'): # MODIFIED: Check for message_id instead of a boolean flag
-                message = update.message.reply_text("`Querying status\.\.\.`", parse_mode=ParseMode.MARKDOWN_V2)
-                # NEW: Store message details in the active task dictionary
-                ACTIVE_TASKS[user_id]['info_message_id'] = message.message_id
-                ACTIVE_TASKS[user_id]['info_chat_id'] = message.chat_id
-                threading.Thread(target=info_updater_thread, args=(context, user_id, message.chat_id, message.message_id), daemon=True).start()
-                LOGGER.info(f"Started info updater thread for user {user_id}")
-            else:
-                LOGGER.info(f"User {user_id} triggered /info, but updater thread is already active.")
-                update.message.reply_text("A live status update is already active for your task\.")
-        else:
-            update.message.reply_text("You have no active tasks\.")
+        if user_id in INFO_MESSAGES:
+            LOGGER.info(f"User {user_id} triggered /info, but a live status message is already active.")
+            update.message.reply_text("A live status update is already active for your tasks\\.")
+            return
+        message = update.message.reply_text("`Querying status\\.\\.\\.`", parse_mode=ParseMode.MARKDOWN_V2)
+        INFO_MESSAGES[user_id] = {'chat_id': message.chat_id, 'message_id': message.message_id}
+    publish_user_status(user_id)
+
+def jobs_command(update: Update, context: CallbackContext) -> None:
+    user_id = update.effective_user.id
+    LOGGER.info(f"User {user_id} triggered /jobs")
+    jobs = SCHEDULER.jobs_for_user(user_id)
+    if not jobs: update.message.reply_text("You have no queued or running jobs\."); return
+    keyboard = [[InlineKeyboardButton(f"🚫 Cancel {job.filename[:40]}", callback_data=f"jcancel:{job.job_id}")] for job in jobs]
+    update.message.reply_text(render_user_status(user_id), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN_V2)
+
+def job_cancel_handler(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query; job_id = query.data.split(':', 1)[1]
+    job = SCHEDULER.get(job_id)
+    if job is None or job.user_id != update.effective_user.id:
+        query.answer("That job is no longer active."); return
+    LOGGER.info(f"User {job.user_id} cancelled job {job_id} ({job.state})")
+    SCHEDULER.cancel(job_id)
+    query.answer("Cancelling…")
+    query.edit_message_text(f"🚫 *Cancelling* `{escape_markdown(job.filename)}`\.", parse_mode=ParseMode.MARKDOWN_V2)
+
+def render_links_page(store, page, query=None):
+    """Returns (text, keyboard) for one page of saved links, or of the links matching `query`; text is None when there are none."""
+    def fetch(page):
+        if query is None: return store.count_links(), store.links(LINKS_PER_PAGE, page * LINKS_PER_PAGE)
+        return store.search_links(query, LINKS_PER_PAGE, page * LINKS_PER_PAGE)
+    page = max(page, 0); total, entries = fetch(page)
+    if not total: return None, None
+    pages = (total + LINKS_PER_PAGE - 1) // LINKS_PER_PAGE
+    if page >= pages: page = pages - 1; total, entries = fetch(page)
+    prefix = 'links' if query is None else 'search'; nav = []
+    if page > 0: nav.append(InlineKeyboardButton("« Prev", callback_data=f"{prefix}:{page - 1}"))
+    if page + 1 < pages: nav.append(InlineKeyboardButton("Next »", callback_data=f"{prefix}:{page + 1}"))
+    return get_saved_links_message(entries, page, pages, total, query), InlineKeyboardMarkup([nav]) if nav else None
 
 def savedlinks_command(update: Update, context: CallbackContext) -> None:
     LOGGER.info(f"User {update.effective_user.id} triggered /savedlinks")
-    with context.bot_data['data_lock']: saved_links = context.bot_data['saved_links']
-    if not saved_links: update.message.reply_text("No links have been saved yet\."); return
-    message = "*\-\-\- Saved Links \-\-\-*\n\n"
-    for filename, link in saved_links.items():
-        message += f"*File:* `{escape_markdown(filename)}`\n*Link:* {escape_markdown(link)}\n\n"
-    update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True)
+    text, keyboard = render_links_page(context.bot_data['store'], 0)
+    if not text: update.message.reply_text("No links have been saved yet\."); return
+    update.message.reply_text(text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True)
+
+def find_command(update: Update, context: CallbackContext) -> None:
+    LOGGER.info(f"User {update.effective_user.id} triggered /find")
+    query = " ".join(context.args).strip()
+    if not query: update.message.reply_text("Usage: `/find <part of a file name>`", parse_mode=ParseMode.MARKDOWN_V2); return
+    text, keyboard = render_links_page(context.bot_data['store'], 0, query)
+    if not text: update.message.reply_text(f"No saved links match `{escape_markdown(query)}`\.", parse_mode=ParseMode.MARKDOWN_V2); return
+    sent = update.message.reply_text(text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True)
+    # Callback data is limited to 64 bytes, so page buttons refer to the query through the message they belong to.
+    searches = context.chat_data.setdefault('searches', {}); searches[sent.message_id] = query
+    while len(searches) > MAX_SEARCHES_PER_CHAT: searches.pop(next(iter(searches)))
+
+def links_page_handler(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query; prefix, page = query.data.split(':')
+    search = None
+    if prefix == 'search':
+        search = context.chat_data.get('searches', {}).get(query.message.message_id)
+        if search is None: query.answer("This search has expired, run /find again."); return
+    text, keyboard = render_links_page(context.bot_data['store'], int(page), search)
+    query.answer()
+    if text: query.edit_message_text(text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True)
 
 def stats_command(update: Update, context: CallbackContext) -> None:
     LOGGER.info(f"User {update.effective_user.id} triggered /stats")
-    with context.bot_data['data_lock']: stats = context.bot_data['stats']
+    store = context.bot_data['store']; stats = store.counters(); stats['dedup_entries'] = store.count_cached()
     update.message.reply_text(get_stats_message(stats), parse_mode=ParseMode.MARKDOWN_V2)
 
 def h_command(update: Update, context: CallbackContext) -> None:
     LOGGER.info(f"User {update.effective_user.id} triggered /h")
     total, used, free = shutil.disk_usage("/")
-    with context.bot_data['data_lock']: total_bw = context.bot_data['stats']['downloaded'] + context.bot_data['stats']['uploaded']
-    update.message.reply_text(get_server_status_message(total, used, free, total_bw), parse_mode=ParseMode.MARKDOWN_V2)
+    stats = context.bot_data['store'].counters(); total_bw = stats['downloaded'] + stats['uploaded']
+    shaper = get_shaper(); limits = {direction: shaper.effective_limit(direction) for direction in DIRECTIONS}
+    update.message.reply_text(get_server_status_message(total, used, free, total_bw, get_client().stats(), measured_rates(context.bot_data['store']), limits),
+                              parse_mode=ParseMode.MARKDOWN_V2)
+
+def measured_rates(store):
+    # With worker processes the traffic is theirs; each reports its rates with its heartbeat.
+    return store.worker_rates(3 * QUEUE_POLL_INTERVAL) if JOB_QUEUE else get_shaper().rates()
+
+def limit_command(update: Update, context: CallbackContext) -> None:
+    user_id = update.effective_user.id; args = [arg.lower() for arg in context.args]
+    LOGGER.info(f"User {user_id} triggered /limit {' '.join(args)}")
+    if user_id not in ADMIN_USER_IDS:
+        update.message.reply_text("This command is only available to admins\."); return
+    shaper = get_shaper()
+    try:
+        if len(args) == 3 and args[0] in ('global', 'user') and args[1] in DIRECTIONS: shaper.set_limit(args[0], args[1], parse_rate(args[2]))
+        elif len(args) == 2 and args[0] == 'reserve': shaper.set_reserve(parse_rate(args[1]))
+        elif args: raise ValueError("Unknown arguments")
+    except ValueError:
+        update.message.reply_text("Invalid arguments\. Usage: `/limit global|user down|up <rate>` or `/limit reserve <rate>`\.", parse_mode=ParseMode.MARKDOWN_V2)
+        return
+    # Worker processes pick the caps up from the store with their next heartbeat.
+    if JOB_QUEUE and args: context.bot_data['store'].put_setting(LIMITS_SETTING, shaper.snapshot())
+    update.message.reply_text(get_limits_message(shaper.limits, shaper.user_limits, shaper.control_reserve), parse_mode=ParseMode.MARKDOWN_V2)
 
 def cancel(update: Update, context: CallbackContext) -> int:
     LOGGER.info(f"User {update.effective_user.id} triggered /cancel")
-    update.message.reply_text('Operation cancelled\. Note: any in\-progress download/upload will continue\.')
+    update.message.reply_text('Operation cancelled\. Use /jobs to cancel a queued or running download/upload\.')
     return ConversationHandler.END
 
+def show_filename_choice(message, context: CallbackContext) -> int:
+    original_filename = context.user_data['original_filename']
+    ext = os.path.splitext(original_filename)[1]; base_name = os.path.splitext(original_filename)[0]
+    context.user_data['smart_name'] = f"{parse_filename(base_name)}{ext}"
+    context.user_data['short_name'] = f"{''.join(random.choices(string.ascii_letters + string.digits, k=8))}{ext}"
+    text = get_filename_choice_message(context.user_data['original_filename'], context.user_data['smart_name'], context.user_data['short_name'])
+    keyboard = [[InlineKeyboardButton("1. Full Name", callback_data='full')],[InlineKeyboardButton("2. Smart Name", callback_data='smart')],
+                [InlineKeyboardButton("3. Short Name", callback_data='short')],[InlineKeyboardButton("4. Custom Name", callback_data='custom')]]
+    message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN_V2)
+    return AWAIT_FILENAME_CHOICE
+
+def show_file_selection(message, context: CallbackContext) -> int:
+    files = context.user_data['torrent_files']; selected = context.user_data['selected_files']; page = context.user_data['file_page']
+    page_files = files[page * FILES_PER_PAGE:(page + 1) * FILES_PER_PAGE]
+    keyboard = [[InlineKeyboardButton(f"{'✅' if index in selected else '⬜'} {os.path.basename(path)[:40]} ({format_bytes(size)})",
+                                      callback_data=f"fsel:{index}")] for index, path, size in page_files]
+    nav = []
+    if page > 0: nav.append(InlineKeyboardButton("« Prev", callback_data=f"fpage:{page - 1}"))
+    nav += [InlineKeyboardButton("All", callback_data='fall'), InlineKeyboardButton("None", callback_data='fnone')]
+    if (page + 1) * FILES_PER_PAGE < len(files): nav.append(InlineKeyboardButton("Next »", callback_data=f"fpage:{page + 1}"))
+    keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("📦 Upload as one .tar", callback_data='fmode:tar'),
+                     InlineKeyboardButton("📄 Upload each file", callback_data='fmode:each')])
+    text = get_file_selection_message(context.user_data['torrent_name'], files, selected, page, FILES_PER_PAGE)
+    message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN_V2)
+    return AWAIT_FILE_SELECTION
+
 def receive_link(update: Update, context: CallbackContext) -> int:
     user_id = update.effective_user.id
     url = update.message.text.strip(); LOGGER.info(f"User {user_id} sent a link/magnet for processing.")
-    context.user_data['url'] = url
+    context.user_data['url'] = url; context.user_data.pop('options', None); context.user_data.pop('probe', None)
+    context.user_data.pop('torrent_size', None); context.user_data.pop('disk_name', None)
     message = update.message.reply_text("_Fetching file details\.\.\._", parse_mode=ParseMode.MARKDOWN_V2)
     original_filename = "magnet_download"
     if url.startswith('http'):
-        original_filename = get_http_filename(url)
+        probe = context.user_data['probe'] = probe_http(url)
+        original_filename = probe['filename'] if probe else None
         if not original_filename:
             LOGGER.warning(f"User {user_id} sent an invalid HTTP link. Could not get filename.")
             message.edit_text("Could not fetch file details\. Please check the URL\."); return ConversationHandler.END
-    ext = os.path.splitext(original_filename)[1]; base_name = os.path.splitext(original_filename)[0]
+    elif url.startswith('magnet:'):
+        info = fetch_torrent_info(url)
+        if info is not None:
+            original_filename = re.sub(r'[<>:"/\\|?*]', '_', info.name())
+            files = list_torrent_files(info)
+            context.user_data.update(torrent_size=sum(size for _, _, size in files), disk_name=files[0][1].split(os.sep)[0] if files else info.name())
+            if len(files) > 1:
+                LOGGER.info(f"User {user_id} sent a multi-file torrent with {len(files)} files; offering file selection.")
+                context.user_data.update(torrent_name=original_filename, torrent_files=files, file_page=0,
+                                         selected_files={index for index, _, _ in files})
+                return show_file_selection(message, context)
     context.user_data['original_filename'] = original_filename
-    context.user_data['smart_name'] = f"{parse_filename(base_name)}{ext}"
-    context.user_data['short_name'] = f"{''.join(random.choices(string.ascii_letters + string.digits, k=8))}{ext}"
-    text = get_filename_choice_message(context.user_data['original_filename'], context.user_data['smart_name'], context.user_data['short_name'])
-    keyboard = [[InlineKeyboardButton("1. Full Name", callback_data='full')],[InlineKeyboardButton("2. Smart Name", callback_data='smart')],
-                [InlineKeyboardButton("3. Short Name", callback_data='short')],[InlineKeyboardButton("4. Custom Name", callback_data='custom')]]
-    message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN_V2)
-    return AWAIT_FILENAME_CHOICE
+    return show_filename_choice(message, context)
+
+def file_selection_handler(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query; choice = query.data
+    files = context.user_data['torrent_files']; selected = context.user_data['selected_files']
+    if choice.startswith('fmode:'):
+        if not selected: query.answer("Select at least one file."); return AWAIT_FILE_SELECTION
+        query.answer(); mode = choice.split(':', 1)[1]
+        context.user_data['options'] = {'files': sorted(selected), 'mode': mode}
+        context.user_data['torrent_size'] = sum(size for index, _, size in files if index in selected)
+        LOGGER.info(f"User {update.effective_user.id} selected {len(selected)} of {len(files)} torrent files, mode '{mode}'")
+        if mode == 'each': return start_worker_and_notify(update, context, context.user_data['torrent_name'])
+        context.user_data['original_filename'] = f"{context.user_data['torrent_name']}.tar"
+        return show_filename_choice(query.message, context)
+    query.answer()
+    if choice.startswith('fsel:'): selected ^= {int(choice.split(':', 1)[1])}
+    elif choice.startswith('fpage:'): context.user_data['file_page'] = int(choice.split(':', 1)[1])
+    elif choice == 'fall': selected.update(index for index, _, _ in files)
+    elif choice == 'fnone': selected.clear()
+    return show_file_selection(query.message, context)
+
+def submit_job(context: CallbackContext, user_id: int, chat_id: int, url: str, final_filename: str, options: dict = None,
+               job_id: str = None, priority: int = PRIORITY_NORMAL, batch: Batch = None) -> int:
+    """Journals and queues a job; returns its queue position. Raises QueueFull when the scheduler is saturated.
+    A job whose name is already used by an active job is renamed (see Store.save_job) and the user is told."""
+    job_id = job_id or uuid.uuid4().hex[:12]
+    requested_filename = final_filename
+    final_filename = context.bot_data['store'].save_job(job_id, user_id, chat_id, url, final_filename, options)
+    if final_filename != requested_filename:
+        LOGGER.info(f"[USER:{user_id}] {requested_filename} is already in use by another job; saving job {job_id} as {final_filename}")
+        try: context.bot.send_message(chat_id, f"ℹ️ Another task is already saving `{escape_markdown(requested_filename)}`, so this one is saved as `{escape_markdown(final_filename)}`\.", parse_mode=ParseMode.MARKDOWN_V2)
+        except Exception as e: LOGGER.warning(f"Could not tell user {user_id} about the renamed job {job_id}: {e}")
+    job = Job(job_id, user_id, chat_id, url, final_filename, options, priority)
+
+    def forget_job(state='done'):
+        context.bot_data['store'].finish_job(job_id, 'cancelled' if job.cancelled else state)
+
+    def on_task_complete(final_status_text): # MODIFIED: Accepts final status
+        forget_job()
+        if batch: batch.finish(job_id, status_outcome(final_status_text)); publish_batch_status(batch)
+        others = [other for other in SCHEDULER.jobs_for_user(user_id) if other.job_id != job_id]
+        with task_lock:
+            info_message = INFO_MESSAGES.pop(user_id, None) if not others else None
+        # NEW: Update the info message with the final status if it exists
+        if info_message:
+            BROADCASTER.publish_final(info_message['chat_id'], info_message['message_id'], final_status_text)
+        elif others and user_id in INFO_MESSAGES:
+            try: context.bot.send_message(chat_id, final_status_text, parse_mode=ParseMode.MARKDOWN_V2)
+            except BadRequest as e: LOGGER.warning(f"Could not send final status for user {user_id}: {e}")
+            publish_user_status(user_id)
+
+    def on_cancelled(job):
+        forget_job()
+        if batch: batch.finish(job_id, 'cancelled'); publish_batch_status(batch)
+        try: context.bot.send_message(chat_id, f"🚫 *Removed from queue:* `{escape_markdown(final_filename)}`", parse_mode=ParseMode.MARKDOWN_V2)
+        except Exception as e: LOGGER.warning(f"Could not notify user {user_id} about cancelled job {job_id}: {e}")
+
+    def on_status(job):
+        publish_user_status(job.user_id)
+        if batch: publish_batch_status(batch)
+
+    job.on_status = on_status; job.on_complete = on_task_complete
+
+    def task_factory(job):
+        return worker_task(url, final_filename, user_id, chat_id, context.bot_data['store'], lambda chat_id, text: send_markdown(context.bot, chat_id, text),
+                           BUZZHEAVIER_ACCOUNT_ID, BUZZHEAVIER_ROOT_DIR_ID, job.set_status, on_task_complete, options, SCHEDULER.submit_upload)
+
+    try:
+        return SCHEDULER.submit(job, task_factory, on_cancelled)
+    except QueueFull:
+        forget_job('rejected'); raise
+
+def send_markdown(bot, chat_id, text):
+    bot.send_message(chat_id, text, parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True)
+
+def prepare_job(store, url, options=None, probe=None, torrent_size=0, disk_name=None):
+    """Checks the dedup cache and the disk for a job about to be queued. Returns (options, cached_uploads, too_big):
+    cached_uploads is set on a dedup hit, too_big when the job could never fit on disk."""
+    options = dict(options or {})
+    key = cache_key(url, options, probe) if DEDUP_CACHE else None
+    cached = store.cache_get(key, DEDUP_TTL) if key else None
+    if cached: return options, cached, False
+    if key: options['cache_key'] = key
+    if probe and probe['size']: options['size'] = probe['size']
+    elif url.startswith('magnet:') and torrent_size: options.update(size=torrent_size, disk_name=disk_name)
+    return options, None, options.get('size', 0) > ADMISSION.capacity()
 
 def start_worker_and_notify(update: Update, context: CallbackContext, final_filename: str):
     user_id = update.effective_user.id; chat_id = update.effective_chat.id; url = context.user_data['url']
     LOGGER.info(f"User {user_id} confirmed filename '{final_filename}'. Submitting worker task.")
-    message_text = f"✅ *Task started successfully\!* Use /info to track progress\."
+    options, cached, too_big = prepare_job(context.bot_data['store'], url, context.user_data.get('options'), context.user_data.get('probe'),
+                                           context.user_data.get('torrent_size'), context.user_data.get('disk_name'))
+    if cached:
+        LOGGER.info(f"Dedup cache hit for user {user_id}: {final_filename} was already uploaded.")
+        message_text = get_cached_upload_message(cached)
+        if update.callback_query: update.callback_query.edit_message_text(message_text, parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True)
+        else: update.message.reply_text(message_text, parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True)
+        return ConversationHandler.END
+    if too_big:
+        LOGGER.warning(f"Rejected job from user {user_id}: {options['size']} bytes can never fit on disk.")
+        message_text = f"❌ *Not enough disk space:* this download needs {escape_markdown(format_bytes(options['size']))}\."
+        if update.callback_query: update.callback_query.edit_message_text(message_text, parse_mode=ParseMode.MARKDOWN_V2)
+        else: update.message.reply_text(message_text, parse_mode=ParseMode.MARKDOWN_V2)
+        return ConversationHandler.END
+    try:
+        position = submit_job(context, user_id, chat_id, url, final_filename, options or None)
+        message_text = f"✅ *Task queued at position {position}\!* Use /info to track progress or /jobs to cancel\."
+    except QueueFull:
+        LOGGER.warning(f"Queue full; rejected job from user {user_id}.")
+        message_text = "❌ *The job queue is full\.* Please try again later\."
     if update.callback_query: update.callback_query.edit_message_text(message_text, parse_mode=ParseMode.MARKDOWN_V2)
     else: update.message.reply_text(message_text, parse_mode=ParseMode.MARKDOWN_V2)
-    
-    def update_status_in_active_tasks(text):
-        with task_lock:
-            if user_id in ACTIVE_TASKS: ACTIVE_TASKS[user_id]['status_text'] = text
-            
-    def on_task_complete(final_status_text): # MODIFIED: Accepts final status
-        with task_lock:
-            if user_id in ACTIVE_TASKS:
-                task_info = ACTIVE_TASKS.pop(user_id) # MODIFIED: Use pop to get and remove atomically
-                # NEW: Update the info message with the final status if it exists
-                if task_info.get('info_message_id'):
-                    try:
-                        context.bot.edit_message_text(
-                            text=final_status_text,
-                            chat_id=task_info['info_chat_id'],
-                            message_id=task_info['info_message_id'],
-                            parse_mode=ParseMode.MARKDOWN_V2
-                        )
-                    except BadRequest as e:
-                        LOGGER.warning(f"Could not edit final status for user {user_id}: {e}")
-
-    with task_lock: ACTIVE_TASKS[user_id] = {'status_text': 'Initializing\.\.\.'} # MODIFIED: Simplified dict
-    
-    executor.submit(worker_task, url, final_filename, user_id, chat_id, context,
-                    BUZZHEAVIER_ACCOUNT_ID, BUZZHEAVIER_ROOT_DIR_ID,
-                    update_status_in_active_tasks, on_task_complete)
     return ConversationHandler.END
 
+def resume_pending_jobs(dispatcher, pending):
+    """Re-queues `pending` (store.pending_jobs() as of startup); runs in the background because every resumed job
+    is announced with a Telegram message."""
+    context = CallbackContext(dispatcher)
+    store = context.bot_data['store']
+    if JOB_QUEUE:
+        # Workers keep running while the bot restarts, so the queued jobs only need their status hooks back.
+        for job in pending:
+            try: submit_job(context, job['user_id'], job['chat_id'], job['url'], job['filename'], job['options'], job_id=job['job_id'], priority=job['priority'])
+            except ValueError: LOGGER.info(f"Job {job['job_id']} finished while the bot was starting.")
+        return
+    for job in pending:
+        job_id = job['job_id']; resumes = store.bump_resumes(job_id)
+        filename = escape_markdown(job['filename'])
+        if resumes > MAX_JOB_RESUMES:
+            store.finish_job(job_id, 'abandoned')
+            LOGGER.warning(f"Dropping job {job_id} for {job['filename']}: resumed too many times.")
+            try: context.bot.send_message(job['chat_id'], f"❌ *Giving up on* `{filename}` after {MAX_JOB_RESUMES} restarts\.", parse_mode=ParseMode.MARKDOWN_V2)
+            except Exception as e: LOGGER.warning(f"Could not notify user {job['user_id']} about abandoned job {job_id}: {e}")
+            continue
+        try:
+            LOGGER.info(f"Re-queueing unfinished job {job_id} for user {job['user_id']}: {job['filename']}")
+            context.bot.send_message(job['chat_id'], f"♻️ *Resuming interrupted task for* `{filename}`\. Use /info to track progress\.", parse_mode=ParseMode.MARKDOWN_V2)
+        except Exception as e:
+            LOGGER.warning(f"Could not notify user {job['user_id']} about resumed job {job_id}: {e}")
+        try:
+            submit_job(context, job['user_id'], job['chat_id'], job['url'], job['filename'], job['options'],
+                       job_id=job_id, priority=PRIORITY_RESUMED)
+        except QueueFull:
+            LOGGER.error(f"Queue full while resuming job {job_id}; it stays journaled for the next start.")
+
 def filename_choice_handler(update: Update, context: CallbackContext) -> int:
     query = update.callback_query; query.answer(); choice = query.data
     LOGGER.info(f"User {update.effective_user.id} chose filename option: '{choice}'")
@@ -200,32 +418,182 @@ def custom_name_received(update: Update, context: CallbackContext) -> int:
     final_filename = f"{custom_name}{ext}" if ext and not custom_name.endswith(ext) else custom_name
     return start_worker_and_notify(update, context, final_filename)
 
-def main() -> None:
+def batch_command(update: Update, context: CallbackContext) -> int:
+    user_id = update.effective_user.id
+    LOGGER.info(f"User {user_id} triggered /batch")
+    if len(SCHEDULER.jobs_for_user(user_id)) >= MAX_JOBS_PER_USER:
+        update.message.reply_text(f"You already have {MAX_JOBS_PER_USER} queued or running jobs\. Please wait for some to complete\.")
+        return ConversationHandler.END
+    update.message.reply_text(get_batch_prompt_message(BATCH_MAX_LINKS), parse_mode=ParseMode.MARKDOWN_V2)
+    return AWAIT_BATCH
+
+def receive_batch(update: Update, context: CallbackContext) -> int:
+    """Resolves pasted or uploaded links in parallel. Runs as an async handler, so the waiting never blocks the dispatcher."""
+    user_id = update.effective_user.id; document = update.message.document
+    if document:
+        if document.file_size and document.file_size > 1024 * 1024: update.message.reply_text("That list is too large\."); return AWAIT_BATCH
+        text = document.get_file().download_as_bytearray().decode('utf-8', errors='replace')
+    else: text = update.message.text
+    urls = extract_links(text)
+    if not urls: update.message.reply_text("I could not find any URLs or magnet links in that\. Send them again or /cancel\."); return AWAIT_BATCH
+    room = max(0, min(BATCH_MAX_LINKS, MAX_JOBS_PER_USER - len(SCHEDULER.jobs_for_user(user_id))))
+    if not room:
+        # Jobs started since /batch may have used up the rest of the allowance.
+        update.message.reply_text(f"You already have {MAX_JOBS_PER_USER} queued or running jobs\. Please wait for some to complete\.")
+        return ConversationHandler.END
+    dropped = urls[room:]; urls = urls[:room]
+    LOGGER.info(f"User {user_id} submitted a batch of {len(urls)} links ({len(dropped)} over the limit).")
+    message = update.message.reply_text(get_batch_resolving_message(0, len(urls)), parse_mode=ParseMode.MARKDOWN_V2)
+    last_edit = [time.time()]
+
+    def on_progress(done, total):
+        if done < total and time.time() - last_edit[0] >= BROADCAST_CHAT_INTERVAL:
+            last_edit[0] = time.time()
+            try: message.edit_text(get_batch_resolving_message(done, total), parse_mode=ParseMode.MARKDOWN_V2)
+            except BadRequest: pass
+
+    items = resolve_links(urls, on_progress)
+    resolved = [item for item in items if not item['error']]
+    failed = [(item['url'], item['error']) for item in items if item['error']] + [(url, "over the batch limit") for url in dropped]
+    if not resolved:
+        message.edit_text("None of those links could be resolved\. Please check them and try /batch again\.", parse_mode=ParseMode.MARKDOWN_V2)
+        return ConversationHandler.END
+    context.user_data['batch_items'] = resolved
+    samples = {policy: apply_policy(resolved[:1], policy)[0] for policy in POLICIES}
+    keyboard = [[InlineKeyboardButton("Full Names", callback_data='bfull'), InlineKeyboardButton("Smart Names", callback_data='bsmart'),
+                 InlineKeyboardButton("Short Names", callback_data='bshort')], [InlineKeyboardButton("Cancel", callback_data='bcancel')]]
+    message.edit_text(get_batch_choice_message([item['name'] for item in resolved], failed, sum(item['size'] or 0 for item in resolved), samples),
+                      reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True)
+    return AWAIT_BATCH_POLICY
+
+def batch_policy_handler(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query; query.answer(); policy = query.data[1:]
+    user_id = update.effective_user.id; chat_id = update.effective_chat.id
+    items = context.user_data.pop('batch_items', [])
+    if policy == 'cancel' or not items: query.edit_message_text("Batch cancelled\."); return ConversationHandler.END
+    LOGGER.info(f"User {user_id} chose '{policy}' names for a batch of {len(items)} links.")
+    store = context.bot_data['store']; batch = Batch(uuid.uuid4().hex[:12], user_id, chat_id, query.message.message_id)
+    for item, name in zip(items, apply_policy(items, policy)):
+        options, cached, too_big = prepare_job(store, item['url'], item['options'], item['probe'], item['size'], item['disk_name'])
+        if cached:
+            batch.add(None, name, item['size'], 'cached')
+            context.bot.send_message(chat_id, get_cached_upload_message(cached), parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True)
+            continue
+        if too_big: batch.add(None, name, item['size'], 'skipped'); continue
+        job_id = uuid.uuid4().hex[:12]; batch.add(job_id, name, item['size'])
+        try: submit_job(context, user_id, chat_id, item['url'], name, options or None, job_id=job_id, batch=batch)
+        except QueueFull:
+            LOGGER.warning(f"Queue full while submitting batch {batch.batch_id} for user {user_id}.")
+            batch.finish(job_id, 'skipped')
+    query.edit_message_text(render_batch_status(batch), parse_mode=ParseMode.MARKDOWN_V2)
+    publish_batch_status(batch)
+    return ConversationHandler.END
+
+def render_batch_status(batch: Batch) -> str:
+    entries = []
+    for job_id, name, size, outcome in batch.snapshot():
+        job = SCHEDULER.get(job_id) if job_id and not outcome else None
+        entries.append((name, size, outcome or (job.state if job and job.state in ('downloading', 'uploading') else 'queued')))
+    return get_batch_status_message(entries)
+
+def publish_batch_status(batch: Batch):
+    publish = BROADCASTER.publish_final if batch.done else BROADCASTER.publish
+    publish(batch.chat_id, batch.message_id, lambda: render_batch_status(batch))
+
+def set_root_dir_id(root_id):
     global BUZZHEAVIER_ROOT_DIR_ID
+    BUZZHEAVIER_ROOT_DIR_ID = root_id
+    SCHEDULER.release(ROOT_DIR_HOLD)
+
+def finish_startup(dispatcher, pending):
+    # Everything here may be slow (disk walks, Telegram messages), so it runs while the bot is already polling.
+    try:
+        prune_staged_downloads(STAGED_FILE_TTL)
+        resume_pending_jobs(dispatcher, pending)
+    except Exception as e:
+        LOGGER.error(f"Startup housekeeping failed: {e}", exc_info=True)
+
+def supervise_local_workers(count, stopping):
+    """Starts `count` worker.py processes and restarts any that exit until `stopping` is set; returns the processes."""
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")]
+    # Numbered from 1, so each gets its own metrics port and torrent state file; a restart keeps the number.
+    def start(index): return subprocess.Popen(command, env=dict(os.environ, WORKER_INDEX=str(index + 1)))
+    processes = [start(index) for index in range(count)]
+    LOGGER.info(f"Started {count} worker processes: {', '.join(str(process.pid) for process in processes)}")
+
+    def watch():
+        while not stopping.wait(WORKER_RESTART_DELAY):
+            for index, process in enumerate(processes):
+                if process.poll() is None: continue
+                LOGGER.warning(f"Worker process {process.pid} exited with code {process.returncode}; restarting it.")
+                processes[index] = start(index)
+
+    threading.Thread(target=watch, name="worker-supervisor", daemon=True).start()
+    return processes
+
+def start_metrics(store):
+    Gauge('securefetch_jobs', 'Jobs in the scheduler by state.', SCHEDULER.state_counts, ('state',))
+    Gauge('securefetch_status_edits_pending', 'Status edits waiting for the broadcaster.', BROADCASTER.pending_count)
+    Gauge('securefetch_disk_available_bytes', 'Free space left for new jobs after the floor and admitted reservations.', ADMISSION.available)
+    Gauge('securefetch_shaper_rate_bytes_per_second', 'Measured transfer rate over the shaper window.', lambda: measured_rates(store), ('direction',))
+    Gauge('securefetch_http_requests_total', 'Requests sent through the shared HTTP client.', lambda: get_client().stats()['requests'], kind='counter')
+    Gauge('securefetch_http_connections_total', 'Connections opened by the shared HTTP client.', lambda: get_client().stats()['connections'], kind='counter')
+    start_metrics_server(METRICS_HOST, METRICS_PORT)
+
+def main() -> None:
+    global BUZZHEAVIER_ROOT_DIR_ID, BROADCASTER, SCHEDULER
     setup_logger()
     LOGGER.info("Bot process started.")
     if not all([BOT_TOKEN, BUZZHEAVIER_ACCOUNT_ID]): LOGGER.critical("BOT_TOKEN or BUZZHEAVIER_ACCOUNT_ID not found in .env file."); sys.exit(1)
     updater = Updater(BOT_TOKEN); dispatcher = updater.dispatcher
+    BROADCASTER = StatusBroadcaster(updater.bot, BROADCAST_GLOBAL_RATE, BROADCAST_CHAT_INTERVAL, on_forget=forget_info_message)
     load_data(dispatcher)
-    BUZZHEAVIER_ROOT_DIR_ID = fetch_root_dir_id(BUZZHEAVIER_ACCOUNT_ID)
-    if not BUZZHEAVIER_ROOT_DIR_ID: LOGGER.critical("Could not fetch BuzzHeavier Root ID. Exiting."); sys.exit(1)
+    if JOB_QUEUE:
+        limits = dispatcher.bot_data['store'].get_setting(LIMITS_SETTING)
+        if limits is not None: get_shaper().restore(limits)
+        SCHEDULER = QueueScheduler(dispatcher.bot_data['store'], lambda chat_id, text: send_markdown(updater.bot, chat_id, text),
+                                   MAX_QUEUED_JOBS, QUEUE_POLL_INTERVAL)
+    else:
+        SCHEDULER = JobScheduler(DOWNLOAD_WORKERS, UPLOAD_WORKERS, GLOBAL_JOB_SLOTS, PER_USER_JOB_SLOTS, MAX_QUEUED_JOBS,
+                                 admission=ADMISSION, recheck_interval=DISK_RECHECK_INTERVAL)
+    if METRICS_PORT: start_metrics(dispatcher.bot_data['store'])
+    if not JOB_QUEUE:
+        # Commands are served right away; only the jobs wait until uploads have a target folder.
+        SCHEDULER.hold(ROOT_DIR_HOLD)
+        resolve_root_dir_id(BUZZHEAVIER_ACCOUNT_ID, init_client(), ROOT_ID_CACHE_FILE, ROOT_ID_TTL, ROOT_ID_RETRY, set_root_dir_id)
     if not os.path.exists(DOWNLOAD_PATH): os.makedirs(DOWNLOAD_PATH); LOGGER.info(f"Created download directory at {DOWNLOAD_PATH}")
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('send', send_command)],
-        states={AWAIT_LINK: [MessageHandler(Filters.text & ~Filters.command, receive_link)],
-                AWAIT_FILENAME_CHOICE: [CallbackQueryHandler(filename_choice_handler)],
+        entry_points=[CommandHandler('send', send_command), CommandHandler('batch', batch_command)],
+        # Link handlers wait on HEADs and torrent metadata, so they run on the dispatcher's worker pool.
+        states={AWAIT_LINK: [MessageHandler(Filters.text & ~Filters.command, receive_link, run_async=True)],
+                AWAIT_BATCH: [MessageHandler((Filters.text & ~Filters.command) | Filters.document.file_extension('txt'), receive_batch, run_async=True)],
+                AWAIT_BATCH_POLICY: [CallbackQueryHandler(batch_policy_handler, pattern=r'^b(full|smart|short|cancel)$')],
+                AWAIT_FILE_SELECTION: [CallbackQueryHandler(file_selection_handler, pattern=r'^f(sel|page|all|none|mode)')],
+                AWAIT_FILENAME_CHOICE: [CallbackQueryHandler(filename_choice_handler, pattern=r'^(full|smart|short|custom)$')],
                 AWAIT_CUSTOM_NAME: [MessageHandler(Filters.text & ~Filters.command, custom_name_received)]},
         fallbacks=[CommandHandler('cancel', cancel)])
     dispatcher.add_handler(CommandHandler("start", start))
     dispatcher.add_handler(conv_handler)
     dispatcher.add_handler(CommandHandler("info", info_command))
+    dispatcher.add_handler(CommandHandler("jobs", jobs_command))
+    dispatcher.add_handler(CallbackQueryHandler(job_cancel_handler, pattern=r'^jcancel:'))
     dispatcher.add_handler(CommandHandler("savedlinks", savedlinks_command))
+    dispatcher.add_handler(CommandHandler("find", find_command))
+    dispatcher.add_handler(CallbackQueryHandler(links_page_handler, pattern=r'^(links|search):\d+$'))
     dispatcher.add_handler(CommandHandler("stats", stats_command))
     dispatcher.add_handler(CommandHandler("h", h_command))
+    dispatcher.add_handler(CommandHandler("limit", limit_command))
+    # Taken before polling starts, so jobs submitted from now on are never mistaken for interrupted ones.
+    pending = dispatcher.bot_data['store'].pending_jobs()
+    stopping = threading.Event()
+    workers = supervise_local_workers(LOCAL_WORKERS, stopping) if JOB_QUEUE and LOCAL_WORKERS else []
     updater.start_polling()
     LOGGER.info("Bot started successfully. Listening for commands...")
+    threading.Thread(target=finish_startup, args=(dispatcher, pending), name="startup", daemon=True).start()
     updater.idle()
     LOGGER.info("Bot is shutting down.")
+    stopping.set()
+    for process in workers: process.terminate()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,99 @@
+# broadcaster.py
+
+import time
+import threading
+from telegram import ParseMode
+from telegram.error import BadRequest, RetryAfter, TimedOut, NetworkError
+
+from utils import TokenBucket, LOGGER
+from metrics import TELEGRAM_EDIT_SECONDS, TELEGRAM_EDITS, TELEGRAM_RETRY_AFTER, TELEGRAM_RETRY_AFTER_SECONDS
+
+class StatusBroadcaster:
+    """One thread that owns every live status edit. Producers only drop the latest text (or a zero-argument
+    callable that renders it) into a dict keyed by message, so the progress hot path never takes a lock and
+    intermediate states are coalesced. Edits go out under a global and a per-chat token bucket, unchanged
+    texts are skipped, and RetryAfter pauses the whole sender instead of killing it. `on_forget(chat_id, message_id)`
+    is called when Telegram rejects an edit for good (message deleted, too old), so its owner can drop it too."""
+    def __init__(self, bot, global_rate, chat_interval, tick=0.5, on_forget=None):
+        self._bot = bot
+        self._on_forget = on_forget
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_interval = chat_interval
+        self._chat_buckets = {}
+        self._pending = {}
+        self._last_sent = {}
+        self._final = set()
+        self._blocked_until = 0
+        self._tick = tick
+        threading.Thread(target=self._run, name="status-broadcaster", daemon=True).start()
+
+    def pending_count(self):
+        return len(self._pending)
+
+    def publish(self, chat_id, message_id, text):
+        # A plain dict assignment: safe without a lock under the GIL, and a newer state simply replaces an unsent one.
+        self._pending[(chat_id, message_id)] = text
+
+    def publish_final(self, chat_id, message_id, text):
+        """Last edit for a message: it is still rate-limited, but the message is forgotten once it has been sent."""
+        self._final.add((chat_id, message_id))
+        self._pending[(chat_id, message_id)] = text
+
+    def forget(self, chat_id, message_id):
+        self._pending.pop((chat_id, message_id), None)
+        self._last_sent.pop((chat_id, message_id), None)
+        self._final.discard((chat_id, message_id))
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(1 / self._chat_interval, 1)
+        return bucket
+
+    def _run(self):
+        while True:
+            time.sleep(self._tick)
+            if time.time() < self._blocked_until: continue
+            for key in list(self._pending):
+                chat_id, message_id = key
+                text = self._pending.pop(key, None)
+                if callable(text):
+                    try: text = text()
+                    except Exception as e: LOGGER.error(f"Status render failed: {e}"); continue
+                if not text or text == self._last_sent.get(key):
+                    if key in self._final and key not in self._pending: self.forget(chat_id, message_id)
+                    continue
+                # Tokens are only taken for an edit that goes out now: global first, and given back if the chat has none.
+                # Otherwise the rendered text waits for the next tick, unless a newer state arrived meanwhile.
+                if not self._global.try_consume(): self._pending.setdefault(key, text); break
+                if not self._chat_bucket(chat_id).try_consume():
+                    self._global.refund(); self._pending.setdefault(key, text); continue
+                if not self._send(key, text): break
+
+    def _send(self, key, text):
+        chat_id, message_id = key; started = time.monotonic()
+        try:
+            self._bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, parse_mode=ParseMode.MARKDOWN_V2)
+            TELEGRAM_EDIT_SECONDS.observe(time.monotonic() - started); TELEGRAM_EDITS.labels('ok').inc()
+            self._last_sent[key] = text
+            if key in self._final and key not in self._pending: self.forget(chat_id, message_id)
+        except RetryAfter as e:
+            TELEGRAM_RETRY_AFTER.inc(); TELEGRAM_RETRY_AFTER_SECONDS.inc(e.retry_after); TELEGRAM_EDITS.labels('retry_after').inc()
+            LOGGER.warning(f"Telegram flood control: pausing status edits for {e.retry_after}s")
+            self._blocked_until = time.time() + e.retry_after
+            self._pending.setdefault(key, text)
+            return False
+        except BadRequest as e:
+            TELEGRAM_EDITS.labels('not_modified' if "Message is not modified" in str(e) else 'bad_request').inc()
+            if "Message is not modified" in str(e): self._last_sent[key] = text
+            else:
+                LOGGER.error(f"Info update error for chat {chat_id}: {e}"); self.forget(chat_id, message_id)
+                if self._on_forget: self._on_forget(chat_id, message_id)
+        except (TimedOut, NetworkError) as e:
+            TELEGRAM_EDITS.labels('network_error').inc()
+            LOGGER.warning(f"Transient error editing status for chat {chat_id}: {e}")
+            self._pending.setdefault(key, text)
+        except Exception as e:
+            TELEGRAM_EDITS.labels('error').inc()
+            LOGGER.error(f"Unexpected info update error: {e}")
+        return True
@@ -0,0 +1,130 @@
+# config.py
+
+import os
+from dotenv import load_dotenv
+
+# Loaded here (not only in bot.py) so tuning knobs from .env are visible to every module at import time.
+load_dotenv()
+
+def env_int(name, default):
+    try: return int(os.getenv(name, default))
+    except (TypeError, ValueError): return default
+
+def env_bool(name, default):
+    value = os.getenv(name)
+    if value is None: return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+# Pass-through mode: pipe HTTP downloads straight into the BuzzHeavier upload instead of staging to disk. Only used
+# for sources without Accept-Ranges; the others are staged so an interrupted transfer resumes instead of restarting.
+STREAM_UPLOADS = env_bool("STREAM_UPLOADS", True)
+STREAM_BUFFER_CHUNKS = env_int("STREAM_BUFFER_CHUNKS", 16)   # 1 MiB chunks held in memory between the two sides
+STREAM_STALL_TIMEOUT = env_int("STREAM_STALL_TIMEOUT", 60)   # seconds either side may stall before falling back
+
+# Segmented downloads: parallel Range requests into a preallocated file when the source allows it.
+SEGMENTED_DOWNLOADS = env_bool("SEGMENTED_DOWNLOADS", True)
+DOWNLOAD_CONNECTIONS = env_int("DOWNLOAD_CONNECTIONS", 4)
+SEGMENT_MIN_SIZE = env_int("SEGMENT_MIN_SIZE", 16 * 1024 * 1024)     # smaller files use a single stream
+SEGMENT_SPLIT_MIN = env_int("SEGMENT_SPLIT_MIN", 4 * 1024 * 1024)    # never split a segment below this
+
+# Write-behind for HTTP downloads: sockets are read into pooled buffers that a writer thread drains to disk.
+DOWNLOAD_BUFFER_SIZE = env_int("DOWNLOAD_BUFFER_SIZE", 1024 * 1024)      # bytes per receive buffer
+DOWNLOAD_BUFFERS = env_int("DOWNLOAD_BUFFERS", 16)                      # buffers per download: memory cap and slack for a slow disk
+DOWNLOAD_WRITE_MAX = env_int("DOWNLOAD_WRITE_MAX", 8 * 1024 * 1024)    # largest coalesced write
+
+# Resumable downloads: bounded exponential backoff between Range-resumed attempts.
+HTTP_RETRIES = env_int("HTTP_RETRIES", 5)
+HTTP_RETRY_BACKOFF = env_int("HTTP_RETRY_BACKOFF", 2)         # seconds, doubled per attempt
+HTTP_RETRY_BACKOFF_MAX = env_int("HTTP_RETRY_BACKOFF_MAX", 60)
+
+# Shared keep-alive HTTP client: one connection pool per host, reused by every request to it.
+HTTP_POOL_HOSTS = env_int("HTTP_POOL_HOSTS", 32)             # distinct hosts kept pooled at once
+HTTP_POOL_SIZE = env_int("HTTP_POOL_SIZE", 16)               # open connections kept per host (segments of parallel jobs share them)
+HTTP_CONNECT_TIMEOUT = env_int("HTTP_CONNECT_TIMEOUT", 15)
+HTTP_READ_TIMEOUT = env_int("HTTP_READ_TIMEOUT", 60)         # seconds without receiving any data
+HTTP_UPLOAD_TIMEOUT = env_int("HTTP_UPLOAD_TIMEOUT", 10800)  # read timeout for an upload's final response
+HTTP_ADAPTER_RETRIES = env_int("HTTP_ADAPTER_RETRIES", 3)    # connection errors and 502/503/504 on HEAD/GET
+HTTP_ADAPTER_BACKOFF = float(os.getenv("HTTP_ADAPTER_BACKOFF", "0.5"))
+UPLOAD_BLOCK_SIZE = env_int("UPLOAD_BLOCK_SIZE", 1024 * 1024)  # bytes per socket write of an upload body (page-aligned)
+UPLOAD_SENDFILE = env_bool("UPLOAD_SENDFILE", True)            # kernel sendfile() for files uploaded to plain-HTTP targets
+# SHA-256 plus a fast hash of every download and upload, checked against each other and the source's digests.
+# The upload side has to see the bytes, so hashed uploads use the buffered path instead of sendfile().
+INTEGRITY_CHECKS = env_bool("INTEGRITY_CHECKS", True)
+
+# BuzzHeavier endpoints; point both at standin.py to exercise uploads locally.
+BUZZHEAVIER_UPLOAD_URL = os.getenv("BUZZHEAVIER_UPLOAD_URL", "https://w.buzzheavier.com").rstrip("/")
+BUZZHEAVIER_API_URL = os.getenv("BUZZHEAVIER_API_URL", "https://buzzheavier.com").rstrip("/")
+UPLOAD_RETRIES = env_int("UPLOAD_RETRIES", 4)                # re-sends after a dropped or 5xx upload (HTTP_RETRY_BACKOFF applies)
+STAGED_FILE_TTL = env_int("STAGED_FILE_TTL", 24 * 3600)      # downloaded files whose upload failed are kept this long for a retry
+
+# Worker processes (JOB_QUEUE mode): the bot numbers the ones it starts 1..LOCAL_WORKERS; give every other worker on
+# the same host its own number too. A worker serves its metrics on METRICS_PORT + WORKER_INDEX and keeps its own
+# torrent session state file, while fast-resume data and cached metadata are shared. 0 is the bot itself.
+WORKER_INDEX = env_int("WORKER_INDEX", 0)
+
+# Shared libtorrent session used by every magnet job.
+TORRENT_LISTEN_INTERFACES = os.getenv("TORRENT_LISTEN_INTERFACES", "0.0.0.0:6881")
+TORRENT_CONNECTIONS_LIMIT = env_int("TORRENT_CONNECTIONS_LIMIT", 200)
+TORRENT_DOWNLOAD_LIMIT = env_int("TORRENT_DOWNLOAD_LIMIT", 0)      # bytes/s for the whole session, 0 = unlimited
+TORRENT_UPLOAD_LIMIT = env_int("TORRENT_UPLOAD_LIMIT", 0)
+TORRENT_STATE_FILE = os.path.join(os.getcwd(), f"torrent_session.worker{WORKER_INDEX}.dat" if WORKER_INDEX else "torrent_session.dat")
+TORRENT_RESUME_PATH = os.path.join(os.getcwd(), "torrent_resume")    # fast-resume data per info-hash
+TORRENT_CACHE_PATH = os.path.join(os.getcwd(), "torrent_cache")      # .torrent metadata per info-hash
+TORRENT_RESUME_INTERVAL = env_int("TORRENT_RESUME_INTERVAL", 60)     # seconds between periodic resume saves
+TORRENT_METADATA_TIMEOUT = env_int("TORRENT_METADATA_TIMEOUT", 30)  # seconds /send waits for metadata to offer file selection
+TORRENT_JOB_METADATA_TIMEOUT = env_int("TORRENT_JOB_METADATA_TIMEOUT", 600)  # seconds a running job waits for metadata before failing
+
+# Job scheduler: queued jobs wait for a global slot, a per-user slot and a free download worker.
+DOWNLOAD_WORKERS = env_int("DOWNLOAD_WORKERS", 4)
+UPLOAD_WORKERS = env_int("UPLOAD_WORKERS", 2)
+GLOBAL_JOB_SLOTS = env_int("GLOBAL_JOB_SLOTS", DOWNLOAD_WORKERS + UPLOAD_WORKERS)
+PER_USER_JOB_SLOTS = env_int("PER_USER_JOB_SLOTS", 2)
+MAX_QUEUED_JOBS = env_int("MAX_QUEUED_JOBS", 200)
+MAX_JOBS_PER_USER = env_int("MAX_JOBS_PER_USER", 20)
+MAX_JOB_RESUMES = env_int("MAX_JOB_RESUMES", 3)   # restarts (or lost worker leases) after which a job is given up
+
+# BuzzHeavier root directory ID: cached on disk so a restart does not wait for the API; a stale entry is still used
+# while it is revalidated in the background. Without any cached ID, jobs are held until a fetch succeeds.
+ROOT_ID_CACHE_FILE = os.path.join(os.getcwd(), "root_dir_id.json")
+ROOT_ID_TTL = env_int("ROOT_ID_TTL", 24 * 3600)   # seconds before the cached ID is fetched again
+ROOT_ID_RETRY = env_int("ROOT_ID_RETRY", 30)      # seconds between attempts while the API is unreachable
+
+# Worker-process mode: the bot only queues jobs in the database and worker.py processes (here or on hosts that
+# share DB_FILE and the download directory's filesystem) claim and run them, each with the scheduler limits above.
+DB_FILE = os.getenv("DB_FILE", os.path.join(os.getcwd(), "bot.db"))
+JOB_QUEUE = env_bool("JOB_QUEUE", False)
+LOCAL_WORKERS = env_int("LOCAL_WORKERS", 2)            # worker processes the bot starts and restarts itself (0 = external only)
+QUEUE_LEASE = env_int("QUEUE_LEASE", 60)               # seconds before a job of a silent worker is handed to another one
+QUEUE_POLL_INTERVAL = env_int("QUEUE_POLL_INTERVAL", 1)  # seconds between heartbeats, claims and front-end polls
+
+# Status broadcaster: Telegram allows roughly 30 messages/s overall and about one per second per chat.
+BROADCAST_GLOBAL_RATE = env_int("BROADCAST_GLOBAL_RATE", 20)     # edits per second across all chats
+BROADCAST_CHAT_INTERVAL = env_int("BROADCAST_CHAT_INTERVAL", 3)  # minimum seconds between edits of one chat
+
+# Dedup cache: a link or magnet that was already uploaded is answered with the existing BuzzHeavier link.
+DEDUP_CACHE = env_bool("DEDUP_CACHE", True)
+DEDUP_TTL = env_int("DEDUP_TTL", 30 * 24 * 3600)          # seconds before a cached link is considered stale
+DEDUP_MAX_ENTRIES = env_int("DEDUP_MAX_ENTRIES", 10000)   # least recently used entries beyond this are evicted
+
+# Bandwidth shaper (bytes/s, 0 = unlimited). Global caps cover every job; the control reserve is subtracted
+# from them so Telegram polling stays responsive. All of these can be changed at runtime with /limit.
+SHAPER_DOWNLOAD_LIMIT = env_int("SHAPER_DOWNLOAD_LIMIT", 0)
+SHAPER_UPLOAD_LIMIT = env_int("SHAPER_UPLOAD_LIMIT", 0)
+SHAPER_USER_DOWNLOAD_LIMIT = env_int("SHAPER_USER_DOWNLOAD_LIMIT", 0)
+SHAPER_USER_UPLOAD_LIMIT = env_int("SHAPER_USER_UPLOAD_LIMIT", 0)
+SHAPER_CONTROL_RESERVE = env_int("SHAPER_CONTROL_RESERVE", 256 * 1024)
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").replace(" ", "").split(",") if user_id.isdigit()}
+
+# Disk admission: a job only starts when its expected size fits the free space of the download directory.
+DISK_FREE_FLOOR = env_int("DISK_FREE_FLOOR", 1024 * 1024 * 1024)   # bytes always kept free for the OS and the database
+DISK_RECHECK_INTERVAL = env_int("DISK_RECHECK_INTERVAL", 10)        # seconds between re-checks for jobs waiting on space
+PREALLOCATE_FILES = env_bool("PREALLOCATE_FILES", True)             # fallocate downloads up front
+
+# Metrics: Prometheus text exposition on a local port (0 = disabled).
+METRICS_PORT = env_int("METRICS_PORT", 0)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_MAX_HOSTS = env_int("METRICS_MAX_HOSTS", 50)   # source hosts with their own series; the rest share 'other'
+
+# Batch submission (/batch): many links at once, resolved in parallel and queued as one tracked batch.
+BATCH_MAX_LINKS = env_int("BATCH_MAX_LINKS", 50)
+BATCH_RESOLVE_WORKERS = env_int("BATCH_RESOLVE_WORKERS", 8)   # concurrent HEADs / metadata fetches across all batches
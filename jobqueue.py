@@ -0,0 +1,202 @@
+# jobqueue.py
+
+import os
+import socket
+import threading
+import time
+
+from scheduler import Job, QueueFull
+from store import ACTIVE_JOB_STATES
+from tasks import worker_task
+from shaper import get_shaper
+from utils import escape_markdown, LOGGER
+from config import MAX_JOB_RESUMES
+
+# Store setting that carries /limit's caps to the worker processes.
+LIMITS_SETTING = 'bandwidth_limits'
+# How the front-end shows the states a job goes through in the queue.
+QUEUE_STATES = {'pending': 'queued', 'claimed': 'queued', 'downloading': 'downloading', 'uploading': 'uploading'}
+
+class QueueScheduler:
+    """Front-end half of worker-process mode, with the JobScheduler interface the handlers use. The store's jobs
+    table is the durable queue: worker processes (worker.py) claim rows from it and write back their phase and
+    latest status text, and their messages and final statuses arrive as job_events. A poller thread applies all
+    of that to the local Job objects and calls their on_status/on_complete hooks, so the broadcaster, /info,
+    /jobs and batches work exactly as with the in-process scheduler."""
+    def __init__(self, store, send_message, max_queued, poll_interval):
+        self.store = store
+        self.send_message = send_message
+        self.max_queued = max_queued
+        self.poll_interval = poll_interval
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._last_event = 0
+        threading.Thread(target=self._poll_loop, name="queue-poller", daemon=True).start()
+
+    def submit(self, job, task_factory=None, on_cancelled=None):
+        """Makes `job` (already journaled with store.save_job) claimable and tracks it. Re-submitting a job that a
+        worker already holds, e.g. after a restart of the bot, only attaches to it. `task_factory` is not used:
+        workers build their own task. Returns the queue position."""
+        row = self.store.get_job(job.job_id)
+        if row is None or row['state'] not in ACTIVE_JOB_STATES: raise ValueError(f"Job {job.job_id} is not in the queue")
+        if row['state'] == 'pending' and self.queue_depth() > self.max_queued: raise QueueFull(f"The queue is full ({self.max_queued} jobs)")
+        if row['state'] == 'pending': self.store.set_job_priority(job.job_id, job.priority)
+        job._on_cancelled = on_cancelled
+        with self._lock: self._jobs[job.job_id] = job
+        self._apply(job, row)
+        LOGGER.info(f"[USER:{job.user_id}] Queued job {job.job_id} for {job.filename} in the worker queue ({row['state']})")
+        return self.position(job.job_id)
+
+    def position(self, job_id):
+        return self.store.job_position(job_id)
+
+    def get(self, job_id):
+        with self._lock: return self._jobs.get(job_id)
+
+    def jobs_for_user(self, user_id):
+        with self._lock: return sorted((job for job in self._jobs.values() if job.user_id == user_id), key=lambda j: j.created)
+
+    def queue_depth(self):
+        return self.store.job_counts()['pending']
+
+    def running_count(self):
+        counts = self.store.job_counts()
+        return counts['downloading'] + counts['uploading']
+
+    def state_counts(self):
+        """Same keys as JobScheduler.state_counts; 'held' counts jobs a worker claimed but has not started yet."""
+        counts = self.store.job_counts()
+        return {'queued': counts['pending'] + counts['claimed'], 'held': counts['claimed'],
+                'downloading': counts['downloading'], 'uploading': counts['uploading']}
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        result = self.store.cancel_queued_job(job_id)
+        if result is None: return False
+        if job: job.cancel_event.set()
+        if result == 'requested':
+            LOGGER.info(f"Asked the worker running job {job_id} to cancel it"); return True
+        with self._lock: self._jobs.pop(job_id, None)
+        LOGGER.info(f"Removed queued job {job_id} from the worker queue")
+        if job:
+            job.state = 'cancelled'
+            if job._on_cancelled: job._on_cancelled(job)
+        return True
+
+    def _apply(self, job, row):
+        state = QUEUE_STATES.get(row['state'], job.state); status = row['status'] or job.status_text
+        if state == job.state and status == job.status_text: return
+        job.state = state; job.status_text = status
+        if job.on_status: job.on_status(job)
+
+    def _poll_loop(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try: self._poll()
+            except Exception as e: LOGGER.error(f"Polling the job queue failed: {e}", exc_info=True)
+
+    def _poll(self):
+        with self._lock: jobs = list(self._jobs.values())
+        if jobs:
+            rows = {row['job_id']: row for row in self.store.pending_jobs()}
+            for job in jobs:
+                if job.job_id in rows: self._apply(job, rows[job.job_id])
+        events = self.store.job_events(self._last_event)
+        for event in events:
+            # Events are acknowledged only after they were handled, so a restart delivers them again rather than losing them.
+            self._last_event = event['id']
+            if event['kind'] == 'final': self._finish(event)
+            else: self._send(event['chat_id'], event['text'])
+        if events: self.store.ack_job_events(self._last_event)
+
+    def _finish(self, event):
+        with self._lock: job = self._jobs.pop(event['job_id'], None)
+        if job is None or job.on_complete is None: self._send(event['chat_id'], event['text']); return
+        job.state = 'finished'
+        job.on_complete(event['text'])
+
+    def _send(self, chat_id, text):
+        try: self.send_message(chat_id, text)
+        except Exception as e: LOGGER.warning(f"Could not deliver a queued message to chat {chat_id}: {e}")
+
+class QueueWorker:
+    """Worker-process half: claims jobs while the local JobScheduler has room for them and runs worker_task with
+    callbacks that turn into rows. Status texts stay in memory and are written, coalesced, by the heartbeat that
+    also renews the job leases and picks up cancellations; messages and the final status become job_events.
+    The heartbeat also reports this process's transfer rates for /h and applies the bandwidth caps set with /limit,
+    with the global caps split between the workers alive. A worker that dies simply stops renewing, and its jobs
+    are claimed again by another one after QUEUE_LEASE."""
+    def __init__(self, store, scheduler, capacity, account_id, root_dir_id, lease, poll_interval, worker_id=None):
+        self.store = store
+        self.scheduler = scheduler
+        self.capacity = capacity
+        self.account_id = account_id
+        self.root_dir_id = root_dir_id
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self._jobs = {}
+        self._stopping = set()
+        self._lock = threading.Lock()
+        self._limits = None
+
+    def set_root_dir_id(self, root_dir_id):
+        self.root_dir_id = root_dir_id
+
+    def run(self):
+        LOGGER.info(f"Worker {self.worker_id} is taking jobs (up to {self.capacity} at a time).")
+        while True:
+            try:
+                self._heartbeat()
+                while self.root_dir_id and len(self._jobs) < self.capacity and self._claim(): pass
+            except Exception as e:
+                LOGGER.error(f"Worker {self.worker_id} could not reach the job queue: {e}")
+            time.sleep(self.poll_interval)
+
+    def _claim(self):
+        row = self.store.claim_job(self.worker_id, time.time() + self.lease)
+        if row is None: return False
+        if row['resumes'] > MAX_JOB_RESUMES:
+            LOGGER.warning(f"Dropping job {row['job_id']} for {row['filename']}: resumed too many times.")
+            self.store.complete_claimed_job(row['job_id'], self.worker_id, row['chat_id'], 'abandoned',
+                                            f"❌ *Giving up on* `{escape_markdown(row['filename'])}` after {MAX_JOB_RESUMES} restarts\\.")
+            return True
+        job = Job(row['job_id'], row['user_id'], row['chat_id'], row['url'], row['filename'], row['options'], row['priority'])
+        with self._lock: self._jobs[job.job_id] = job
+        LOGGER.info(f"[USER:{job.user_id}] Worker {self.worker_id} claimed job {job.job_id} for {job.filename}"
+                    + (f" (resume {row['resumes']})" if row['resumes'] else ""))
+        self.scheduler.submit(job, self._task, self._cancelled_in_queue)
+        return True
+
+    def _heartbeat(self):
+        shaper = get_shaper(); workers = self.store.report_worker(self.worker_id, shaper.rates(), self.lease)
+        settings = self.store.get_setting(LIMITS_SETTING)
+        if settings is not None and (settings, len(workers)) != self._limits:
+            shaper.restore(settings, len(workers)); self._limits = (settings, len(workers))
+        with self._lock: jobs = list(self._jobs.values())
+        updates = [(job.job_id, 'claimed' if job.state == 'queued' else job.state, job.status_text)
+                   for job in jobs if job.state in ('queued', 'downloading', 'uploading')]
+        stops = self.store.renew_claims(self.worker_id, updates, time.time() + self.lease)
+        with self._lock:
+            stops = {job_id: reason for job_id, reason in stops.items() if job_id not in self._stopping}
+            self._stopping.update(stops)
+        for job_id, reason in stops.items():
+            LOGGER.info(f"Worker {self.worker_id} is stopping job {job_id}: {'taken over by another worker' if reason == 'reclaimed' else 'cancelled'}")
+            # A reclaimed job's partial files now belong to the new owner, so it stops without discarding them.
+            job = self.scheduler.get(job_id)
+            if job and reason == 'reclaimed': job.lease_lost = True
+            self.scheduler.cancel(job_id)
+
+    def _task(self, job):
+        def send_message(chat_id, text): self.store.post_job_event(job.job_id, chat_id, text)
+        def on_complete(final_status): self._complete(job, 'cancelled' if job.cancelled else 'done', final_status)
+        return worker_task(job.url, job.filename, job.user_id, job.chat_id, self.store, send_message,
+                           self.account_id, self.root_dir_id, job.set_status, on_complete, job.options, self.scheduler.submit_upload)
+
+    def _cancelled_in_queue(self, job):
+        self._complete(job, 'cancelled', f"🚫 *Removed from queue:* `{escape_markdown(job.filename)}`")
+
+    def _complete(self, job, state, final_status):
+        with self._lock: self._jobs.pop(job.job_id, None); self._stopping.discard(job.job_id)
+        if not self.store.complete_claimed_job(job.job_id, self.worker_id, job.chat_id, state, final_status):
+            LOGGER.warning(f"Job {job.job_id} finished here but is no longer held by {self.worker_id}; its result is dropped.")
@@ -0,0 +1,176 @@
+# metrics.py
+
+import bisect
+import threading
+import time
+from urllib.parse import urlsplit
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from utils import LOGGER
+from config import METRICS_MAX_HOSTS
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30)
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+RATE_BUCKETS = tuple(2 ** n for n in range(16, 31, 2))  # 64 KiB/s .. 1 GiB/s
+
+_registry = []
+_hosts = set()
+_hosts_lock = threading.Lock()
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _series(name, names, values, extra=''):
+    pairs = [f'{label}="{_escape(value)}"' for label, value in zip(names, values)]
+    if extra: pairs.append(extra)
+    return f"{name}{{{','.join(pairs)}}}" if pairs else name
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Family:
+    """A metric with a fixed set of label names; labels(*values) returns the child for one series, created once."""
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name; self.help = help; self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock: child = self._children.setdefault(values, self._new())
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()): lines.extend(self._lines(values, child))
+        return lines
+
+class _CounterChild:
+    __slots__ = ('value', 'lock')
+    def __init__(self): self.value = 0; self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock: self.value += amount
+
+class Counter(_Family):
+    kind = 'counter'
+    def _new(self): return _CounterChild()
+    def inc(self, amount=1): self.labels().inc(amount)
+    def _lines(self, values, child): return [f"{_series(self.name, self.label_names, values)} {_number(child.value)}"]
+
+class _HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum', 'lock')
+    def __init__(self, bounds):
+        self.bounds = bounds; self.counts = [0] * (len(bounds) + 1); self.sum = 0.0; self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock: self.counts[index] += 1; self.sum += value
+
+class Histogram(_Family):
+    kind = 'histogram'
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels)
+
+    def _new(self): return _HistogramChild(self.buckets)
+    def observe(self, value): self.labels().observe(value)
+
+    def _lines(self, values, child):
+        with child.lock: counts = list(child.counts); total = child.sum
+        lines = []; cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else _number(bound); extra = f'le="{le}"'
+            lines.append(f"{_series(self.name + '_bucket', self.label_names, values, extra)} {cumulative}")
+        lines.append(f"{_series(self.name + '_sum', self.label_names, values)} {_number(total)}")
+        lines.append(f"{_series(self.name + '_count', self.label_names, values)} {cumulative}")
+        return lines
+
+class Gauge:
+    """A value read from `func` at scrape time, so nothing is paid while nobody is scraping. `func` returns a
+    number, or a dict mapping label values (a tuple, or a plain value for one label) to numbers."""
+    def __init__(self, name, help, func, labels=(), kind='gauge'):
+        self.name = name; self.help = help; self.func = func; self.label_names = tuple(labels); self.kind = kind
+        _registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try: value = self.func()
+        except Exception as e:
+            LOGGER.warning(f"Metric {self.name} could not be collected: {e}"); return lines
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for values, number in items:
+            lines.append(f"{_series(self.name, self.label_names, values if isinstance(values, tuple) else (values,))} {_number(number)}")
+        return lines
+
+def render():
+    lines = []
+    for metric in list(_registry): lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def host_label(url):
+    """The URL's host as a label value. Only the first METRICS_MAX_HOSTS hosts get their own series; later ones
+    share 'other', so a stream of one-off download hosts cannot grow the exposition without bound."""
+    host = (urlsplit(url).hostname or '') if url else ''
+    if host in _hosts: return host
+    with _hosts_lock:
+        if len(_hosts) < METRICS_MAX_HOSTS: _hosts.add(host); return host
+    return 'other'
+
+HEAD_SECONDS = Histogram('securefetch_head_seconds', 'Latency of the HEAD probe sent before a download.', ('host',))
+HEAD_FAILURES = Counter('securefetch_head_failures_total', 'HEAD probes that failed.', ('host',))
+PHASE_SECONDS = Histogram('securefetch_phase_seconds', 'Duration of successful job phases.', ('phase', 'host'), DURATION_BUCKETS)
+PHASE_BYTES = Counter('securefetch_phase_bytes_total', 'Bytes moved by successful job phases.', ('phase', 'host'))
+PHASE_RATE = Histogram('securefetch_phase_throughput_bytes_per_second', 'Average throughput of successful job phases.', ('phase', 'host'), RATE_BUCKETS)
+PHASE_FAILURES = Counter('securefetch_phase_failures_total', 'Job phases that failed or were cancelled.', ('phase', 'host'))
+JOBS = Counter('securefetch_jobs_total', 'Finished jobs by outcome.', ('outcome',))
+JOB_SECONDS = Histogram('securefetch_job_seconds', 'Wall time of a job from worker start to its final status.', ('outcome',), DURATION_BUCKETS)
+TELEGRAM_EDIT_SECONDS = Histogram('securefetch_telegram_edit_seconds', 'Latency of status message edits.')
+TELEGRAM_EDITS = Counter('securefetch_telegram_edits_total', 'Status message edits by result.', ('result',))
+TELEGRAM_RETRY_AFTER = Counter('securefetch_telegram_retry_after_total', 'RetryAfter (flood control) responses from Telegram.')
+TELEGRAM_RETRY_AFTER_SECONDS = Counter('securefetch_telegram_retry_after_seconds_total', 'Seconds of flood-control pauses requested by Telegram.')
+
+class phase:
+    """Times one job phase: `with phase('download', url) as p: ...; p.done(nbytes)`. A phase that
+    leaves the block without done() (failure or exception) is counted as a failure."""
+    __slots__ = ('name', 'host', 'started', 'nbytes')
+    def __init__(self, name, url=None):
+        self.name = name; self.host = host_label(url); self.nbytes = None
+
+    def __enter__(self):
+        self.started = time.monotonic(); return self
+
+    def done(self, nbytes):
+        self.nbytes = nbytes or 0
+
+    def __exit__(self, *exc):
+        if self.nbytes is None:
+            PHASE_FAILURES.labels(self.name, self.host).inc(); return False
+        seconds = time.monotonic() - self.started
+        PHASE_SECONDS.labels(self.name, self.host).observe(seconds)
+        PHASE_BYTES.labels(self.name, self.host).inc(self.nbytes)
+        if seconds > 0 and self.nbytes: PHASE_RATE.labels(self.name, self.host).observe(self.nbytes / seconds)
+        return False
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args): pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'): self.send_error(404); return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE); self.send_header('Content-Length', str(len(body)))
+        self.end_headers(); self.wfile.write(body)
+
+def start_metrics_server(host, port):
+    """Serves the Prometheus text exposition on http://{host}:{port}/metrics from a background thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler); server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    LOGGER.info(f"Metrics endpoint listening on http://{host}:{server.server_port}/metrics")
+    return server
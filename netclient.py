@@ -0,0 +1,116 @@
+# netclient.py
+
+import threading
+import http.cookiejar
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.poolmanager import PoolKey
+from urllib3.util.retry import Retry
+
+from utils import LOGGER
+from config import (
+    HTTP_POOL_HOSTS, HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT,
+    HTTP_ADAPTER_RETRIES, HTTP_ADAPTER_BACKOFF, UPLOAD_BLOCK_SIZE
+)
+
+_client = None
+_client_lock = threading.Lock()
+
+class _PoolAdapter(HTTPAdapter):
+    """HTTPAdapter that remembers the request/connection counts of pools it evicts, so the reuse
+    counters stay accurate when more hosts are contacted than there are pool slots."""
+    def __init__(self, *args, **kwargs):
+        self._retired = {'requests': 0, 'connections': 0}
+        self._retired_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        # urllib3 2.x reads request bodies in `blocksize` pieces (16 KiB by default); large uploads want far fewer, larger writes.
+        if 'key_blocksize' in PoolKey._fields: kwargs.setdefault('blocksize', UPLOAD_BLOCK_SIZE)
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pools.dispose_func = self._retire
+
+    def _retire(self, pool):
+        with self._retired_lock:
+            self._retired['requests'] += pool.num_requests; self._retired['connections'] += pool.num_connections
+        pool.close()
+
+    def counters(self):
+        with self._retired_lock: totals = dict(self._retired)
+        pools = self.poolmanager.pools
+        with pools.lock: live = [pools._container[key] for key in pools.keys()]
+        for pool in live:
+            totals['requests'] += pool.num_requests; totals['connections'] += pool.num_connections
+        totals['pools'] = len(live)
+        return totals
+
+class HttpClient:
+    """One requests.Session shared by every network call. urllib3 keeps a keep-alive pool per
+    (scheme, host, port), so repeated requests to buzzheavier.com or a source host skip the TCP/TLS handshake.
+    The adapter only retries connection failures and 502/503/504 on HEAD/GET; downloads and uploads
+    keep their own resume logic on top of it."""
+    def __init__(self, pool_hosts, pool_size, connect_timeout, read_timeout, retries, backoff):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'Mozilla/5.0'
+        # The session is shared between users, so cookies set by one source must never leak into another job.
+        self.session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        retry = Retry(total=retries, connect=retries, read=0, status=retries, backoff_factor=backoff,
+                      status_forcelist=(502, 503, 504), allowed_methods=frozenset({'HEAD', 'GET'}), raise_on_status=False)
+        self._adapter = _PoolAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('https://', self._adapter); self.session.mount('http://', self._adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def head(self, url, **kwargs): return self.request('HEAD', url, **kwargs)
+    def get(self, url, **kwargs): return self.request('GET', url, **kwargs)
+    def put(self, url, **kwargs): return self.request('PUT', url, **kwargs)
+
+    def stats(self):
+        """Connection reuse counters: `reused` is how many requests went over an already open connection."""
+        totals = self._adapter.counters()
+        totals['reused'] = max(totals['requests'] - totals['connections'], 0)
+        return totals
+
+    def close(self):
+        self.session.close()
+
+def body_reader(response, chunk_size=1024 * 1024):
+    """readinto(buffer) -> bytes read (0 at the end) for the body of a streamed response. Plain bodies are read by
+    http.client straight into the caller's buffer, beneath urllib3's read(), which allocates a new bytes object per
+    call; once such a body has been read to its end the response is marked consumed, so closing it still returns
+    the keep-alive connection to the pool. Content-encoded bodies go through iter_content, which decodes them."""
+    fp = getattr(response.raw, '_fp', None)
+    if response.headers.get('content-encoding', 'identity') == 'identity' and hasattr(fp, 'readinto'):
+        def readinto(buffer):
+            n = fp.readinto(buffer)
+            if not n: response._content_consumed = True
+            return n
+        return readinto
+    chunks = response.iter_content(chunk_size=chunk_size); pending = memoryview(b'')
+
+    def readinto(buffer):
+        nonlocal pending
+        while not pending:
+            chunk = next(chunks, None)
+            if chunk is None: return 0
+            pending = memoryview(chunk)
+        n = min(len(buffer), len(pending))
+        buffer[:n] = pending[:n]; pending = pending[n:]
+        return n
+    return readinto
+
+def init_client():
+    """Creates the shared client from config; main() calls this once at startup."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient(HTTP_POOL_HOSTS, HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT,
+                                 HTTP_ADAPTER_RETRIES, HTTP_ADAPTER_BACKOFF)
+            LOGGER.info(f"HTTP client ready: {HTTP_POOL_HOSTS} host pools of up to {HTTP_POOL_SIZE} keep-alive connections")
+        return _client
+
+def get_client():
+    return _client or init_client()
@@ -0,0 +1,232 @@
+# scheduler.py
+
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import LOGGER
+
+# Values a worker_task generator yields to ask the scheduler to continue it in another pool.
+PHASE_UPLOAD = 'upload'
+
+PRIORITY_RESUMED = 0
+PRIORITY_NORMAL = 10
+
+class JobCancelled(Exception):
+    pass
+
+class LeaseLost(JobCancelled):
+    # Another worker process took the job over: stop, but leave its files to the new owner.
+    pass
+
+class QueueFull(Exception):
+    pass
+
+class Job:
+    def __init__(self, job_id, user_id, chat_id, url, filename, options=None, priority=PRIORITY_NORMAL):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.url = url
+        self.filename = filename
+        self.options = options or {}
+        self.priority = priority
+        self.state = 'queued'
+        self._status = "*Status:* Queued\\."
+        self.created = time.time()
+        self.cancel_event = threading.Event()
+        self.lease_lost = False
+        self.on_status = None
+        self.on_complete = None
+        self.waiting_for = None
+        self._task = None
+        self._factory = None
+        self._on_cancelled = None
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    @property
+    def status_text(self):
+        # Progress loops may report a zero-argument callable, so the text is only rendered when somebody reads it.
+        status = self._status
+        return status() if callable(status) else status
+
+    @status_text.setter
+    def status_text(self, text):
+        self._status = text
+
+    def set_status(self, text):
+        # Every download/upload loop reports progress through here, so raising makes cancellation reach all of them.
+        if self.cancel_event.is_set():
+            if self.lease_lost: raise LeaseLost(f"Job {self.job_id} is now run by another worker")
+            raise JobCancelled(f"Job {self.job_id} was cancelled")
+        self.status_text = text
+        if self.on_status: self.on_status(self)
+
+class JobScheduler:
+    """Bounded priority queue in front of separately sized download and upload pools. A job holds one global
+    and one per-user slot from the moment it leaves the queue until its task finishes. Tasks are generators:
+    everything up to `yield PHASE_UPLOAD` runs in the download pool, the rest in the upload pool.
+    An optional `admission` object (refresh()/try_admit(job)/release(job)) can hold jobs back, e.g. until disk space
+    frees up; those are re-checked every `recheck_interval` seconds. refresh() is called before every dispatch pass,
+    outside the lock, so try_admit() never does I/O while submit, cancel and /jobs wait for it. hold(reason) keeps every job queued until release(reason),
+    e.g. while a dependency of all jobs is still starting up."""
+    def __init__(self, download_workers, upload_workers, global_slots, per_user_slots, max_queued, admission=None, recheck_interval=10):
+        self.download_workers = download_workers
+        self.global_slots = global_slots
+        self.per_user_slots = per_user_slots
+        self.max_queued = max_queued
+        self.admission = admission
+        self.recheck_interval = recheck_interval
+        self._held = False
+        self._holds = set()
+        self._download_pool = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="download")
+        self._upload_pool = ThreadPoolExecutor(max_workers=upload_workers, thread_name_prefix="upload")
+        self._cond = threading.Condition()
+        self._queue = []
+        self._seq = itertools.count()
+        self._jobs = {}
+        self._running_per_user = {}
+        self._running = 0
+        self._downloading = 0
+        threading.Thread(target=self._dispatch_loop, name="scheduler", daemon=True).start()
+
+    def submit(self, job, task_factory, on_cancelled=None):
+        """Queues `job`; `task_factory(job)` must return the worker generator. Returns the queue position."""
+        with self._cond:
+            if len(self._queue) >= self.max_queued: raise QueueFull(f"The queue is full ({self.max_queued} jobs)")
+            job._factory = task_factory; job._on_cancelled = on_cancelled
+            self._jobs[job.job_id] = job
+            heapq.heappush(self._queue, (job.priority, next(self._seq), job))
+            self._cond.notify_all()
+            LOGGER.info(f"[USER:{job.user_id}] Queued job {job.job_id} for {job.filename} (queue depth {len(self._queue)})")
+            return self._position_locked(job)
+
+    def _position_locked(self, job):
+        if job.state != 'queued': return 0
+        return 1 + sum(1 for _, _, other in self._queue if (other.priority, other.created) < (job.priority, job.created))
+
+    def position(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            return self._position_locked(job) if job else None
+
+    def get(self, job_id):
+        with self._cond: return self._jobs.get(job_id)
+
+    def jobs_for_user(self, user_id):
+        with self._cond: return sorted((job for job in self._jobs.values() if job.user_id == user_id), key=lambda j: j.created)
+
+    def queue_depth(self):
+        with self._cond: return len(self._queue)
+
+    def running_count(self):
+        with self._cond: return self._running
+
+    def state_counts(self):
+        """Jobs per state; 'held' counts queued jobs that admission control is keeping back."""
+        with self._cond:
+            return {'queued': len(self._queue), 'held': sum(1 for entry in self._queue if entry[2].waiting_for),
+                    'downloading': self._downloading, 'uploading': self._running - self._downloading}
+
+    def hold(self, reason):
+        with self._cond: self._holds.add(reason)
+        LOGGER.info(f"Holding queued jobs until {reason} is ready")
+
+    def release(self, reason):
+        with self._cond:
+            if reason not in self._holds: return
+            self._holds.discard(reason); self._cond.notify_all()
+            for _, _, job in self._queue:
+                if job.waiting_for == reason: job.waiting_for = None
+        LOGGER.info(f"{reason} is ready; releasing held jobs")
+
+    def cancel(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None: return False
+            job.cancel_event.set()
+            if job.state != 'queued':
+                LOGGER.info(f"[USER:{job.user_id}] Cancelling running job {job.job_id}")
+                return True
+            self._queue = [entry for entry in self._queue if entry[2] is not job]; heapq.heapify(self._queue)
+            job.state = 'cancelled'; self._jobs.pop(job_id, None)
+        LOGGER.info(f"[USER:{job.user_id}] Removed queued job {job.job_id} from the queue")
+        if job._on_cancelled: job._on_cancelled(job)
+        return True
+
+    def submit_upload(self, fn, *args):
+        """Runs fn(*args) in the upload pool and returns its Future. For uploads a job starts while it is still
+        downloading (a torrent's files in 'each' mode), so they share the upload_workers bound with upload phases."""
+        return self._upload_pool.submit(fn, *args)
+
+    def _next_runnable_locked(self):
+        self._held = False
+        if self._holds:
+            reason = next(iter(self._holds))
+            for _, _, job in self._queue: job.waiting_for = reason
+            return None
+        if self._running >= self.global_slots or self._downloading >= self.download_workers: return None
+        for entry in sorted(self._queue):
+            job = entry[2]
+            if self._running_per_user.get(job.user_id, 0) >= self.per_user_slots: continue
+            if self.admission and not self.admission.try_admit(job):
+                # Smaller jobs behind it may still fit, so keep looking instead of blocking the whole queue.
+                if job.waiting_for is None: LOGGER.info(f"[USER:{job.user_id}] Job {job.job_id} is waiting for disk space")
+                job.waiting_for = 'disk space'; self._held = True
+                continue
+            job.waiting_for = None
+            self._queue.remove(entry); heapq.heapify(self._queue)
+            return job
+        return None
+
+    def _dispatch_loop(self):
+        while True:
+            if self.admission: self.admission.refresh()
+            with self._cond:
+                job = self._next_runnable_locked()
+                if job is None:
+                    self._cond.wait(self.recheck_interval if self._held else None); continue
+                job.state = 'downloading'
+                self._running += 1; self._downloading += 1
+                self._running_per_user[job.user_id] = self._running_per_user.get(job.user_id, 0) + 1
+            LOGGER.info(f"[USER:{job.user_id}] Starting job {job.job_id} after {time.time() - job.created:.1f}s in queue")
+            self._download_pool.submit(self._step, job)
+
+    def _step(self, job):
+        try:
+            if job._task is None: job._task = job._factory(job)
+            phase = next(job._task)
+        except StopIteration:
+            self._finish(job); return
+        except JobCancelled:
+            LOGGER.info(f"[USER:{job.user_id}] Job {job.job_id} stopped after cancellation")
+            self._finish(job); return
+        except Exception as e:
+            LOGGER.error(f"[USER:{job.user_id}] Job {job.job_id} crashed: {e}", exc_info=True)
+            self._finish(job); return
+        if phase == PHASE_UPLOAD and job.state == 'downloading':
+            with self._cond:
+                job.state = 'uploading'; self._downloading -= 1; self._cond.notify_all()
+            self._upload_pool.submit(self._step, job)
+        else:
+            self._step(job)
+
+    def _finish(self, job):
+        with self._cond:
+            if job.state == 'downloading': self._downloading -= 1
+            job.state = 'cancelled' if job.cancelled else 'finished'
+            self._running -= 1
+            self._running_per_user[job.user_id] -= 1
+            if not self._running_per_user[job.user_id]: del self._running_per_user[job.user_id]
+            self._jobs.pop(job.job_id, None)
+            if self.admission: self.admission.release(job)
+            self._cond.notify_all()
+
+def run_inline(task):
+    """Drives a worker_task generator to completion on the calling thread."""
+    for _ in task: pass
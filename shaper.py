@@ -0,0 +1,131 @@
+# shaper.py
+
+import time
+import threading
+
+from utils import TokenBucket, LOGGER
+from config import (
+    SHAPER_DOWNLOAD_LIMIT, SHAPER_UPLOAD_LIMIT, SHAPER_USER_DOWNLOAD_LIMIT,
+    SHAPER_USER_UPLOAD_LIMIT, SHAPER_CONTROL_RESERVE
+)
+
+DIRECTIONS = ('down', 'up')
+RATE_WINDOW = 5  # seconds of history behind the measured rates shown in /h
+
+_shaper = None
+_shaper_lock = threading.Lock()
+
+class Shaper:
+    """Token-bucket bandwidth shaper shared by every job. Each byte a job moves is charged to the global
+    bucket for its direction and to its user's bucket, and throttle() blocks while either is in debt.
+    `control_reserve` is carved out of each global cap so Telegram polling and API calls keep headroom.
+    A limit of 0 means unlimited. Listeners (the torrent engine) are told the effective global caps."""
+    def __init__(self, limits, user_limits, control_reserve):
+        self._lock = threading.Lock()
+        self.limits = dict(limits); self.user_limits = dict(user_limits); self.control_reserve = control_reserve
+        self.version = 0
+        self._global = {direction: TokenBucket(0, 0) for direction in DIRECTIONS}
+        self._users = {}
+        self._bins = {direction: [] for direction in DIRECTIONS}
+        self._listeners = []
+        self._apply()
+
+    def effective_limit(self, direction):
+        limit = self.limits[direction]
+        # The reserve never takes more than 90% of a cap, so a small cap cannot starve every job.
+        return max(limit - self.control_reserve, limit // 10) if limit else 0
+
+    @staticmethod
+    def _burst(rate):
+        return max(rate // 4, 64 * 1024)
+
+    def _apply(self):
+        for direction in DIRECTIONS:
+            rate = self.effective_limit(direction); self._global[direction].set_rate(rate, self._burst(rate))
+        for (user_id, direction), bucket in self._users.items():
+            rate = self.user_limits[direction]; bucket.set_rate(rate, self._burst(rate))
+        self.version += 1
+        limits = (self.effective_limit('down'), self.effective_limit('up'))
+        for listener in self._listeners:
+            try: listener(*limits)
+            except Exception as e: LOGGER.error(f"Could not apply bandwidth limits: {e}")
+
+    def add_listener(self, listener):
+        """`listener(download_limit, upload_limit)` is called now and whenever the global caps change."""
+        with self._lock:
+            self._listeners.append(listener)
+            listener(self.effective_limit('down'), self.effective_limit('up'))
+
+    def set_limit(self, scope, direction, rate):
+        with self._lock:
+            (self.limits if scope == 'global' else self.user_limits)[direction] = rate
+            self._apply()
+        LOGGER.info(f"Bandwidth limit changed: {scope} {direction} = {rate} B/s")
+
+    def set_reserve(self, rate):
+        with self._lock:
+            self.control_reserve = rate; self._apply()
+        LOGGER.info(f"Control traffic reserve changed to {rate} B/s")
+
+    def snapshot(self):
+        """The configured caps and reserve, as stored for worker processes."""
+        with self._lock: return {'limits': dict(self.limits), 'user_limits': dict(self.user_limits), 'reserve': self.control_reserve}
+
+    def restore(self, settings, share=1):
+        """Applies a snapshot() taken in another process. `share` splits the global caps and the reserve evenly
+        between that many worker processes, so together they stay within the configured totals."""
+        def part(rate): return max(rate // share, 1) if rate else 0
+        with self._lock:
+            self.limits = {direction: part(settings['limits'][direction]) for direction in DIRECTIONS}
+            self.user_limits = dict(settings['user_limits']); self.control_reserve = part(settings['reserve'])
+            self._apply()
+        LOGGER.info(f"Bandwidth limits applied from the store (shared by {share} worker(s)): {self.limits}, per user {self.user_limits}")
+
+    def _user_bucket(self, user_id, direction):
+        bucket = self._users.get((user_id, direction))
+        if bucket is None:
+            with self._lock:
+                rate = self.user_limits[direction]
+                bucket = self._users.setdefault((user_id, direction), TokenBucket(rate, self._burst(rate)))
+        return bucket
+
+    def _record(self, direction, nbytes):
+        second = int(time.monotonic())
+        with self._lock:
+            bins = self._bins[direction]
+            if bins and bins[-1][0] == second: bins[-1][1] += nbytes
+            else:
+                bins.append([second, nbytes])
+                if len(bins) > RATE_WINDOW + 1: del bins[0]
+
+    def throttle(self, direction, user_id, nbytes):
+        """Charges `nbytes` that were just moved and blocks until the user's and the global budget allow more."""
+        self._record(direction, nbytes)
+        if user_id is not None and self.user_limits[direction]: self._user_bucket(user_id, direction).consume(nbytes)
+        self._global[direction].consume(nbytes)
+
+    def charge(self, direction, user_id, nbytes):
+        """Accounts for traffic that is rate-limited elsewhere (libtorrent) without blocking."""
+        if nbytes <= 0: return
+        self._record(direction, nbytes)
+        if user_id is not None and self.user_limits[direction]: self._user_bucket(user_id, direction).charge(nbytes)
+        self._global[direction].charge(nbytes)
+
+    def throttler(self, direction, user_id):
+        """Returns a one-argument callable for upload bodies and chunk loops."""
+        return lambda nbytes: self.throttle(direction, user_id, nbytes)
+
+    def rates(self):
+        """Measured bytes per second over the last RATE_WINDOW full seconds, per direction."""
+        now = int(time.monotonic())
+        with self._lock:
+            return {direction: sum(n for second, n in self._bins[direction] if now - RATE_WINDOW <= second < now) / RATE_WINDOW
+                    for direction in DIRECTIONS}
+
+def get_shaper():
+    global _shaper
+    with _shaper_lock:
+        if _shaper is None:
+            _shaper = Shaper({'down': SHAPER_DOWNLOAD_LIMIT, 'up': SHAPER_UPLOAD_LIMIT},
+                             {'down': SHAPER_USER_DOWNLOAD_LIMIT, 'up': SHAPER_USER_UPLOAD_LIMIT}, SHAPER_CONTROL_RESERVE)
+        return _shaper
@@ -0,0 +1,96 @@
+# standin.py
+
+"""Local stand-in for the two BuzzHeavier endpoints the bot uses (GET /api/fs and PUT /{root_dir_id}/{name}),
+with injectable faults for exercising the upload retry path without touching the real service.
+
+    python standin.py --port 8080 --drop-after 1048576 --drops 2
+    BUZZHEAVIER_UPLOAD_URL=http://127.0.0.1:8080 BUZZHEAVIER_API_URL=http://127.0.0.1:8080 python bot.py
+"""
+
+import json
+import hashlib
+import argparse
+import threading
+from urllib.parse import unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ROOT_DIR_ID = "standin-root"
+
+class StandInServer(ThreadingHTTPServer):
+    """`drops` uploads are cut off after `drop_after` body bytes, then `failures` more get a 503; after that
+    uploads succeed. `uploads` records name -> {'size', 'sha256', 'attempts'} of every completed upload."""
+    daemon_threads = True
+
+    def __init__(self, address, drop_after=0, drops=0, failures=0, store_path=None):
+        super().__init__(address, StandInHandler)
+        self.drop_after = drop_after; self.drops = drops; self.failures = failures
+        self.store_path = store_path
+        self.uploads = {}; self.attempts = {}
+        self.lock = threading.Lock()
+
+    def next_fault(self, name):
+        with self.lock:
+            self.attempts[name] = self.attempts.get(name, 0) + 1
+            if self.drops > 0: self.drops -= 1; return 'drop'
+            if self.failures > 0: self.failures -= 1; return 'fail'
+        return None
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args): pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json'); self.send_header('Content-Length', str(len(body)))
+        self.end_headers(); self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/api/fs': return self._reply(404, {'code': 404, 'message': 'Not found'})
+        if not self.headers.get('Authorization', '').startswith('Bearer '): return self._reply(401, {'code': 401, 'message': 'Unauthorized'})
+        self._reply(200, {'code': 200, 'data': {'id': ROOT_DIR_ID}})
+
+    def do_PUT(self):
+        parts = self.path.lstrip('/').split('/', 1)
+        if len(parts) != 2 or parts[0] != ROOT_DIR_ID: return self._reply(404, {'code': 404, 'message': 'Unknown directory'})
+        if 'Content-Length' not in self.headers: return self._reply(411, {'code': 411, 'message': 'Length required'})
+        name = unquote(parts[1]); remaining = int(self.headers['Content-Length'])
+        fault = self.server.next_fault(name)
+        digest = hashlib.sha256(); received = 0
+        out = open(f"{self.server.store_path}/{name.replace('/', '_')}", 'wb') if self.server.store_path else None
+        try:
+            while remaining > 0:
+                chunk = self.rfile.read(min(65536, remaining))
+                if not chunk: return
+                digest.update(chunk); received += len(chunk); remaining -= len(chunk)
+                if out: out.write(chunk)
+                if fault == 'drop' and received >= self.server.drop_after:
+                    # Simulates the connection dying mid-upload: no response, socket closed.
+                    self.close_connection = True; self.connection.close(); return
+        finally:
+            if out: out.close()
+        if fault == 'fail': return self._reply(503, {'code': 503, 'message': 'Service unavailable'})
+        file_id = digest.hexdigest()[:12]
+        with self.server.lock:
+            self.server.uploads[name] = {'size': received, 'sha256': digest.hexdigest(), 'attempts': self.server.attempts[name]}
+        self._reply(200, {'code': 200, 'data': {'id': file_id}})
+
+def start_standin(port=0, **faults):
+    """Starts a stand-in on a background thread and returns it; its URL is http://127.0.0.1:{server.server_port}."""
+    server = StandInServer(('127.0.0.1', port), **faults)
+    threading.Thread(target=server.serve_forever, name="standin", daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local BuzzHeavier stand-in with fault injection.")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--drop-after', type=int, default=1024 * 1024, help="body bytes received before a connection is cut")
+    parser.add_argument('--drops', type=int, default=0, help="number of uploads to cut off")
+    parser.add_argument('--failures', type=int, default=0, help="number of uploads answered with 503 after the drops")
+    parser.add_argument('--store', default=None, help="directory to write received files to")
+    args = parser.parse_args()
+    server = StandInServer(('127.0.0.1', args.port), args.drop_after, args.drops, args.failures, args.store)
+    print(f"BuzzHeavier stand-in listening on http://127.0.0.1:{args.port} (root dir id '{ROOT_DIR_ID}')")
+    try: server.serve_forever()
+    except KeyboardInterrupt: pass
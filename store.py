@@ -0,0 +1,389 @@
+# store.py
+
+import os
+import json
+import time
+import sqlite3
+import itertools
+import threading
+
+from utils import LOGGER
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS links (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT NOT NULL,
+    link TEXT NOT NULL,
+    user_id INTEGER,
+    size INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    hashes TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_links_filename ON links(filename);
+CREATE INDEX IF NOT EXISTS idx_links_user ON links(user_id);
+CREATE INDEX IF NOT EXISTS idx_links_created ON links(created);
+
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    options TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    resumes INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 10,
+    worker TEXT,
+    lease_until REAL,
+    status TEXT,
+    cancel_requested INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs(state);
+CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs(user_id);
+CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs(created);
+CREATE INDEX IF NOT EXISTS idx_jobs_filename ON jobs(filename);
+
+CREATE TABLE IF NOT EXISTS dedup (
+    key TEXT PRIMARY KEY,
+    uploads TEXT NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    last_hit REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_dedup_last_hit ON dedup(last_hit);
+
+CREATE TABLE IF NOT EXISTS link_trigrams (
+    trigram TEXT NOT NULL,
+    link_id INTEGER NOT NULL,
+    PRIMARY KEY (trigram, link_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS job_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    text TEXT NOT NULL,
+    created REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS workers (
+    worker TEXT PRIMARY KEY,
+    down REAL NOT NULL DEFAULT 0,
+    up REAL NOT NULL DEFAULT 0,
+    updated REAL NOT NULL
+);
+"""
+
+# Columns added after the first release, created on older databases by Store.__init__.
+ADDED_COLUMNS = {'links': {'hashes': "TEXT"},
+                 'jobs': {'priority': "INTEGER NOT NULL DEFAULT 10", 'worker': "TEXT", 'lease_until': "REAL", 'status': "TEXT",
+                          'cancel_requested': "INTEGER NOT NULL DEFAULT 0"}}
+# Jobs that still have to run: queued ('pending'), held by a worker process ('claimed') or in one of its phases.
+ACTIVE_JOB_STATES = ('pending', 'claimed', 'downloading', 'uploading')
+_ACTIVE = f"state IN ({', '.join(repr(state) for state in ACTIVE_JOB_STATES)})"
+
+def trigrams(text):
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class Store:
+    """SQLite store (WAL mode) for saved links, bandwidth counters and the job journal.
+    Every write is a small incremental statement, so its cost does not grow with history."""
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+            for table, columns in ADDED_COLUMNS.items():
+                existing = {row['name'] for row in conn.execute(f"PRAGMA table_info({table})")}
+                for name, definition in columns.items():
+                    if name not in existing: conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+        self.index_links()
+
+    def _conn(self):
+        # One connection per thread; WAL lets readers proceed while a worker is writing.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            # Python's lower(), which unlike SQLite's also folds non-ASCII letters, for filename search.
+            conn.create_function("py_lower", 1, lambda text: text.lower() if text else text, deterministic=True)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # --- counters ---
+    def add_counters(self, **deltas):
+        with self._conn() as conn:
+            conn.executemany("INSERT INTO counters(name, value) VALUES(?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                             [(name, int(delta)) for name, delta in deltas.items() if delta])
+
+    def counters(self):
+        stats = {"downloaded": 0, "uploaded": 0}
+        stats.update({row['name']: row['value'] for row in self._conn().execute("SELECT name, value FROM counters")})
+        return stats
+
+    # --- links ---
+    def record_link(self, filename, link, user_id=None, size=0, hashes=None):
+        """`hashes` is the integrity report of the upload (digests by algorithm), kept as JSON."""
+        with self._conn() as conn:
+            cursor = conn.execute("INSERT INTO links(filename, link, user_id, size, created, hashes) VALUES(?, ?, ?, ?, ?, ?)",
+                                  (filename, link, user_id, size or 0, time.time(), json.dumps(hashes) if hashes else None))
+            self._index_link(conn, cursor.lastrowid, filename)
+            return cursor.lastrowid
+
+    @staticmethod
+    def _index_link(conn, link_id, filename):
+        conn.executemany("INSERT OR IGNORE INTO link_trigrams(trigram, link_id) VALUES(?, ?)", [(gram, link_id) for gram in trigrams(filename)])
+
+    def index_links(self):
+        """Adds links inserted without going through record_link (legacy migration, older databases) to the trigram index.
+        Links are only ever appended, so everything above the highest indexed id is what is missing."""
+        with self._conn() as conn:
+            rows = conn.execute("SELECT id, filename FROM links WHERE id > COALESCE((SELECT MAX(link_id) FROM link_trigrams), 0)").fetchall()
+            for row in rows: self._index_link(conn, row['id'], row['filename'])
+        if rows: LOGGER.info(f"Indexed {len(rows)} saved links for search.")
+
+    def links(self, limit=None, offset=0):
+        query = "SELECT id, filename, link, user_id, size, created FROM links ORDER BY created DESC, id DESC"
+        if limit is None: return [dict(row) for row in self._conn().execute(query)]
+        return [dict(row) for row in self._conn().execute(f"{query} LIMIT ? OFFSET ?", (limit, offset))]
+
+    def count_links(self):
+        return self._conn().execute("SELECT COUNT(*) FROM links").fetchone()[0]
+
+    def search_links(self, query, limit, offset=0):
+        """Case-insensitive search for links whose filename contains every whitespace-separated term of `query`.
+        Candidates come from the trigram index (all trigrams of all terms must be present) and are checked for the
+        actual substrings, counted and paged in SQL. Returns (total_matches, rows of the requested page), newest first."""
+        terms = query.lower().split()
+        if not terms: return 0, []
+        grams = set().union(*(trigrams(term) for term in terms))
+        where = " AND ".join("instr(py_lower(l.filename), ?) > 0" for _ in terms)
+        if grams:
+            source = (f"links l JOIN (SELECT link_id FROM link_trigrams WHERE trigram IN ({','.join('?' * len(grams))}) "
+                      f"GROUP BY link_id HAVING COUNT(*) = ?) m ON m.link_id = l.id")
+            params = (*grams, len(grams), *terms)
+        else:
+            # Only terms shorter than a trigram: nothing to look up, so every link is a candidate.
+            source = "links l"; params = tuple(terms)
+        conn = self._conn()
+        total = conn.execute(f"SELECT COUNT(*) FROM {source} WHERE {where}", params).fetchone()[0]
+        rows = conn.execute(f"SELECT l.id, l.filename, l.link, l.user_id, l.size, l.created FROM {source} WHERE {where} "
+                            f"ORDER BY l.created DESC, l.id DESC LIMIT ? OFFSET ?", (*params, limit, offset)).fetchall()
+        return total, [dict(row) for row in rows]
+
+    # --- jobs ---
+    def save_job(self, job_id, user_id, chat_id, url, filename, options=None):
+        """Journals a job and returns the name it is saved under. Active jobs never share a name, since both would
+        write DOWNLOAD_PATH/name: a clash gets the first free 'stem (2).ext'. Each INSERT checks for the clash
+        itself, so concurrent submissions (or front-ends) cannot both win. A journaled job keeps its name."""
+        now = time.time(); stem, ext = os.path.splitext(filename)
+        with self._conn() as conn:
+            row = conn.execute("SELECT filename FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row: return row['filename']
+            for n in itertools.count(1):
+                name = filename if n == 1 else f"{stem} ({n}){ext}"
+                if conn.execute("INSERT INTO jobs(job_id, user_id, chat_id, url, filename, options, created, updated) "
+                                f"SELECT ?, ?, ?, ?, ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM jobs WHERE filename = ? AND {_ACTIVE})",
+                                (job_id, user_id, chat_id, url, name, json.dumps(options) if options else None, now, now, name)).rowcount:
+                    return name
+
+    def finish_job(self, job_id, state):
+        with self._conn() as conn:
+            # Only unfinished jobs: a worker process may already have recorded a more specific end state.
+            conn.execute(f"UPDATE jobs SET state = ?, updated = ? WHERE job_id = ? AND {_ACTIVE}", (state, time.time(), job_id))
+
+    def bump_resumes(self, job_id):
+        with self._conn() as conn:
+            conn.execute("UPDATE jobs SET resumes = resumes + 1, updated = ? WHERE job_id = ?", (time.time(), job_id))
+            return conn.execute("SELECT resumes FROM jobs WHERE job_id = ?", (job_id,)).fetchone()[0]
+
+    def pending_jobs(self):
+        """Unfinished jobs, oldest first (including any a worker process held when it was switched off)."""
+        rows = self._conn().execute(f"SELECT * FROM jobs WHERE {_ACTIVE} ORDER BY created").fetchall()
+        return [self._job(row) for row in rows]
+
+    @staticmethod
+    def _job(row):
+        return dict(row, options=json.loads(row['options']) if row['options'] else None)
+
+    # --- job queue (worker-process mode) ---
+    def get_job(self, job_id):
+        row = self._conn().execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def set_job_priority(self, job_id, priority):
+        with self._conn() as conn: conn.execute("UPDATE jobs SET priority = ? WHERE job_id = ?", (priority, job_id))
+
+    def job_position(self, job_id):
+        """1-based place of a pending job in claim order, 0 once a worker holds it."""
+        row = self._conn().execute(
+            "SELECT CASE WHEN j.state = 'pending' THEN 1 + (SELECT COUNT(*) FROM jobs o WHERE o.state = 'pending' "
+            "AND (o.priority, o.created) < (j.priority, j.created)) ELSE 0 END FROM jobs j WHERE j.job_id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def job_counts(self):
+        rows = self._conn().execute(f"SELECT state, COUNT(*) FROM jobs WHERE {_ACTIVE} GROUP BY state").fetchall()
+        return {state: 0 for state in ACTIVE_JOB_STATES} | {row[0]: row[1] for row in rows}
+
+    def claim_job(self, worker, lease_until):
+        """Hands the next pending job, or one whose worker stopped renewing its lease, to `worker`. A single UPDATE
+        so concurrent workers can never claim the same row; a reclaimed job counts as a resume."""
+        now = time.time()
+        with self._conn() as conn:
+            row = conn.execute(
+                "UPDATE jobs SET state = 'claimed', worker = ?, lease_until = ?, updated = ?, status = NULL, "
+                "resumes = resumes + (state != 'pending') WHERE job_id = (SELECT job_id FROM jobs WHERE state = 'pending' "
+                "OR (state IN ('claimed', 'downloading', 'uploading') AND lease_until < ?) ORDER BY priority, created LIMIT 1) RETURNING *",
+                (worker, lease_until, now, now)).fetchone()
+        return self._job(row) if row else None
+
+    def renew_claims(self, worker, updates, lease_until):
+        """Heartbeat of a worker: writes (job_id, state, status) for the jobs it runs and extends their lease.
+        Returns {job_id: 'cancelled' | 'reclaimed'} for the jobs it should stop: cancelled from the front-end, or
+        reclaimed by another worker meanwhile."""
+        if not updates: return {}
+        now = time.time()
+        with self._conn() as conn:
+            conn.executemany("UPDATE jobs SET state = ?, status = ?, lease_until = ?, updated = ? "
+                             "WHERE job_id = ? AND worker = ? AND state IN ('claimed', 'downloading', 'uploading')",
+                             [(state, status, lease_until, now, job_id, worker) for job_id, state, status in updates])
+            rows = conn.execute(f"SELECT job_id, worker, cancel_requested FROM jobs WHERE job_id IN ({','.join('?' * len(updates))})",
+                                [job_id for job_id, _, _ in updates]).fetchall()
+        return {row['job_id']: 'reclaimed' if row['worker'] != worker else 'cancelled'
+                for row in rows if row['cancel_requested'] or row['worker'] != worker}
+
+    def cancel_queued_job(self, job_id):
+        """'removed' if the job was still waiting for a worker, 'requested' if its worker has to stop it, else None."""
+        with self._conn() as conn:
+            if conn.execute("UPDATE jobs SET state = 'cancelled', updated = ? WHERE job_id = ? AND state = 'pending'", (time.time(), job_id)).rowcount:
+                return 'removed'
+            if conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE job_id = ? AND state IN ('claimed', 'downloading', 'uploading')", (job_id,)).rowcount:
+                return 'requested'
+        return None
+
+    def post_job_event(self, job_id, chat_id, text):
+        """A message for the front-end to send to `chat_id` on behalf of a job."""
+        with self._conn() as conn:
+            conn.execute("INSERT INTO job_events(job_id, chat_id, kind, text, created) VALUES(?, ?, 'message', ?, ?)", (job_id, chat_id, text, time.time()))
+
+    def complete_claimed_job(self, job_id, worker, chat_id, state, final_status):
+        """Ends a job and queues its final status for the front-end, in one transaction. Returns False (and changes
+        nothing) when the job is no longer held by `worker`."""
+        now = time.time()
+        with self._conn() as conn:
+            if not conn.execute("UPDATE jobs SET state = ?, status = ?, updated = ? WHERE job_id = ? AND worker = ? "
+                                "AND state IN ('claimed', 'downloading', 'uploading')", (state, final_status, now, job_id, worker)).rowcount:
+                return False
+            conn.execute("INSERT INTO job_events(job_id, chat_id, kind, text, created) VALUES(?, ?, 'final', ?, ?)", (job_id, chat_id, final_status, now))
+        return True
+
+    def job_events(self, after_id=0, limit=100):
+        return [dict(row) for row in self._conn().execute("SELECT * FROM job_events WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit))]
+
+    def ack_job_events(self, up_to_id):
+        with self._conn() as conn: conn.execute("DELETE FROM job_events WHERE id <= ?", (up_to_id,))
+
+    # --- settings and worker reports (worker-process mode) ---
+    def put_setting(self, name, value):
+        with self._conn() as conn:
+            conn.execute("INSERT INTO settings(name, value, updated) VALUES(?, ?, ?) "
+                         "ON CONFLICT(name) DO UPDATE SET value = excluded.value, updated = excluded.updated", (name, json.dumps(value), time.time()))
+
+    def get_setting(self, name, default=None):
+        row = self._conn().execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+        return json.loads(row['value']) if row else default
+
+    def report_worker(self, worker, rates, stale_after):
+        """Records a worker's measured transfer rates and returns the ids of the workers that reported within
+        `stale_after` seconds, this one included. Older rows belong to stopped workers and are dropped."""
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute("INSERT INTO workers(worker, down, up, updated) VALUES(?, ?, ?, ?) ON CONFLICT(worker) DO UPDATE "
+                         "SET down = excluded.down, up = excluded.up, updated = excluded.updated", (worker, rates['down'], rates['up'], now))
+            conn.execute("DELETE FROM workers WHERE updated < ?", (now - stale_after,))
+            return [row[0] for row in conn.execute("SELECT worker FROM workers ORDER BY worker")]
+
+    def worker_rates(self, stale_after):
+        """Summed transfer rates of the workers that reported within `stale_after` seconds."""
+        row = self._conn().execute("SELECT COALESCE(SUM(down), 0), COALESCE(SUM(up), 0) FROM workers WHERE updated >= ?",
+                                   (time.time() - stale_after,)).fetchone()
+        return {'down': row[0], 'up': row[1]}
+
+    # --- dedup cache ---
+    def cache_get(self, key, ttl):
+        """Returns the cached [(name, size, link)] for `key`, or None. Expired entries are dropped on read;
+        hits, misses and the bytes a hit saved are tracked in the counters table."""
+        now = time.time()
+        with self._conn() as conn:
+            row = conn.execute("SELECT uploads, size, created FROM dedup WHERE key = ?", (key,)).fetchone()
+            if row is not None and row['created'] < now - ttl:
+                conn.execute("DELETE FROM dedup WHERE key = ?", (key,)); row = None
+            if row is not None: conn.execute("UPDATE dedup SET hits = hits + 1, last_hit = ? WHERE key = ?", (now, key))
+        if row is None:
+            self.add_counters(dedup_misses=1); return None
+        self.add_counters(dedup_hits=1, dedup_saved=row['size'])
+        return [tuple(upload) for upload in json.loads(row['uploads'])]
+
+    def cache_put(self, key, uploads, size, max_entries):
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute("INSERT INTO dedup(key, uploads, size, created, last_hit) VALUES(?, ?, ?, ?, ?) "
+                         "ON CONFLICT(key) DO UPDATE SET uploads = excluded.uploads, size = excluded.size, created = excluded.created",
+                         (key, json.dumps([list(upload) for upload in uploads]), size or 0, now, now))
+            # Least recently used entries go first once the cache is over its size limit.
+            conn.execute("DELETE FROM dedup WHERE key IN (SELECT key FROM dedup ORDER BY last_hit DESC LIMIT -1 OFFSET ?)", (max_entries,))
+
+    def cache_forget(self, key):
+        with self._conn() as conn: conn.execute("DELETE FROM dedup WHERE key = ?", (key,))
+
+    def count_cached(self):
+        return self._conn().execute("SELECT COUNT(*) FROM dedup").fetchone()[0]
+
+    # --- migration ---
+    def migrate_legacy(self, stats_file, jobs_file):
+        """One-time import of the old stats.json / jobs.json files; each is renamed to *.migrated afterwards."""
+        if os.path.exists(stats_file):
+            try:
+                with open(stats_file, 'r') as f: data = json.load(f)
+                stats = data.get("stats", {}); links = data.get("saved_links", {})
+                with self._conn() as conn:
+                    conn.executemany("INSERT INTO counters(name, value) VALUES(?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                                     [(name, int(value)) for name, value in stats.items()])
+                    conn.executemany("INSERT INTO links(filename, link, created) VALUES(?, ?, ?)",
+                                     [(filename, link, time.time()) for filename, link in links.items()])
+                os.replace(stats_file, f"{stats_file}.migrated")
+                self.index_links()
+                LOGGER.info(f"Migrated {len(links)} saved links and stats from {stats_file} into {self.path}")
+            except (json.JSONDecodeError, IOError, sqlite3.Error) as e:
+                LOGGER.warning(f"Could not migrate stats file: {e}")
+        if os.path.exists(jobs_file):
+            try:
+                with open(jobs_file, 'r') as f: jobs = json.load(f)
+                for job_id, job in jobs.items():
+                    self.save_job(job_id, job['user_id'], job['chat_id'], job['url'], job['filename'], job.get('options'))
+                os.replace(jobs_file, f"{jobs_file}.migrated")
+                LOGGER.info(f"Migrated {len(jobs)} unfinished jobs from {jobs_file} into {self.path}")
+            except (json.JSONDecodeError, IOError, KeyError, sqlite3.Error) as e:
+                LOGGER.warning(f"Could not migrate jobs file: {e}")
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None: conn.close(); self._local.conn = None
@@ -2,184 +2,880 @@
 
 import os
 import time
+import errno
 import re
+import shutil
+import threading
 import requests
-import libtorrent as lt
 import json
-from urllib.parse import urlparse, unquote
+import base64
+import hashlib
+import http.client
+import functools
+from concurrent import futures
+from urllib.parse import urlparse, urlsplit, urlunsplit, parse_qsl, urlencode, unquote
 
 from utils import (
     escape_markdown, format_bytes, format_time, progress_bar, 
-    UploadProgressTracker, DOWNLOAD_PATH, LOGGER
+    Checksum, DiskWriter, FileUploadSource, StreamPipe, TarStream, preallocate, DOWNLOAD_PATH, LOGGER
+)
+from text import get_integrity_lines
+from scheduler import PHASE_UPLOAD, JobCancelled, LeaseLost
+from netclient import get_client, body_reader
+from shaper import get_shaper
+import metrics
+from torrent import get_engine, magnet_key, list_torrent_files, file_progress
+from config import (
+    STREAM_UPLOADS, STREAM_BUFFER_CHUNKS, STREAM_STALL_TIMEOUT,
+    SEGMENTED_DOWNLOADS, DOWNLOAD_CONNECTIONS, SEGMENT_MIN_SIZE, SEGMENT_SPLIT_MIN,
+    DOWNLOAD_BUFFER_SIZE, DOWNLOAD_BUFFERS, DOWNLOAD_WRITE_MAX,
+    HTTP_RETRIES, HTTP_RETRY_BACKOFF, HTTP_RETRY_BACKOFF_MAX, TORRENT_METADATA_TIMEOUT, TORRENT_JOB_METADATA_TIMEOUT,
+    DEDUP_TTL, DEDUP_MAX_ENTRIES, HTTP_CONNECT_TIMEOUT, HTTP_UPLOAD_TIMEOUT,
+    BUZZHEAVIER_UPLOAD_URL, UPLOAD_RETRIES, HTTP_READ_TIMEOUT, UPLOAD_BLOCK_SIZE, UPLOAD_SENDFILE, PREALLOCATE_FILES,
+    INTEGRITY_CHECKS
 )
 
-# ... (get_http_filename and download_http functions are unchanged) ...
-def get_http_filename(url):
-    headers = {'User-Agent': 'Mozilla/5.0'}
+class RangeNotSupported(IOError):
+    pass
+
+class UploadRejected(IOError):
+    pass
+
+class IntegrityError(IOError):
+    pass
+
+def _filename_from_response(r):
+    if "content-disposition" in r.headers:
+        d = r.headers['content-disposition']
+        fnames = re.findall("filename\*?=([^;]+)", d, re.IGNORECASE)
+        if fnames:
+            fname = fnames[0].strip().strip("'\"")
+            if fname.lower().startswith("utf-8''"): fname = unquote(fname[7:])
+            return fname
+    return unquote(os.path.basename(urlparse(r.url).path))
+
+_DIGEST_NAMES = {'sha-256': ('sha256', 32), 'md5': ('md5', 16)}
+
+def _source_digests(headers):
+    """Digests the source publishes for the whole file, as {'sha256'|'md5': hex}: RFC 9530 Repr-Digest,
+    RFC 3230 Digest and Content-MD5. Malformed values are ignored."""
+    found = {}
+    values = [part for header in ('repr-digest', 'digest') for part in headers.get(header, '').split(',')]
+    if headers.get('content-md5'): values.append(f"md5={headers['content-md5']}")
+    for part in values:
+        algorithm, _, value = part.strip().partition('=')
+        name, length = _DIGEST_NAMES.get(algorithm.strip().lower(), (None, 0))
+        if not name or name in found: continue
+        try: raw = base64.b64decode(value.strip().strip(':'), validate=True)
+        except ValueError: continue
+        if len(raw) == length: found[name] = raw.hex()
+    return found
+
+def probe_http(url):
+    """HEADs the URL and returns what the downloaders need to know about it, or None on failure."""
+    host = metrics.host_label(url); started = time.monotonic()
     try:
-        with requests.head(url, allow_redirects=True, timeout=15, headers=headers) as r:
+        with get_client().head(url, allow_redirects=True) as r:
             r.raise_for_status()
-            if "content-disposition" in r.headers:
-                d = r.headers['content-disposition']
-                fnames = re.findall("filename\*?=([^;]+)", d, re.IGNORECASE)
-                if fnames:
-                    fname = fnames[0].strip().strip("'\"")
-                    if fname.lower().startswith("utf-8''"): fname = unquote(fname[7:])
-                    return fname
-            return unquote(os.path.basename(urlparse(r.url).path))
-    except requests.RequestException as e:
+            metrics.HEAD_SECONDS.labels(host).observe(time.monotonic() - started)
+            return {'filename': _filename_from_response(r), 'url': r.url,
+                    'size': int(r.headers.get('content-length', 0) or 0),
+                    'ranges': r.headers.get('accept-ranges', '').lower() == 'bytes',
+                    'etag': r.headers.get('etag'), 'last_modified': r.headers.get('last-modified'),
+                    'digests': _source_digests(r.headers)}
+    except (requests.RequestException, ValueError) as e:
+        metrics.HEAD_FAILURES.labels(host).inc()
         LOGGER.error(f"Failed to get filename from URL {url}: {e}")
         return None
 
-def download_http(url, filename, update_status_callback):
+def get_http_filename(url):
+    info = probe_http(url)
+    return info['filename'] if info else None
+
+def normalize_url(url):
+    """Canonical form used for dedup: lower-case scheme and host, no default port, sorted query, no fragment."""
+    parts = urlsplit(url.strip())
+    netloc = (parts.hostname or '').lower()
+    if parts.port and (parts.scheme.lower(), parts.port) not in (('http', 80), ('https', 443)): netloc += f":{parts.port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme.lower(), netloc, parts.path or '/', query, ''))
+
+def cache_key(url, options=None, info=None):
+    """Dedup key for a job, or None when the source cannot be identified reliably. Magnets are keyed by
+    info-hash plus file selection and upload mode; HTTP links by URL plus the ETag/Content-Length from the HEAD."""
+    options = options or {}
+    if url.startswith("magnet:"):
+        try: key = magnet_key(url)
+        except Exception: return None
+        files = ",".join(map(str, options['files'])) if options.get('files') else "*"
+        return f"magnet:{key}:{files}:{options.get('mode', '')}"
+    if not info or not (info.get('etag') or info.get('size')): return None
+    digest = hashlib.sha256(f"{normalize_url(url)}|{info.get('etag') or ''}|{info.get('size') or 0}".encode()).hexdigest()
+    return f"http:{digest}"
+
+def journal_path(filepath):
+    return f"{filepath}.journal.json"
+
+def _load_journal(filepath, url, info):
+    """Returns the sidecar journal for a partial download if it still describes the same remote file."""
+    path = journal_path(filepath)
+    if not (os.path.exists(path) and os.path.exists(filepath)): return None
+    try:
+        with open(path, 'r') as f: journal = json.load(f)
+    except (json.JSONDecodeError, IOError) as e:
+        LOGGER.warning(f"Ignoring unreadable download journal {path}: {e}"); return None
+    if journal.get('url') != url: return None
+    if info:
+        for key in ('etag', 'last_modified', 'size'):
+            if journal.get(key) and info.get(key) and journal[key] != info[key]:
+                LOGGER.info(f"Remote file changed since partial download of {os.path.basename(filepath)} ({key}); starting over.")
+                return None
+    return journal
+
+def _save_journal(filepath, journal):
+    path = journal_path(filepath); tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, 'w') as f: json.dump(journal, f)
+        os.replace(tmp_path, path)
+    except IOError as e: LOGGER.warning(f"Could not write download journal {path}: {e}")
+
+def _clear_journal(filepath):
+    if os.path.exists(journal_path(filepath)): os.remove(journal_path(filepath))
+
+def _mark_complete(filepath, journal, size):
+    # Kept until the upload is confirmed, so a retried or resumed job goes straight to the upload.
+    _save_journal(filepath, {'url': journal.get('url'), 'etag': journal.get('etag'), 'last_modified': journal.get('last_modified'),
+                             'size': size, 'complete': True})
+
+def prune_staged_downloads(max_age):
+    """Removes downloads whose upload failed and that nobody retried within `max_age` seconds."""
+    if not os.path.isdir(DOWNLOAD_PATH): return
+    for name in os.listdir(DOWNLOAD_PATH):
+        if not name.endswith(".journal.json"): continue
+        path = os.path.join(DOWNLOAD_PATH, name); filepath = path[:-len(".journal.json")]
+        try:
+            with open(path, 'r') as f: complete = json.load(f).get('complete')
+            if complete and time.time() - os.path.getmtime(path) > max_age:
+                discard_partial_download(filepath); LOGGER.info(f"Removed stale staged download: {filepath}")
+        except (json.JSONDecodeError, IOError) as e:
+            LOGGER.warning(f"Could not inspect staged download {path}: {e}")
+
+def discard_partial_download(filepath):
+    for path in (filepath, journal_path(filepath)):
+        if os.path.exists(path): os.remove(path)
+
+def has_partial_download(filepath):
+    return os.path.exists(journal_path(filepath)) and os.path.exists(filepath)
+
+def _backoff(attempt):
+    return min(HTTP_RETRY_BACKOFF * (2 ** attempt), HTTP_RETRY_BACKOFF_MAX)
+
+def _download_status(filename, downloaded, total_size, speed, seg_stats=None):
+    """MarkdownV2 progress for an HTTP download. The download loops report it as a functools.partial over a
+    snapshot of their counters, so the text is only built when the status is actually read."""
+    progress = (downloaded / total_size) * 100 if total_size > 0 else 0
+    eta = ((total_size - downloaded) / speed) if speed > 0 else -1
+    if seg_stats is None: speed_line = f"*Speed:* {escape_markdown(f'{format_bytes(speed)}/s')}"
+    else:
+        speed_line = f"*Speed:* {escape_markdown(f'{format_bytes(speed)}/s')} over {len(seg_stats)} connections\n" + \
+            "\n".join(escape_markdown(f"  #{sid}: {format_bytes(done / el if el > 0 else 0)}/s, {format_bytes(left)} left")
+                      for sid, done, left, el in seg_stats)
+    return (f"*Status:* Downloading `{escape_markdown(filename)}`\n"
+            f"{progress_bar(progress)} {escape_markdown(f'{progress:.2f}%')}\n"
+            f"`{escape_markdown(format_bytes(downloaded))}` of `{escape_markdown(format_bytes(total_size))}`\n"
+            f"{speed_line}\n*ETA:* {escape_markdown(format_time(eta))}")
+
+def _download_segmented(url, filepath, filename, total_size, update_status_callback, journal, user_id=None, checksum=None):
+    """Downloads byte ranges over several connections into a preallocated file. Connections read into buffers of
+    a shared DiskWriter, which does the positional writes. Idle connections steal the back half of whichever
+    segment has the longest time left. `checksum`, if given, is fed the file in order by a thread that reads back
+    the prefix the writer has completed, which is still in the page cache."""
+    throttle = get_shaper().throttler('down', user_id)
+    if journal and 'segments' in journal:
+        ranges = [(pos, end) for pos, end in journal['segments'] if pos < end]
+        LOGGER.info(f"Resuming segmented download of {filename}: {format_bytes(total_size - sum(e - p for p, e in ranges))} already on disk")
+    else:
+        seg_size = -(-total_size // DOWNLOAD_CONNECTIONS)
+        ranges = [(start, min(start + seg_size, total_size)) for start in range(0, total_size, seg_size)]
+    # 'pos' is the next byte claimed by a connection, 'flushed' the end of what the writer has put in the file.
+    segments = [{'id': i, 'pos': pos, 'flushed': pos, 'end': end, 'done': 0, 'active': False, 'started': 0}
+                for i, (pos, end) in enumerate(ranges)]
+    lock = threading.Lock(); errors = []
+    journal = dict(journal or {}, segments=ranges)
+
+    def time_left(seg):
+        elapsed = time.time() - seg['started']; speed = seg['done'] / elapsed if elapsed > 0 else 0
+        return (seg['end'] - seg['pos']) / speed if speed > 0 else float('inf')
+
+    def take_work():
+        with lock:
+            for seg in segments:
+                if not seg['active'] and seg['pos'] < seg['end']:
+                    seg['active'] = True; seg['started'] = time.time(); return seg
+            busy = [seg for seg in segments if seg['active'] and seg['end'] - seg['pos'] >= 2 * SEGMENT_SPLIT_MIN]
+            if not busy: return None
+            victim = max(busy, key=time_left)
+            mid = victim['pos'] + (victim['end'] - victim['pos']) // 2
+            seg = {'id': len(segments), 'pos': mid, 'flushed': mid, 'end': victim['end'], 'done': 0, 'active': True, 'started': time.time()}
+            victim['end'] = mid; segments.append(seg)
+            LOGGER.info(f"Rebalanced segment #{victim['id']} of {filename}: new segment #{seg['id']} from byte {mid}")
+            return seg
+
+    def written(seg, end):
+        with lock: seg['flushed'] = max(seg['flushed'], end)
+        advanced.set()
+
+    def completed_prefix():
+        # Everything outside the [flushed, end) ranges still owed is in the file, including bytes of an earlier run.
+        with lock: return min((seg['flushed'] for seg in segments if seg['flushed'] < seg['end']), default=total_size)
+
+    def hash_prefix():
+        view = memoryview(bytearray(DOWNLOAD_BUFFER_SIZE))
+        try:
+            with open(filepath, 'rb', buffering=0) as f:
+                while True:
+                    finished = stopped.is_set()
+                    _extend_checksum(checksum, f, completed_prefix(), view)
+                    if finished: return
+                    advanced.wait(1); advanced.clear()
+        except Exception as e:
+            LOGGER.warning(f"Hashing {filename} while downloading failed ({e}); it is read back before the upload instead.")
+
+    def fetch_segment(writer, seg):
+        headers = {'Range': f"bytes={seg['pos']}-{seg['end'] - 1}"}
+        with get_client().get(url, stream=True, allow_redirects=True, headers=headers) as r:
+            if r.status_code != 206: raise RangeNotSupported(f"Server ignored Range request (HTTP {r.status_code})")
+            readinto = body_reader(r, DOWNLOAD_BUFFER_SIZE)
+            while True:
+                buffer = writer.get_buffer()
+                try: n = readinto(memoryview(buffer))
+                except BaseException: writer.release(buffer); raise
+                # Claim the bytes under the lock so a concurrent split can never overlap this write.
+                with lock:
+                    pos = seg['pos']; take = min(n, seg['end'] - pos)
+                    if take > 0: seg['pos'] += take; seg['done'] += take
+                if take <= 0: writer.release(buffer); break
+                writer.submit(buffer, take, pos, functools.partial(written, seg, pos + take))
+                throttle(take)
+                if take < n: break
+        if seg['pos'] < seg['end']: raise IOError(f"Segment #{seg['id']} ended early at byte {seg['pos']}")
+
+    def fetch(writer):
+        while not errors:
+            seg = take_work()
+            if not seg: return
+            try:
+                for attempt in range(HTTP_RETRIES + 1):
+                    try: fetch_segment(writer, seg); break
+                    except RangeNotSupported: raise
+                    except Exception as e:
+                        if attempt == HTTP_RETRIES or errors: raise
+                        # Resume after the last byte in the file, once the bytes still queued for it have landed.
+                        writer.flush()
+                        with lock: seg['pos'] = seg['flushed']
+                        LOGGER.warning(f"Segment #{seg['id']} of {filename} failed ({e}); retrying in {_backoff(attempt)}s")
+                        time.sleep(_backoff(attempt))
+            except Exception as e:
+                errors.append(e); return
+            finally:
+                with lock: seg['active'] = False
+
+    fd = os.open(filepath, os.O_RDWR | os.O_CREAT, 0o644); writer = None; hasher = None
+    advanced = threading.Event(); stopped = threading.Event()
+    try:
+        if not journal.get('segments_started'):
+            if PREALLOCATE_FILES: preallocate(fd, total_size)
+            else: os.ftruncate(fd, total_size)
+            journal['segments_started'] = True
+        _save_journal(filepath, journal)
+        LOGGER.info(f"Starting segmented HTTP download for: {filename} ({DOWNLOAD_CONNECTIONS} connections)")
+        writer = DiskWriter(fd, DOWNLOAD_BUFFER_SIZE, DOWNLOAD_BUFFERS, DOWNLOAD_WRITE_MAX, name=filename)
+        threads = [threading.Thread(target=fetch, args=(writer,), daemon=True) for _ in range(DOWNLOAD_CONNECTIONS)]
+        for t in threads: t.start()
+        if checksum is not None:
+            checksum.reset(); hasher = threading.Thread(target=hash_prefix, name=f"hash-{filename}", daemon=True); hasher.start()
+        start_time = time.time()
+        while any(t.is_alive() for t in threads):
+            next((t for t in threads if t.is_alive()), threads[0]).join(timeout=2)
+            elapsed = time.time() - start_time
+            with lock:
+                downloaded = total_size - sum(seg['end'] - seg['flushed'] for seg in segments)
+                journal['segments'] = [(seg['flushed'], seg['end']) for seg in segments if seg['flushed'] < seg['end']]
+                seg_stats = [(seg['id'], seg['done'], seg['end'] - seg['pos'], time.time() - seg['started']) for seg in segments if seg['active']]
+                session_bytes = sum(seg['done'] for seg in segments)
+            os.fsync(fd); _save_journal(filepath, journal)
+            speed = session_bytes / elapsed if elapsed > 0 else 0
+            update_status_callback(functools.partial(_download_status, filename, downloaded, total_size, speed, seg_stats))
+    finally:
+        try:
+            if writer: writer.close()
+        finally:
+            os.close(fd); stopped.set(); advanced.set()
+            # Joined on every path: a single-stream fallback takes the checksum over from here.
+            if hasher: hasher.join()
+    if errors: raise errors[0]
+    LOGGER.info(f"Finished segmented HTTP download for: {filename}")
+    return filepath
+
+def _extend_checksum(checksum, f, end, view):
+    """Feeds `checksum` the bytes of the unbuffered file `f` from checksum.size up to `end`, reading into `view`."""
+    if checksum.size >= end: return
+    f.seek(checksum.size)
+    while checksum.size < end:
+        n = f.readinto(view[:min(len(view), end - checksum.size)])
+        if not n: raise IOError(f"{f.name} is shorter than {end} bytes")
+        checksum.update(view[:n])
+
+def _prime_checksum(checksum, filepath, offset):
+    """Brings `checksum` up to the first `offset` bytes of the file. A download resumed from disk hashes the part it
+    already has once; a retry inside the same call has already seen those bytes and costs nothing."""
+    if checksum.size == offset: return
+    checksum.reset()
+    with open(filepath, 'rb', buffering=0) as f: _extend_checksum(checksum, f, offset, memoryview(bytearray(1024 * 1024)))
+
+def _download_single(url, filepath, filename, update_status_callback, journal, info, user_id=None, checksum=None):
+    """Single-connection download that continues from the bytes already on disk whenever the server honours Range.
+    The socket is read into DiskWriter buffers; `checksum`, if given, is fed every byte of the file in order on the
+    writer's thread."""
+    journal = dict(journal or {}); journal.pop('segments', None); throttle = get_shaper().throttler('down', user_id)
+    total_size = 0; start_time = time.monotonic(); session_bytes = 0
+    for attempt in range(HTTP_RETRIES + 1):
+        offset = os.path.getsize(filepath) if journal.get('single_started') and os.path.exists(filepath) else 0
+        headers = {}
+        if offset:
+            headers['Range'] = f"bytes={offset}-"
+            validator = journal.get('etag') or journal.get('last_modified')
+            if validator: headers['If-Range'] = validator
+        try:
+            with get_client().get(url, stream=True, allow_redirects=True, headers=headers) as r:
+                if offset and r.status_code == 416 and journal.get('size') == offset:
+                    return filepath, offset
+                r.raise_for_status()
+                if offset and r.status_code != 206:
+                    LOGGER.info(f"Server did not honour resume for {filename}; restarting from the beginning.")
+                    offset = 0
+                total_size = offset + int(r.headers.get('content-length', 0))
+                journal.update(url=url, size=total_size or None, single_started=True,
+                               etag=r.headers.get('etag') or journal.get('etag'),
+                               last_modified=r.headers.get('last-modified') or journal.get('last_modified'))
+                _save_journal(filepath, journal)
+                if offset: LOGGER.info(f"Resuming HTTP download for {filename} at {format_bytes(offset)}")
+                if checksum is not None: _prime_checksum(checksum, filepath, offset)
+                downloaded = offset; last_update_time = 0
+                fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | (0 if offset else os.O_TRUNC), 0o644)
+                try:
+                    if PREALLOCATE_FILES and total_size > offset: preallocate(fd, total_size, keep_size=True)
+                    writer = DiskWriter(fd, DOWNLOAD_BUFFER_SIZE, DOWNLOAD_BUFFERS, DOWNLOAD_WRITE_MAX, checksum, filename)
+                    try:
+                        readinto = body_reader(r, DOWNLOAD_BUFFER_SIZE)
+                        while True:
+                            buffer = writer.get_buffer()
+                            try: n = readinto(memoryview(buffer))
+                            except BaseException: writer.release(buffer); raise
+                            if not n: writer.release(buffer); break
+                            writer.submit(buffer, n, downloaded); downloaded += n; session_bytes += n; throttle(n); current_time = time.monotonic()
+                            if current_time - last_update_time > 2:
+                                elapsed = current_time - start_time; speed = session_bytes / elapsed if elapsed > 0 else 0
+                                update_status_callback(functools.partial(_download_status, filename, downloaded, total_size, speed))
+                                last_update_time = current_time
+                    finally: writer.close()
+                finally: os.close(fd)
+            if total_size and downloaded < total_size: raise IOError(f"Connection closed at {downloaded} of {total_size} bytes")
+            return filepath, downloaded
+        except JobCancelled: raise
+        except Exception as e:
+            if attempt == HTTP_RETRIES or getattr(e, 'errno', None) == errno.ENOSPC: raise
+            LOGGER.warning(f"HTTP download of {filename} interrupted ({e}); retrying in {_backoff(attempt)}s")
+            update_status_callback(f"*Status:* Connection lost for `{escape_markdown(filename)}`, retrying in {_backoff(attempt)}s\.\.\.")
+            time.sleep(_backoff(attempt))
+
+def download_http(url, filename, update_status_callback, user_id=None, checksum=None, info=None):
+    """`checksum` receives the source's published digests and every byte of the file in order: single-stream
+    downloads feed it as they write, segmented ones as the written prefix grows. `info` is the probe_http()
+    result when the caller already has it; it decides between the segmented and the single-stream download."""
     filepath = os.path.join(DOWNLOAD_PATH, filename)
-    headers = {'User-Agent': 'Mozilla/5.0'}
+    info = info or probe_http(url)
+    if checksum is not None and info: checksum.expect(info['digests'])
+    journal = _load_journal(filepath, url, info)
+    if journal and journal.get('complete') and os.path.getsize(filepath) == journal.get('size'):
+        LOGGER.info(f"{filename} was fully downloaded by an earlier attempt; skipping the download.")
+        return filepath, journal['size']
+    if journal is None:
+        journal = {'url': url}
+        if info: journal.update(etag=info['etag'], last_modified=info['last_modified'], size=info['size'] or None)
     try:
+        if SEGMENTED_DOWNLOADS and DOWNLOAD_CONNECTIONS > 1 and not journal.get('single_started') \
+                and info and info['ranges'] and info['size'] >= SEGMENT_MIN_SIZE:
+            try:
+                filepath = _download_segmented(url, filepath, filename, info['size'], update_status_callback, journal, user_id, checksum)
+                _mark_complete(filepath, journal, info['size'])
+                return filepath, info['size']
+            except RangeNotSupported as e:
+                LOGGER.warning(f"Segmented download not possible for {filename} ({e}); using a single stream.")
+                journal.pop('segments', None); journal.pop('segments_started', None)
         LOGGER.info(f"Starting HTTP download for: {filename}")
-        with requests.get(url, stream=True, allow_redirects=True, timeout=30, headers=headers) as r:
-            r.raise_for_status()
-            total_size = int(r.headers.get('content-length', 0))
-            downloaded = 0; start_time = time.time(); last_update_time = 0
-            with open(filepath, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=1024*1024):
-                    if chunk:
-                        f.write(chunk); downloaded += len(chunk); current_time = time.time()
-                        if current_time - last_update_time > 2:
-                            elapsed = current_time - start_time; speed = downloaded / elapsed if elapsed > 0 else 0
-                            progress = (downloaded / total_size) * 100 if total_size > 0 else 0
-                            eta = ((total_size - downloaded) / speed) if speed > 0 else -1
-                            msg = (f"*Status:* Downloading `{escape_markdown(filename)}`\n"
-                                   f"{progress_bar(progress)} {escape_markdown(f'{progress:.2f}%')}\n"
-                                   f"`{escape_markdown(format_bytes(downloaded))}` of `{escape_markdown(format_bytes(total_size))}`\n"
-                                   f"*Speed:* {escape_markdown(f'{format_bytes(speed)}/s')}\n*ETA:* {escape_markdown(format_time(eta))}")
-                            update_status_callback(msg); last_update_time = current_time
+        filepath, downloaded = _download_single(url, filepath, filename, update_status_callback, journal, info, user_id, checksum)
+        _mark_complete(filepath, journal, downloaded)
         LOGGER.info(f"Finished HTTP download for: {filename}")
         return filepath, downloaded
+    except JobCancelled: raise
     except Exception as e:
         LOGGER.error(f"HTTP download failed for {filename}: {e}")
         return None, 0
 
-def download_magnet(magnet_link, filename, update_status_callback):
+def fetch_torrent_info(magnet_link):
+    try:
+        return get_engine().fetch_metadata(magnet_link, DOWNLOAD_PATH, TORRENT_METADATA_TIMEOUT)
+    except Exception as e:
+        LOGGER.error(f"Could not fetch torrent metadata: {e}")
+        return None
+
+def download_magnet(magnet_link, filename, update_status_callback, file_indices=None, on_file_complete=None, user_id=None):
+    """Downloads a magnet and returns (path, size, files) where files lists (path, arcname, size) for every selected file.
+    Single-file torrents are renamed to `filename` as before; multi-file torrents stay in their own directory.
+    Unselected files get priority 0 so their pieces are never requested. When on_file_complete is given it is
+    called with (path, arcname, size) as soon as each selected file of a multi-file torrent is complete."""
     LOGGER.info(f"Starting magnet download for: {filename}")
-    ses = lt.session({'listen_interfaces': '0.0.0.0:6881'}); params = {'save_path': DOWNLOAD_PATH}
+    engine = get_engine(); handle = None; cancelled = False
     try:
-        handle = lt.add_magnet_uri(ses, magnet_link, params); ses.start_dht()
+        wanted = set(file_indices) if file_indices else None
+        cached = engine.cached_info(magnet_key(magnet_link))
+        priorities = [4 if wanted is None or i in wanted else 0 for i in range(cached.num_files())] if cached else None
+        handle = engine.add_magnet(magnet_link, DOWNLOAD_PATH, file_priorities=priorities)
         
         update_status_callback(f"*Status:* Fetching metadata for `{escape_markdown(filename)}`\.\.\.")
         LOGGER.info("Waiting for torrent metadata...")
-
-        while not handle.has_metadata(): time.sleep(1)
+        # Short waits with a status call in between, so a cancel reaches a job still looking for peers.
+        started = time.monotonic()
+        while not engine.wait_for_metadata(handle, timeout=2):
+            waited = int(time.monotonic() - started)
+            if waited >= TORRENT_JOB_METADATA_TIMEOUT: raise TimeoutError(f"No metadata after {waited}s")
+            update_status_callback(f"*Status:* Fetching metadata for `{escape_markdown(filename)}`\.\.\. {waited}s")
         
-        info = handle.get_torrent_info(); sanitized_torrent_name = re.sub(r'[<>:"/\\|?*]', '_', info.name())
+        info = handle.torrent_file(); sanitized_torrent_name = re.sub(r'[<>:"/\\|?*]', '_', info.name())
+        files = [(i, path, size) for i, path, size in list_torrent_files(info) if wanted is None or i in wanted]
+        if not files: raise ValueError("None of the selected files exist in this torrent")
+        multi_file = info.num_files() > 1
+        if wanted is not None:
+            handle.prioritize_files([4 if i in wanted else 0 for i in range(info.num_files())])
+            LOGGER.info(f"Selected {len(files)} of {len(list_torrent_files(info))} files from {sanitized_torrent_name}")
+        reported = set()
+
+        def report_completed_files():
+            progress = file_progress(handle)
+            for i, path, size in files:
+                if i not in reported and progress[i] >= size:
+                    reported.add(i); on_file_complete(os.path.join(DOWNLOAD_PATH, path), path, size)
         
         update_status_callback(f"*Status:* Metadata received for `{escape_markdown(sanitized_torrent_name)}`\.\nStarting download\.\.\.")
         LOGGER.info(f"Metadata received. Torrent name: {sanitized_torrent_name}")
-        time.sleep(2)
         
-        last_update_time = 0
-        while not handle.status().is_seeding:
-            s = handle.status(); current_time = time.time()
-            if current_time - last_update_time > 2:
-                state = ['queued','checking','dl metadata','downloading','finished','seeding'][s.state]
-                eta = (s.total_wanted - s.total_wanted_done) / s.download_rate if s.download_rate > 0 else -1
-                
-                # MODIFIED: Final, most robust method to get seeder/leecher counts.
-                seeds = 0
-                leechers = 0
-                if hasattr(s, 'list_seeds'):
-                    seeds = s.list_seeds
-                elif hasattr(s, 'num_seeds'):
-                    seeds = s.num_seeds
-                
-                if hasattr(s, 'list_leechers'):
-                    leechers = s.list_leechers
-                elif hasattr(s, 'num_leechers'):
-                    leechers = s.num_leechers
-
-                msg = (f"*Status:* {escape_markdown(state.capitalize())} `{escape_markdown(sanitized_torrent_name)}`\n"
-                       f"{progress_bar(s.progress * 100)} {escape_markdown(f'{s.progress * 100:.2f}%')}\n"
-                       f"`{escape_markdown(format_bytes(s.total_wanted_done))}` of `{escape_markdown(format_bytes(s.total_wanted))}`\n"
-                       f"*Speed:* {escape_markdown(f'{format_bytes(s.download_rate)}/s')}\n"
-                       f"*Peers:* {escape_markdown(f'{s.num_peers} (S:{seeds}, L:{leechers})')}\n*ETA:* {escape_markdown(format_time(eta))}")
-                update_status_callback(msg); last_update_time = current_time
-            time.sleep(1)
+        # libtorrent enforces the session-wide caps itself; here the torrent gets the per-user cap and its
+        # traffic is charged to the shaper so HTTP jobs running alongside slow down accordingly.
+        shaper = get_shaper(); limits_version = None; charged_down = charged_up = 0
+        version = 0
+        while True:
+            entry = engine.wait_for_update(handle, version, timeout=2)
+            if entry['finished']: break
+            s = entry['status']; version = entry['version']
+            if s is None: continue
+            if limits_version != shaper.version:
+                handle.set_download_limit(shaper.user_limits['down'] or -1); handle.set_upload_limit(shaper.user_limits['up'] or -1)
+                limits_version = shaper.version
+            shaper.charge('down', user_id, s.total_payload_download - charged_down); charged_down = s.total_payload_download
+            shaper.charge('up', user_id, s.total_payload_upload - charged_up); charged_up = s.total_payload_upload
+            if on_file_complete and multi_file: report_completed_files()
+            state = ['queued','checking','dl metadata','downloading','finished','seeding'][s.state] if s.state < 6 else 'downloading'
+            eta = (s.total_wanted - s.total_wanted_done) / s.download_rate if s.download_rate > 0 else -1
+            
+            # MODIFIED: Final, most robust method to get seeder/leecher counts.
+            seeds = 0
+            leechers = 0
+            if hasattr(s, 'list_seeds'):
+                seeds = s.list_seeds
+            elif hasattr(s, 'num_seeds'):
+                seeds = s.num_seeds
+            
+            if hasattr(s, 'list_leechers'):
+                leechers = s.list_leechers
+            elif hasattr(s, 'num_leechers'):
+                leechers = s.num_leechers
+
+            msg = (f"*Status:* {escape_markdown(state.capitalize())} `{escape_markdown(sanitized_torrent_name)}`\n"
+                   f"{progress_bar(s.progress * 100)} {escape_markdown(f'{s.progress * 100:.2f}%')}\n"
+                   f"`{escape_markdown(format_bytes(s.total_wanted_done))}` of `{escape_markdown(format_bytes(s.total_wanted))}`\n"
+                   f"*Speed:* {escape_markdown(f'{format_bytes(s.download_rate)}/s')}\n"
+                   f"*Peers:* {escape_markdown(f'{s.num_peers} (S:{seeds}, L:{leechers})')}\n*ETA:* {escape_markdown(format_time(eta))}")
+            update_status_callback(msg)
             
         LOGGER.info(f"Finished magnet download for: {filename}")
+        # Drop the handle before renaming so libtorrent no longer holds the files open.
+        if on_file_complete and multi_file: report_completed_files()
+        engine.remove(handle); handle = None
+        total_wanted = sum(size for _, _, size in files)
+        if multi_file:
+            root_path = os.path.join(DOWNLOAD_PATH, files[0][1].split(os.sep)[0])
+            return root_path, total_wanted, [(os.path.join(DOWNLOAD_PATH, path), path, size) for _, path, size in files]
         original_path = os.path.join(DOWNLOAD_PATH, sanitized_torrent_name); final_path = os.path.join(DOWNLOAD_PATH, filename)
-        if os.path.exists(original_path): os.rename(original_path, final_path); return final_path, info.total_size()
+        if os.path.exists(original_path): os.rename(original_path, final_path); return final_path, total_wanted, [(final_path, filename, total_wanted)]
         else: raise FileNotFoundError(f"Torrent file not found: {original_path}")
-    except Exception as e: LOGGER.error(f"Torrent download failed: {e}"); return None, 0
-    finally: ses.pause()
+    except LeaseLost: raise
+    except JobCancelled: cancelled = True; raise
+    except Exception as e: LOGGER.error(f"Torrent download failed: {e}"); return None, 0, []
+    finally:
+        # After a failure the resume data stays, so sending the link again continues the download; after a cancel
+        # neither it nor the partial files are wanted any more.
+        if handle is not None: engine.remove(handle, keep_resume=not cancelled, delete_files=cancelled)
 
-def upload_file(filepath, final_filename, update_status_callback, account_id, root_dir_id):
-    upload_url = f"https://w.buzzheavier.com/{root_dir_id}/{final_filename}"
+def _sendfile_put(upload_url, data, headers):
+    """PUTs a FileUploadSource over plain HTTP with socket.sendfile(), so the file goes from the page cache
+    to the socket without being copied through Python. Returns (status_code, body_text)."""
+    parts = urlsplit(requests.utils.requote_uri(upload_url))
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=HTTP_CONNECT_TIMEOUT)
+    try:
+        conn.connect(); conn.sock.settimeout(HTTP_READ_TIMEOUT)
+        conn.putrequest('PUT', f"{parts.path}?{parts.query}" if parts.query else parts.path, skip_accept_encoding=True)
+        for name, value in dict(headers, **{'User-Agent': 'Mozilla/5.0', 'Content-Length': str(data.size)}).items(): conn.putheader(name, value)
+        conn.endheaders()
+        try:
+            while data.read_so_far < data.size:
+                sent = conn.sock.sendfile(data.raw, data.read_so_far, min(UPLOAD_BLOCK_SIZE, data.size - data.read_so_far))
+                if not sent: raise IOError(f"{data.raw.name} shrank during upload")
+                data.advance(sent)
+        except ConnectionError as e:
+            # A server that rejects the PUT (e.g. 404 for a bad folder) may answer and close before reading the body;
+            # prefer its reply over the broken pipe so the rejection is not retried.
+            try: response = conn.getresponse()
+            except (OSError, http.client.HTTPException): raise e from None
+            return response.status, response.read().decode('utf-8', errors='replace')
+        conn.sock.settimeout(HTTP_UPLOAD_TIMEOUT)
+        response = conn.getresponse()
+        return response.status, response.read().decode('utf-8', errors='replace')
+    except http.client.HTTPException as e:
+        raise IOError(f"Upload connection failed: {e!r}") from e
+    finally:
+        conn.close()
+
+def _put_to_buzzheavier(data, final_filename, account_id, root_dir_id):
+    upload_url = f"{BUZZHEAVIER_UPLOAD_URL}/{root_dir_id}/{final_filename}"
     headers = {"Authorization": f"Bearer {account_id}"}
-    file_size = os.path.getsize(filepath)
+    if UPLOAD_SENDFILE and isinstance(data, FileUploadSource) and data.checksum is None and upload_url.startswith("http://"):
+        status_code, text = _sendfile_put(upload_url, data, headers)
+    else:
+        response = get_client().put(upload_url, data=data, headers=headers, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_UPLOAD_TIMEOUT))
+        status_code, text = response.status_code, response.text
+    if 400 <= status_code < 500 and status_code != 429:
+        raise UploadRejected(f"BuzzHeavier rejected the upload (HTTP {status_code}): {text[:200]}")
+    if status_code >= 400: raise requests.HTTPError(f"{status_code} Server Error for url: {upload_url}")
+    try:
+        response_data = json.loads(text)
+        file_id = response_data.get('data', {}).get('id')
+        if file_id:
+            buzz_link = f"https://buzzheavier.com/{file_id}"
+            LOGGER.info(f"Finished upload for: {final_filename}. Link: {buzz_link}")
+            return buzz_link
+        LOGGER.error(f"Upload HTTP status OK, but API response missing 'id' for {final_filename}: {text}")
+    except json.JSONDecodeError:
+        LOGGER.error(f"Upload HTTP status OK, but failed to decode JSON from API for {final_filename}: {text}")
+    return None
+
+def _upload_with_retries(open_body, final_filename, update_status_callback, account_id, root_dir_id):
+    """PUTs a fresh body from open_body() until BuzzHeavier confirms it. The endpoint only accepts whole files,
+    so after a dropped connection or a 5xx the body is re-sent from byte 0 after a backoff; 4xx is final.
+    Returns (size, link) or (None, None)."""
+    for attempt in range(UPLOAD_RETRIES + 1):
+        data = open_body()
+        try:
+            buzz_link = _put_to_buzzheavier(data, final_filename, account_id, root_dir_id)
+            return (len(data), buzz_link) if buzz_link else (None, None)
+        except (JobCancelled, UploadRejected): raise
+        except (requests.RequestException, IOError) as e:
+            if attempt == UPLOAD_RETRIES:
+                LOGGER.error(f"Upload failed for {final_filename} after {attempt + 1} attempts: {e}"); break
+            LOGGER.warning(f"Upload of {final_filename} interrupted after {format_bytes(data.read_so_far)} ({e}); retry {attempt + 1}/{UPLOAD_RETRIES} in {_backoff(attempt)}s")
+            update_status_callback(f"*Status:* Upload of `{escape_markdown(final_filename)}` interrupted, retrying in {_backoff(attempt)}s\.\.\.")
+            time.sleep(_backoff(attempt))
+        finally:
+            data.close()
+    return None, None
 
+def _upload_progress_callback(final_filename, update_status_callback):
     def progress_callback(uploaded, total, start_time):
         elapsed = time.time() - start_time; speed = uploaded / elapsed if elapsed > 0 else 0
         percentage = (uploaded / total) * 100 if total > 0 else 0
         eta = ((total - uploaded) / speed) if speed > 0 else -1
         msg = (f"*Status:* Uploading `{escape_markdown(final_filename)}`\n"
                f"{progress_bar(percentage)} {escape_markdown(f'{percentage:.2f}%')}\n"
-               f"`{escape_markdown(format_bytes(uploaded))}` of `{escape_markdown(format_bytes(file_size))}`\n"
+               f"`{escape_markdown(format_bytes(uploaded))}` of `{escape_markdown(format_bytes(total))}`\n"
                f"*Speed:* {escape_markdown(f'{format_bytes(speed)}/s')}\n*ETA:* {escape_markdown(format_time(eta))}")
         update_status_callback(msg)
+    return progress_callback
+
+def upload_file(filepath, final_filename, update_status_callback, account_id, root_dir_id, user_id=None, checksum=None):
+    """`checksum`, if given, ends up holding the digests of the bytes sent by the successful attempt."""
     try:
         LOGGER.info(f"Starting upload for: {final_filename}")
-        with open(filepath, 'rb') as f:
-            data = UploadProgressTracker(f, progress_callback, file_size)
-            response = requests.put(upload_url, data=data, headers=headers, timeout=10800)
-            response.raise_for_status()
-        try:
-            response_data = response.json()
-            file_id = response_data.get('data', {}).get('id')
-            if file_id:
-                buzz_link = f"https://buzzheavier.com/{file_id}"
-                LOGGER.info(f"Finished upload for: {final_filename}. Link: {buzz_link}")
-                return file_size, buzz_link
-            else:
-                LOGGER.error(f"Upload HTTP status OK, but API response missing 'id' for {final_filename}: {response.text}")
-                return None, None
-        except json.JSONDecodeError:
-            LOGGER.error(f"Upload HTTP status OK, but failed to decode JSON from API for {final_filename}: {response.text}")
-            return None, None
+        progress = _upload_progress_callback(final_filename, update_status_callback)
+        throttle = get_shaper().throttler('up', user_id)
+        return _upload_with_retries(lambda: FileUploadSource(filepath, progress, UPLOAD_BLOCK_SIZE, throttle=throttle, checksum=checksum),
+                                    final_filename, update_status_callback, account_id, root_dir_id)
+    except JobCancelled: raise
     except Exception as e:
         LOGGER.error(f"Upload failed for {final_filename}: {e}")
         return None, None
 
+def upload_tar(files, archive_name, update_status_callback, account_id, root_dir_id, user_id=None, checksum=None):
+    """Uploads (path, arcname, size) files as one tar archive that is generated while the PUT reads it."""
+    try:
+        LOGGER.info(f"Starting streamed tar upload for: {archive_name} ({len(files)} files)")
+        progress = _upload_progress_callback(archive_name, update_status_callback)
+        throttle = get_shaper().throttler('up', user_id)
+        return _upload_with_retries(lambda: TarStream([(path, arcname) for path, arcname, _ in files], progress, UPLOAD_BLOCK_SIZE,
+                                                      throttle=throttle, checksum=checksum),
+                                    archive_name, update_status_callback, account_id, root_dir_id)
+    except JobCancelled: raise
+    except Exception as e:
+        LOGGER.error(f"Upload failed for {archive_name}: {e}")
+        return None, None
 
-def worker_task(url, final_filename, user_id, chat_id, context, account_id, root_dir_id, update_status_callback, on_complete_callback):
+def stream_http_upload(url, final_filename, update_status_callback, account_id, root_dir_id, user_id=None, checksum=None):
+    """Pipes an HTTP download straight into the BuzzHeavier PUT without touching disk.
+    Returns (size, link) on success and (None, None) when the caller should fall back to the staged path."""
+    try:
+        r = get_client().get(url, stream=True, allow_redirects=True)
+        r.raise_for_status()
+    except requests.RequestException as e:
+        LOGGER.warning(f"Stream source request failed for {final_filename}: {e}")
+        return None, None
+    with r:
+        total_size = int(r.headers.get('content-length', 0))
+        # iter_content decodes Content-Encoding, so the byte count would no longer match Content-Length.
+        if total_size <= 0 or r.headers.get('content-encoding', 'identity') != 'identity':
+            LOGGER.info(f"No usable Content-Length for {final_filename}; using staged download.")
+            return None, None
+        if checksum is not None: checksum.reset(); checksum.expect(_source_digests(r.headers))
+        downloaded = [0]
+
+        def progress_callback(uploaded, total, start_time):
+            elapsed = time.time() - start_time; speed = uploaded / elapsed if elapsed > 0 else 0
+            dl_pct = (downloaded[0] / total) * 100; ul_pct = (uploaded / total) * 100
+            eta = ((total - uploaded) / speed) if speed > 0 else -1
+            msg = (f"*Status:* Streaming `{escape_markdown(final_filename)}`\n"
+                   f"*Download:* {progress_bar(dl_pct)} {escape_markdown(f'{dl_pct:.2f}%')}\n"
+                   f"*Upload:* {progress_bar(ul_pct)} {escape_markdown(f'{ul_pct:.2f}%')}\n"
+                   f"`{escape_markdown(format_bytes(uploaded))}` of `{escape_markdown(format_bytes(total))}`\n"
+                   f"*Speed:* {escape_markdown(f'{format_bytes(speed)}/s')}\n*ETA:* {escape_markdown(format_time(eta))}")
+            update_status_callback(msg)
+
+        pipe = StreamPipe(total_size, STREAM_BUFFER_CHUNKS, STREAM_STALL_TIMEOUT, progress_callback,
+                          throttle=get_shaper().throttler('up', user_id), checksum=checksum)
+
+        def pump():
+            try:
+                for chunk in r.iter_content(chunk_size=1024*1024):
+                    if chunk: pipe.feed(chunk); downloaded[0] += len(chunk); get_shaper().throttle('down', user_id, len(chunk))
+                if downloaded[0] != total_size:
+                    raise IOError(f"Source ended after {downloaded[0]} of {total_size} bytes")
+                pipe.finish()
+            except Exception as e:
+                pipe.finish(e)
+
+        LOGGER.info(f"Starting pass-through stream for: {final_filename}")
+        pump_thread = threading.Thread(target=pump, daemon=True); pump_thread.start()
+        try:
+            buzz_link = _put_to_buzzheavier(pipe, final_filename, account_id, root_dir_id)
+        except Exception as e:
+            LOGGER.warning(f"Pass-through upload failed for {final_filename}: {e}")
+            buzz_link = None
+        finally:
+            pipe.abort()
+        pump_thread.join(timeout=5)
+        if not buzz_link or pipe.read_so_far != total_size: return None, None
+        return total_size, buzz_link
+
+
+def _integrity_report(name, sent, received=None, torrent=False, size=None):
+    """Digests to keep with an upload. Raises IntegrityError when the bytes sent differ from the `size` bytes the
+    job downloaded, from their digests (`received`) or from a digest the source published."""
+    digests = sent.hexdigests(); verified = []
+    if size is not None and sent.size != size:
+        raise IntegrityError(f"{name} was uploaded with {sent.size} bytes but {size} were downloaded")
+    if received is not None:
+        if received.size != sent.size:
+            raise IntegrityError(f"only {received.size} of the {sent.size} bytes of {name} were hashed during the download")
+        theirs = received.hexdigests()
+        differing = [algorithm for algorithm, value in digests.items() if theirs.get(algorithm, value) != value]
+        if differing: raise IntegrityError(f"{name} changed between download and upload ({', '.join(differing)} differ)")
+        verified.append('download')
+    differing = sent.source_mismatches()
+    if differing: raise IntegrityError(f"{name} does not match the {', '.join(differing)} digest published by the source")
+    if any(algorithm in digests for algorithm in sent.expected): verified.append('source')
+    if torrent: verified.append('torrent')
+    digests['verified'] = verified
+    return digests
+
+def _verified(name, buzz_link, sent, integrity, received=None, torrent=False, size=None):
+    """Records the digests of a finished upload in `integrity` and returns the link, or None if verification failed."""
+    if not buzz_link or sent is None: return buzz_link
+    try:
+        integrity[name] = _integrity_report(name, sent, received, torrent, size)
+        return buzz_link
+    except IntegrityError as e:
+        LOGGER.error(f"Integrity check failed: {e}. The copy uploaded to {buzz_link} is not trusted.")
+        integrity[name] = {'error': str(e)}
+        return None
+
+def _run_http_job(url, final_filename, update_status_callback, account_id, root_dir_id, cleanup_paths, integrity, user_id=None):
+    """Generator returning (downloaded_bytes, uploads) where uploads is a list of (name, size, link-or-None);
+    downloaded is None on failure. Yields PHASE_UPLOAD once the staged download is on disk. Digests of
+    verified uploads (or the reason verification failed) are put into `integrity` by name."""
+    # A source that accepts ranges always goes through the journaled download, so a dropped connection resumes
+    # where it stopped instead of restarting the transfer, and a large one is fetched over several connections;
+    # only sources that cannot resume are piped through. The same probe then picks the download mode.
+    info = probe_http(url)
+    if STREAM_UPLOADS and not (info and info['ranges']) and not has_partial_download(os.path.join(DOWNLOAD_PATH, final_filename)):
+        sent = Checksum() if INTEGRITY_CHECKS else None
+        with metrics.phase('stream', url) as phase:
+            upload_size, buzz_link = stream_http_upload(url, final_filename, update_status_callback, account_id, root_dir_id, user_id, sent)
+            if buzz_link: phase.done(upload_size)
+        if buzz_link:
+            return upload_size, [(final_filename, upload_size, _verified(final_filename, buzz_link, sent, integrity))]
+        LOGGER.info(f"Pass-through unavailable for {final_filename}, falling back to staged download.")
+    received = Checksum() if INTEGRITY_CHECKS else None
+    with metrics.phase('download', url) as phase:
+        filepath, size = download_http(url, final_filename, update_status_callback, user_id, received, info)
+        if filepath: phase.done(size)
+    if not filepath: return None, []
+    if received is not None and received.size != size:
+        # Skipped or cut-short hashing (a download finished by an earlier attempt, a failed hashing thread): read back once.
+        try: _prime_checksum(received, filepath, size)
+        except OSError as e:
+            integrity[final_filename] = {'error': f"the download could not be verified ({e})"}
+            LOGGER.error(f"Discarding {filepath}: {integrity[final_filename]['error']}")
+            discard_partial_download(filepath)
+            return None, []
+    if received is not None and received.source_mismatches():
+        # Corrupt in transit: uploading it would only publish a bad copy, and a retry has to download it again anyway.
+        integrity[final_filename] = {'error': f"the download does not match the {', '.join(received.source_mismatches())} digest published by the source"}
+        LOGGER.error(f"Discarding {filepath}: {integrity[final_filename]['error']}")
+        discard_partial_download(filepath)
+        return None, []
+    LOGGER.info(f"Download complete. Size: {format_bytes(size)}. Starting upload...")
+    yield PHASE_UPLOAD
+    sent = Checksum(received.extra) if received is not None else None
+    if sent is not None: sent.expected = received.expected
+    with metrics.phase('upload', BUZZHEAVIER_UPLOAD_URL) as phase:
+        upload_size, buzz_link = upload_file(filepath, final_filename, update_status_callback, account_id, root_dir_id, user_id, sent)
+        buzz_link = _verified(final_filename, buzz_link, sent, integrity, received, size=size)
+        if buzz_link: phase.done(upload_size)
+    if buzz_link: cleanup_paths.extend([filepath, journal_path(filepath)])
+    else: LOGGER.info(f"Keeping {filepath} after the failed upload so a retry can skip the download.")
+    return size, [(final_filename, upload_size, buzz_link)]
+
+def _run_magnet_job(url, final_filename, options, update_status_callback, account_id, root_dir_id, cleanup_paths, integrity, user_id=None,
+                    submit_upload=None):
+    """Downloads the selected torrent files, then uploads them one by one as they complete ('each')
+    or as a single tar archive streamed from disk ('tar', the default for multi-file torrents).
+    libtorrent has already verified every piece against the torrent's hashes, so uploads are hashed on the way out only.
+    In 'each' mode the per-file uploads go through submit_upload(fn, *args) -> Future, the scheduler's upload pool."""
+    mode = options.get('mode', 'tar'); uploads = []; started = []; own_pool = None
+    if mode == 'each':
+        if submit_upload is None:
+            # Run outside a scheduler (run_inline): one upload at a time next to the download.
+            own_pool = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="upload"); submit_upload = own_pool.submit
+
+        def upload_completed_file(path, arcname, size):
+            name = os.path.basename(arcname)
+            sent = Checksum() if INTEGRITY_CHECKS else None
+            with metrics.phase('upload', BUZZHEAVIER_UPLOAD_URL) as phase:
+                upload_size, buzz_link = upload_file(path, name, update_status_callback, account_id, root_dir_id, user_id, sent)
+                buzz_link = _verified(name, buzz_link, sent, integrity, torrent=True, size=size)
+                if buzz_link: phase.done(upload_size)
+            uploads.append((name, upload_size, buzz_link))
+            if buzz_link and os.path.exists(path): os.remove(path)
+    try:
+        with metrics.phase('torrent') as phase:
+            path, size, files = download_magnet(url, final_filename, update_status_callback, file_indices=options.get('files'),
+                                                on_file_complete=(lambda *item: started.append(submit_upload(upload_completed_file, *item)))
+                                                if mode == 'each' else None, user_id=user_id)
+            if path: phase.done(size)
+    except BaseException:
+        # Files not picked up by the pool yet are not uploaded after a cancel; running uploads stop on their own.
+        for future in started: future.cancel()
+        raise
+    finally:
+        futures.wait(started)
+        if own_pool: own_pool.shutdown()
+    if not path: return None, uploads
+    cleanup_paths.append(path)
+    yield PHASE_UPLOAD
+    sent = Checksum() if INTEGRITY_CHECKS else None
+    if not os.path.isdir(path):
+        with metrics.phase('upload', BUZZHEAVIER_UPLOAD_URL) as phase:
+            upload_size, buzz_link = upload_file(path, final_filename, update_status_callback, account_id, root_dir_id, user_id, sent)
+            buzz_link = _verified(final_filename, buzz_link, sent, integrity, torrent=True, size=size)
+            if buzz_link: phase.done(upload_size)
+        return size, [(final_filename, upload_size, buzz_link)]
+    if mode == 'each': return size, uploads
+    archive_name = final_filename if final_filename.lower().endswith('.tar') else f"{final_filename}.tar"
+    with metrics.phase('upload', BUZZHEAVIER_UPLOAD_URL) as phase:
+        upload_size, buzz_link = upload_tar(files, archive_name, update_status_callback, account_id, root_dir_id, user_id, sent)
+        buzz_link = _verified(archive_name, buzz_link, sent, integrity, torrent=True)
+        if buzz_link: phase.done(upload_size)
+    return size, [(archive_name, upload_size, buzz_link)]
+
+def worker_task(url, final_filename, user_id, chat_id, store, send_message, account_id, root_dir_id, update_status_callback, on_complete_callback, options=None,
+                submit_upload=None):
+    """Generator: runs the download phase, yields PHASE_UPLOAD, then runs the upload phase, so the scheduler
+    can continue it in its upload pool. Use scheduler.run_inline() to run it on the current thread.
+    The task only talks to the outside through its arguments: send_message(chat_id, text) delivers a MarkdownV2
+    message, so the same task runs in the bot or in a worker process that relays everything through the queue.
+    `submit_upload` is the running scheduler's JobScheduler.submit_upload, for uploads started during the download phase."""
     LOGGER.info(f"[USER:{user_id}] Worker task started for file: {final_filename}")
-    filepath, size = None, 0
-    final_status = ""
+    cleanup_paths = []; integrity = {}
+    final_status = ""; outcome = 'error'; started = time.monotonic()
     try:
         update_status_callback(f"*Status:* Preparing task for `{escape_markdown(final_filename)}`\.")
         if url.startswith("magnet:"):
-            filepath, size = download_magnet(url, final_filename, update_status_callback)
+            size, uploads = yield from _run_magnet_job(url, final_filename, options or {}, update_status_callback, account_id, root_dir_id, cleanup_paths, integrity, user_id, submit_upload)
         else:
-            filepath, size = download_http(url, final_filename, update_status_callback)
-        if not filepath:
-            final_status = f"❌ *Download failed for* `{escape_markdown(final_filename)}`\."
+            size, uploads = yield from _run_http_job(url, final_filename, update_status_callback, account_id, root_dir_id, cleanup_paths, integrity, user_id)
+        errors = [f"{escape_markdown(report['error'])}\." for report in integrity.values() if 'error' in report]
+        if size is None and not uploads:
+            final_status = f"❌ *Download failed for* `{escape_markdown(final_filename)}`\."; outcome = 'download_failed'
+            if errors: final_status += f" {errors[0]}"
             update_status_callback(final_status)
             return
-        LOGGER.info(f"[USER:{user_id}] Download complete. Size: {format_bytes(size)}. Starting upload...")
-        with context.bot_data['data_lock']:
-            context.bot_data['stats']['downloaded'] += size
-        upload_size, buzz_link = upload_file(filepath, final_filename, update_status_callback, account_id, root_dir_id)
-        if upload_size and buzz_link:
-            with context.bot_data['data_lock']:
-                context.bot_data['stats']['uploaded'] += upload_size
-                context.bot_data['saved_links'][final_filename] = buzz_link
-                context.bot_data['save_stats']()
-            LOGGER.info(f"[USER:{user_id}] Upload complete for: {final_filename}")
-            final_message = f"✅ *Upload successful\!*\n\n*File:* `{escape_markdown(final_filename)}`\n*Link:* {escape_markdown(buzz_link)}"
-            context.bot.send_message(chat_id, final_message, parse_mode='MarkdownV2', disable_web_page_preview=True)
-            final_status = f"✅ *Task complete for:* `{escape_markdown(final_filename)}`"
-            update_status_callback(final_status)
+        done = [(name, upload_size, link) for name, upload_size, link in uploads if link]
+        store.add_counters(downloaded=size or 0, uploaded=sum(upload_size for _, upload_size, _ in done))
+        for name, upload_size, link in done: store.record_link(name, link, user_id, upload_size, integrity.get(name))
+        if (options or {}).get('cache_key') and done and len(done) == len(uploads) and size is not None:
+            store.cache_put(options['cache_key'], done, size, DEDUP_MAX_ENTRIES)
+        for name, upload_size, link in done:
+            LOGGER.info(f"[USER:{user_id}] Upload complete for: {name}")
+            final_message = f"✅ *Upload successful\!*\n\n*File:* `{escape_markdown(name)}`\n*Link:* {escape_markdown(link)}"
+            if name in integrity: final_message += f"\n{get_integrity_lines(integrity[name])}"
+            send_message(chat_id, final_message)
+        if done and len(done) == len(uploads) and size is not None:
+            final_status = f"✅ *Task complete for:* `{escape_markdown(final_filename)}`"; outcome = 'complete'
+        elif done:
+            failed = [name for name, _, link in uploads if not link]
+            final_status = f"⚠️ *Task partly complete for* `{escape_markdown(final_filename)}`\. {len(failed)} upload\(s\) failed\."; outcome = 'partial'
         else:
-            final_status = f"❌ *Upload failed for* `{escape_markdown(final_filename)}`\."
-            update_status_callback(final_status)
+            final_status = f"❌ *Upload failed for* `{escape_markdown(final_filename)}`\."; outcome = 'upload_failed'
+            if errors: final_status += f" {errors[0]}"
+            if size is not None and has_partial_download(os.path.join(DOWNLOAD_PATH, final_filename)):
+                final_status += " The download is kept, so sending the same link with the same name retries only the upload\."
+        update_status_callback(final_status)
+    except LeaseLost:
+        # The worker that took the job over is using the same files; leave all of them to it.
+        LOGGER.info(f"[USER:{user_id}] Job for {final_filename} is now run by another worker; stopping here.")
+        final_status = f"🔁 *Moved to another worker:* `{escape_markdown(final_filename)}`"; outcome = 'lease_lost'
+        cleanup_paths.clear()
+    except JobCancelled:
+        LOGGER.info(f"[USER:{user_id}] Job for {final_filename} was cancelled.")
+        final_status = f"🚫 *Cancelled:* `{escape_markdown(final_filename)}`"; outcome = 'cancelled'
+        if not url.startswith("magnet:"): discard_partial_download(os.path.join(DOWNLOAD_PATH, final_filename))
     except Exception as e:
         LOGGER.error(f"[USER:{user_id}] Unhandled exception in worker_task for {final_filename}: {e}", exc_info=True)
         final_status = f"❌ *An unexpected error occurred for* `{escape_markdown(final_filename)}`\."
@@ -188,11 +884,13 @@ def worker_task(url, final_filename, user_id, chat_id, context, account_id, root
         except Exception:
             pass
     finally:
-        if filepath and os.path.exists(filepath):
-            os.remove(filepath)
-            LOGGER.info(f"Cleaned up local file: {filepath}")
+        for path in cleanup_paths:
+            if os.path.isdir(path): shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path): os.remove(path)
+            LOGGER.info(f"Cleaned up local file: {path}")
         if not final_status:
             final_status = f" A task for `{escape_markdown(final_filename)}` finished with an unknown state\."
             LOGGER.warning(f"[USER:{user_id}] Worker for {final_filename} finished without a final status.")
+        metrics.JOBS.labels(outcome).inc(); metrics.JOB_SECONDS.labels(outcome).observe(time.monotonic() - started)
         on_complete_callback(final_status)
         LOGGER.info(f"[USER:{user_id}] Worker task finished for file: {final_filename}")
@@ -0,0 +1,60 @@
+# test_uploads.py
+
+"""Upload retry behaviour against the local BuzzHeavier stand-in (standin.py) with injected faults."""
+
+import os
+import hashlib
+
+import pytest
+
+import tasks
+from netclient import init_client
+from standin import start_standin, ROOT_DIR_ID
+from utils import Checksum, FileUploadSource
+
+SIZE = 3 * 1024 * 1024 + 123
+
+@pytest.fixture(scope='module', autouse=True)
+def client():
+    init_client()
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'upload.bin'; data = os.urandom(SIZE)
+    path.write_bytes(data)
+    return str(path), hashlib.sha256(data).hexdigest()
+
+def _upload(monkeypatch, source, checksum=None, **faults):
+    server = start_standin(**faults)
+    monkeypatch.setattr(tasks, 'BUZZHEAVIER_UPLOAD_URL', f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setattr(tasks, 'HTTP_RETRY_BACKOFF', 0)
+    statuses = []
+    open_body = lambda: FileUploadSource(source[0], lambda *args: None, 256 * 1024, checksum=checksum)
+    try: return server, statuses, tasks._upload_with_retries(open_body, 'upload.bin', statuses.append, 'account', ROOT_DIR_ID)
+    finally: server.shutdown(); server.server_close()
+
+@pytest.mark.parametrize('checksum', [None, Checksum()], ids=['sendfile', 'hashed'])
+def test_retries_after_drops_and_503s(monkeypatch, source, checksum):
+    server, statuses, (size, link) = _upload(monkeypatch, source, checksum, drop_after=1024 * 1024, drops=2, failures=1)
+    upload = server.uploads['upload.bin']
+    assert size == SIZE and link == f"https://buzzheavier.com/{upload['sha256'][:12]}"
+    assert upload == {'size': SIZE, 'sha256': source[1], 'attempts': 4}
+    assert len(statuses) == 3
+    if checksum is not None: assert checksum.size == SIZE and checksum.hexdigests()['sha256'] == source[1]
+
+def test_gives_up_after_upload_retries(monkeypatch, source):
+    server, statuses, result = _upload(monkeypatch, source, drop_after=64 * 1024, drops=tasks.UPLOAD_RETRIES + 1)
+    assert result == (None, None)
+    assert 'upload.bin' not in server.uploads and server.attempts['upload.bin'] == tasks.UPLOAD_RETRIES + 1
+
+@pytest.mark.parametrize('checksum', [None, Checksum()], ids=['sendfile', 'hashed'])
+def test_client_errors_are_not_retried(monkeypatch, source, checksum):
+    monkeypatch.setattr(tasks, 'HTTP_RETRY_BACKOFF', 0)
+    server = start_standin()
+    monkeypatch.setattr(tasks, 'BUZZHEAVIER_UPLOAD_URL', f"http://127.0.0.1:{server.server_port}")
+    try:
+        with pytest.raises(tasks.UploadRejected):
+            tasks._upload_with_retries(lambda: FileUploadSource(source[0], lambda *args: None, 256 * 1024, checksum=checksum), 'upload.bin',
+                                       lambda text: None, 'account', 'no-such-folder')
+    finally: server.shutdown(); server.server_close()
+    assert server.attempts == {}
@@ -8,10 +8,14 @@ def get_welcome_message():
         "I can download files from direct links or magnets and upload them to BuzzHeavier for you\.\n\n"
         "*Commands:*\n"
         "/send \- Start a new download job\.\n"
-        "/info \- Get a live status of your current job\.\n"
+        "/batch \- Submit many links at once\.\n"
+        "/info \- Get a live status of your jobs\.\n"
+        "/jobs \- List queued and running jobs, or cancel one\.\n"
         "/savedlinks \- View completed upload links\.\n"
+        "/find \- Search saved links by file name\.\n"
         "/stats \- View all\-time data usage\.\n"
         "/h \- Check server status\.\n"
+        "/limit \- Show or change bandwidth limits \(admins\)\.\n"
         "/cancel \- Cancel the current operation\."
     )
 
@@ -21,16 +25,48 @@ def get_stats_message(stats):
         f"*\-\-\- All\-Time Statistics \-\-\-*\n"
         f"*Total Downloaded:* {escape_markdown(format_bytes(stats['downloaded']))}\n"
         f"*Total Uploaded:* {escape_markdown(format_bytes(stats['uploaded']))}\n"
-        f"*Total Bandwidth Used:* {escape_markdown(format_bytes(total_bw))}"
+        f"*Total Bandwidth Used:* {escape_markdown(format_bytes(total_bw))}\n\n"
+        f"{get_dedup_stats_line(stats)}"
     )
 
-def get_server_status_message(total, used, free, total_bw):
+def get_dedup_stats_line(stats):
+    hits = stats.get('dedup_hits', 0); lookups = hits + stats.get('dedup_misses', 0)
+    rate = f"{hits * 100 / lookups:.1f}%" if lookups else "n/a"
+    return (
+        f"*Dedup Cache:* {stats.get('dedup_entries', 0)} entries, {hits}/{lookups} hits \({escape_markdown(rate)}\)\n"
+        f"*Bandwidth Saved:* {escape_markdown(format_bytes(stats.get('dedup_saved', 0)))}"
+    )
+
+def get_cached_upload_message(uploads):
+    return "\n\n".join(
+        f"♻️ *Already uploaded\!*\n\n*File:* `{escape_markdown(name)}`\n*Link:* {escape_markdown(link)}" for name, _, link in uploads
+    )
+
+def _format_rate(rate):
+    return escape_markdown(f"{format_bytes(rate)}/s") if rate else "unlimited"
+
+def get_limits_message(limits, user_limits, reserve):
+    return (
+        f"*\-\-\- Bandwidth Limits \-\-\-*\n"
+        f"*Global:* ↓ {_format_rate(limits['down'])} ↑ {_format_rate(limits['up'])}\n"
+        f"*Per User:* ↓ {_format_rate(user_limits['down'])} ↑ {_format_rate(user_limits['up'])}\n"
+        f"*Control Reserve:* {_format_rate(reserve)}\n\n"
+        f"Usage: `/limit global|user down|up <rate>` or `/limit reserve <rate>`, e\.g\. `/limit global up 20M`\. "
+        f"Use `0` for unlimited\."
+    )
+
+def get_server_status_message(total, used, free, total_bw, http_stats, rates, limits):
+    reuse = f"{http_stats['reused'] * 100 / http_stats['requests']:.1f}%" if http_stats['requests'] else "n/a"
     return (
         f"*\-\-\- Server Status \-\-\-*\n"
         f"*Disk Total:* {escape_markdown(format_bytes(total))}\n"
         f"*Disk Used:* {escape_markdown(format_bytes(used))}\n"
         f"*Disk Free:* {escape_markdown(format_bytes(free))}\n\n"
-        f"*Bandwidth Used by Bot:* {escape_markdown(format_bytes(total_bw))}"
+        f"*Bandwidth Used by Bot:* {escape_markdown(format_bytes(total_bw))}\n"
+        f"*Current Rate:* ↓ {escape_markdown(format_bytes(rates['down']))}/s of {_format_rate(limits['down'])}, "
+        f"↑ {escape_markdown(format_bytes(rates['up']))}/s of {_format_rate(limits['up'])}\n"
+        f"*HTTP Connections:* {http_stats['connections']} opened for {http_stats['requests']} requests "
+        f"\({escape_markdown(reuse)} reused, {http_stats['pools']} host pools\)"
     )
 
 def get_filename_choice_message(original, smart, short):
@@ -41,3 +77,78 @@ def get_filename_choice_message(original, smart, short):
         f"3\. *Short Name*: `{escape_markdown(short)}`\n"
         f"4\. *Custom Name*: \(You will provide this\)"
     )
+
+
+def get_file_selection_message(torrent_name, files, selected, page, per_page):
+    selected_size = sum(size for index, _, size in files if index in selected)
+    pages = (len(files) + per_page - 1) // per_page
+    return (
+        f"*Select files from* `{escape_markdown(torrent_name)}`\n"
+        f"{len(selected)} of {len(files)} files selected \({escape_markdown(format_bytes(selected_size))}\)\n"
+        f"Page {page + 1}/{pages}\. Unselected files are never downloaded\.\n\n"
+        f"Tap files to toggle them, then choose how to upload\."
+    )
+
+def get_saved_links_message(entries, page, pages, total, query=None):
+    # Names are shortened so a full page of escaped entries stays well under Telegram's 4096-character limit.
+    header = "*\-\-\- Saved Links \-\-\-*" if query is None else f"*Links matching* `{escape_markdown(query)}`"
+    lines = [f"{header}\n{total} link{'s' if total != 1 else ''}, page {page + 1}/{pages}\n"]
+    for entry in entries:
+        name = entry['filename'] if len(entry['filename']) <= 120 else f"{entry['filename'][:119]}…"
+        lines.append(f"*File:* `{escape_markdown(name)}`\n*Link:* {escape_markdown(entry['link'])}\n")
+    return "\n".join(lines)
+
+INTEGRITY_LABELS = {'sha256': "SHA\-256", 'xxh3': "XXH3", 'crc32': "CRC32", 'md5': "MD5"}
+INTEGRITY_SOURCES = {'source': "source digest", 'download': "downloaded bytes", 'torrent': "torrent pieces"}
+
+def get_integrity_lines(report):
+    if 'error' in report: return f"*Integrity:* {escape_markdown(report['error'])}"
+    lines = [f"*{label}:* `{report[name]}`" for name, label in INTEGRITY_LABELS.items() if name in report]
+    verified = [INTEGRITY_SOURCES[name] for name in report.get('verified', ())]
+    if verified: lines.append(f"*Verified against:* {escape_markdown(', '.join(verified))}")
+    return "\n".join(lines)
+
+BATCH_ICONS = {'done': "✅", 'partial': "⚠️", 'failed': "❌", 'cancelled': "🚫", 'cached': "♻️", 'skipped': "⛔",
+               'queued': "⏳", 'downloading': "⬇️", 'uploading': "⬆️"}
+BATCH_LINES = 20
+
+def get_batch_prompt_message(max_links):
+    return (f"Send me up to {max_links} URLs or magnet links, separated by spaces or new lines, "
+            f"or upload a \\.txt file that lists them\\.")
+
+def get_batch_resolving_message(done, total):
+    return f"_Fetching file details: {done} of {total} links\\.\\.\\._"
+
+def get_batch_choice_message(names, failed, total_size, samples):
+    lines = [f"*Batch of {len(names)} file{'s' if len(names) != 1 else ''}* \\({escape_markdown(format_bytes(total_size))} known\\)"]
+    if failed:
+        lines.append(f"{len(failed)} link{'s' if len(failed) != 1 else ''} skipped:")
+        lines += [f"• `{escape_markdown(url[:60])}`: {escape_markdown(error)}" for url, error in failed[:5]]
+        if len(failed) > 5: lines.append(f"• \\.\\.\\. and {len(failed) - 5} more")
+    lines.append("\n*Choose how to name all of them*, e\\.g\\. for the first file:")
+    lines += [f"{label}: `{escape_markdown(samples[policy])}`" for policy, label in (('full', "Full"), ('smart', "Smart"), ('short', "Short"))]
+    return "\n".join(lines)
+
+def get_batch_status_message(entries):
+    """`entries` are (filename, size, state) with state one of BATCH_ICONS."""
+    counts = {}
+    for _, _, state in entries: counts[state] = counts.get(state, 0) + 1
+    finished = sum(counts.get(state, 0) for state in ('done', 'partial', 'failed', 'cancelled', 'cached', 'skipped'))
+    done_size = sum(size or 0 for _, size, state in entries if state in ('done', 'cached'))
+    lines = [f"*Batch:* {finished} of {len(entries)} finished, {escape_markdown(format_bytes(done_size))} uploaded",
+             " ".join(f"{BATCH_ICONS[state]} {counts[state]}" for state in BATCH_ICONS if counts.get(state)), ""]
+    # Unfinished jobs first, so the interesting lines survive the cut.
+    ordered = sorted(entries, key=lambda entry: entry[2] not in ('downloading', 'uploading', 'queued'))
+    lines += [f"{BATCH_ICONS[state]} `{escape_markdown(name[:60])}`" for name, _, state in ordered[:BATCH_LINES]]
+    if len(entries) > BATCH_LINES: lines.append(f"\\.\\.\\. and {len(entries) - BATCH_LINES} more")
+    return "\n".join(lines)
+
+def get_jobs_message(jobs_with_positions):
+    blocks = []
+    for job, position in jobs_with_positions:
+        if job.state == 'queued':
+            waiting = f" \\(waiting for {escape_markdown(job.waiting_for)}\\)" if job.waiting_for else ""
+            blocks.append(f"*Queued \\#{position}{waiting}:* `{escape_markdown(job.filename)}`")
+        else:
+            blocks.append(job.status_text)
+    return "\n\n".join(blocks)
\ No newline at end of file
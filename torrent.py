@@ -0,0 +1,308 @@
+# torrent.py
+
+import os
+import time
+import atexit
+import importlib
+import threading
+
+from utils import LOGGER
+from shaper import get_shaper
+from metrics import Gauge
+from config import (
+    TORRENT_LISTEN_INTERFACES, TORRENT_CONNECTIONS_LIMIT, TORRENT_DOWNLOAD_LIMIT,
+    TORRENT_UPLOAD_LIMIT, TORRENT_STATE_FILE, TORRENT_RESUME_PATH, TORRENT_CACHE_PATH,
+    TORRENT_RESUME_INTERVAL, PREALLOCATE_FILES
+)
+
+_engine = None
+_engine_lock = threading.Lock()
+
+class _LazyModule:
+    """Imports the named module on first attribute access. Loading libtorrent (and the boost and OpenSSL libraries
+    behind it) is a noticeable part of a cold start, and plenty of runs never see a magnet link."""
+    def __init__(self, name): self._name = name; self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+            LOGGER.info(f"Loaded {self._name} {getattr(self._module, '__version__', '')}")
+        return getattr(self._module, attr)
+
+lt = _LazyModule('libtorrent')
+
+def hash_key(obj):
+    """Stable string key for an add_torrent_params, torrent_handle or torrent_info across libtorrent 1.2 and 2.x."""
+    hashes = getattr(obj, 'info_hashes', None)
+    if hashes is not None:
+        hashes = hashes() if callable(hashes) else hashes
+        return str(hashes.get_best())
+    info_hash = obj.info_hash
+    return str(info_hash() if callable(info_hash) else info_hash)
+
+class TorrentError(RuntimeError):
+    pass
+
+def magnet_key(magnet_link):
+    return hash_key(lt.parse_magnet_uri(magnet_link))
+
+def file_progress(handle):
+    """Per-file completed bytes, counted in whole verified pieces (much cheaper than byte granularity)."""
+    return handle.file_progress(flags=lt.torrent_handle.piece_granularity)
+
+def list_torrent_files(info):
+    """Returns (index, path, size) for every real file in a torrent, skipping BEP 47 pad files."""
+    fs = info.files(); pad_flag = getattr(lt.file_storage, 'flag_pad_file', 0)
+    return [(i, fs.file_path(i), fs.file_size(i)) for i in range(fs.num_files()) if not fs.file_flags(i) & pad_flag]
+
+class TorrentEngine:
+    """Owns the single process-wide libtorrent session. Jobs add and remove handles on it and block on
+    per-torrent events that a dedicated thread fills in from pop_alerts(), instead of polling handle.status()."""
+    def __init__(self, state_file, resume_path, cache_path):
+        self._state_file = state_file
+        self._resume_path = resume_path; self._cache_path = cache_path
+        for path in (resume_path, cache_path): os.makedirs(path, exist_ok=True)
+        self._pending_saves = 0
+        self._ses = lt.session(self._load_session_params())
+        self._ses.apply_settings({
+            'listen_interfaces': TORRENT_LISTEN_INTERFACES,
+            'enable_dht': True,
+            'connections_limit': TORRENT_CONNECTIONS_LIMIT,
+            'download_rate_limit': TORRENT_DOWNLOAD_LIMIT,
+            'upload_rate_limit': TORRENT_UPLOAD_LIMIT,
+            'alert_mask': lt.alert.category_t.status_notification | lt.alert.category_t.error_notification
+                          | lt.alert.category_t.storage_notification,
+        })
+        self._lock = threading.Condition()
+        self._torrents = {}
+        self._running = True
+        self._thread = threading.Thread(target=self._alert_loop, name="torrent-alerts", daemon=True)
+        self._thread.start()
+        LOGGER.info(f"Torrent engine started on {TORRENT_LISTEN_INTERFACES}")
+
+    def _load_session_params(self):
+        if not os.path.exists(self._state_file): return lt.session_params() if hasattr(lt, 'session_params') else {}
+        try:
+            with open(self._state_file, 'rb') as f: data = f.read()
+            if hasattr(lt, 'read_session_params'):
+                LOGGER.info("Restoring saved DHT state for the torrent session.")
+                return lt.read_session_params(data)
+        except Exception as e:
+            LOGGER.warning(f"Could not restore torrent session state: {e}")
+        return lt.session_params() if hasattr(lt, 'session_params') else {}
+
+    def set_rate_limits(self, download_limit, upload_limit):
+        """Applies the shaper's global caps to the session, never loosening the TORRENT_*_LIMIT settings."""
+        def tighter(a, b): return min(a, b) if a and b else a or b
+        self._ses.apply_settings({'download_rate_limit': tighter(TORRENT_DOWNLOAD_LIMIT, download_limit),
+                                  'upload_rate_limit': tighter(TORRENT_UPLOAD_LIMIT, upload_limit)})
+
+    def save_state(self):
+        try:
+            if hasattr(lt, 'write_session_params_buf'):
+                data = lt.write_session_params_buf(self._ses.session_state())
+            else:
+                data = lt.bencode(self._ses.save_state())
+            self._write_atomic(self._state_file, data)
+            LOGGER.info("Torrent session state saved to disk.")
+        except Exception as e:
+            LOGGER.error(f"Could not save torrent session state: {e}")
+
+    def add_torrent(self, params):
+        key = hash_key(params)
+        with self._lock:
+            if key in self._torrents: raise TorrentError("This torrent is already being downloaded by another job.")
+            self._torrents[key] = {'status': None, 'version': 0, 'metadata': params.ti is not None, 'finished': False, 'error': None}
+        try:
+            handle = self._ses.add_torrent(params)
+        except Exception:
+            with self._lock: self._torrents.pop(key, None)
+            raise
+        return handle
+
+    def _resume_file(self, key): return os.path.join(self._resume_path, f"{key}.fastresume")
+    def _cache_file(self, key): return os.path.join(self._cache_path, f"{key}.torrent")
+
+    def _write_atomic(self, path, data):
+        # Worker processes share the resume and metadata directories, so each writes under its own temporary name.
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f: f.write(data)
+        os.replace(tmp, path)
+
+    def add_magnet(self, magnet_link, save_path, file_priorities=None):
+        """Adds a magnet, preferring saved fast-resume data and then cached metadata so neither the
+        metadata phase nor a full piece recheck has to be repeated."""
+        params = lt.parse_magnet_uri(magnet_link); key = hash_key(params)
+        resume_file = self._resume_file(key); cache_file = self._cache_file(key)
+        if os.path.exists(resume_file):
+            try:
+                with open(resume_file, 'rb') as f: resumed = lt.read_resume_data(f.read())
+                if resumed.ti is None and os.path.exists(cache_file): resumed.ti = lt.torrent_info(cache_file)
+                resumed.trackers = list(set(resumed.trackers) | set(params.trackers))
+                LOGGER.info(f"Loaded fast-resume data for torrent {key}")
+                params = resumed
+            except Exception as e:
+                LOGGER.warning(f"Ignoring unusable fast-resume data for {key}: {e}")
+        if params.ti is None and os.path.exists(cache_file):
+            try:
+                params.ti = lt.torrent_info(cache_file)
+                LOGGER.info(f"Using cached metadata for torrent {key}; skipping metadata download.")
+            except Exception as e:
+                LOGGER.warning(f"Ignoring unusable cached metadata for {key}: {e}")
+        params.save_path = save_path
+        # Full allocation makes libtorrent fallocate selected files up front: no fragmentation, and no ENOSPC mid-download.
+        if PREALLOCATE_FILES: params.storage_mode = lt.storage_mode_t.storage_mode_allocate
+        if file_priorities is not None and params.ti is not None: params.file_priorities = file_priorities
+        return self.add_torrent(params)
+
+    def cached_info(self, key):
+        """Returns torrent_info from the metadata cache or saved resume data without touching the session."""
+        try:
+            if os.path.exists(self._cache_file(key)): return lt.torrent_info(self._cache_file(key))
+            if os.path.exists(self._resume_file(key)):
+                with open(self._resume_file(key), 'rb') as f: return lt.read_resume_data(f.read()).ti
+        except Exception as e:
+            LOGGER.warning(f"Could not read cached metadata for {key}: {e}")
+        return None
+
+    def fetch_metadata(self, magnet_link, save_path, timeout):
+        """Resolves a magnet's metadata (for file selection) without downloading any payload.
+        The metadata_received_alert handler caches it, so the real job starts without a metadata phase."""
+        params = lt.parse_magnet_uri(magnet_link); key = hash_key(params)
+        info = self.cached_info(key)
+        if info is not None: return info
+        params.save_path = save_path; params.flags |= lt.torrent_flags.upload_mode
+        handle = self.add_torrent(params)
+        try:
+            if not self.wait_for_metadata(handle, timeout): return None
+            return handle.torrent_file()
+        finally:
+            self.remove(handle)
+
+    def _request_resume_save(self, handle, flags=0):
+        try:
+            if handle.is_valid() and handle.status().has_metadata:
+                handle.save_resume_data(flags | lt.save_resume_flags_t.save_info_dict); return True
+        except Exception as e:
+            LOGGER.warning(f"Could not request resume data: {e}")
+        return False
+
+    def _save_all_resume_data(self, flags=0):
+        requested = 0
+        for handle in self._ses.get_torrents():
+            if handle.need_save_resume_data() and self._request_resume_save(handle, flags): requested += 1
+        with self._lock: self._pending_saves += requested
+        return requested
+
+    def remove(self, handle, keep_resume=False, delete_files=False):
+        """Drops the torrent from the session. Its resume data is deleted unless `keep_resume` is set, which a job
+        that failed uses so the next attempt continues from the pieces already on disk. `delete_files` also has
+        libtorrent delete the torrent's files from the save path, for a job the user cancelled."""
+        key = hash_key(handle)
+        with self._lock:
+            self._torrents.pop(key, None); self._lock.notify_all()
+        try: self._ses.remove_torrent(handle, lt.session.delete_files) if delete_files else self._ses.remove_torrent(handle)
+        except Exception as e: LOGGER.warning(f"Could not remove torrent {key}: {e}")
+        # A finished or cancelled job's files are moved or abandoned, so its resume data no longer describes anything on disk.
+        if not keep_resume and os.path.exists(self._resume_file(key)): os.remove(self._resume_file(key))
+
+    def _wait(self, handle, predicate, timeout):
+        key = hash_key(handle); deadline = time.time() + timeout if timeout else None
+        with self._lock:
+            while True:
+                entry = self._torrents.get(key)
+                if entry is None: raise TorrentError("Torrent was removed from the session.")
+                if entry['error']: raise TorrentError(entry['error'])
+                if predicate(entry): return entry
+                remaining = deadline - time.time() if deadline else None
+                if remaining is not None and remaining <= 0: return entry
+                self._lock.wait(remaining)
+
+    def wait_for_metadata(self, handle, timeout=None):
+        return self._wait(handle, lambda e: e['metadata'], timeout)['metadata']
+
+    def wait_for_update(self, handle, since_version, timeout=2):
+        """Blocks until a newer status snapshot arrives or the torrent finishes; returns the entry."""
+        return self._wait(handle, lambda e: e['finished'] or e['version'] > since_version, timeout)
+
+    def stats(self):
+        """Totals over the latest status snapshots from the alert thread; makes no libtorrent calls."""
+        with self._lock:
+            count = len(self._torrents); statuses = [entry['status'] for entry in self._torrents.values() if entry['status'] is not None]
+        return {'torrents': count, 'peers': sum(status.num_peers for status in statuses), 'seeds': sum(status.num_seeds for status in statuses),
+                'down': sum(status.download_payload_rate for status in statuses), 'up': sum(status.upload_payload_rate for status in statuses)}
+
+    def _alert_loop(self):
+        last_post = 0; last_resume_save = time.time()
+        while self._running:
+            try:
+                if time.time() - last_post >= 1:
+                    self._ses.post_torrent_updates(); last_post = time.time()
+                if time.time() - last_resume_save >= TORRENT_RESUME_INTERVAL:
+                    self._save_all_resume_data(); last_resume_save = time.time()
+                self._ses.wait_for_alert(500)
+                alerts = self._ses.pop_alerts()
+                if not alerts: continue
+                with self._lock:
+                    for alert in alerts: self._dispatch(alert)
+                    self._lock.notify_all()
+            except Exception as e:
+                LOGGER.error(f"Torrent alert loop error: {e}")
+                time.sleep(1)
+
+    def _dispatch(self, alert):
+        if isinstance(alert, lt.state_update_alert):
+            for status in alert.status:
+                entry = self._torrents.get(hash_key(status.handle))
+                if entry:
+                    entry['status'] = status; entry['version'] += 1
+                    if status.is_seeding or status.is_finished: entry['finished'] = True
+            return
+        if isinstance(alert, (lt.save_resume_data_alert, lt.save_resume_data_failed_alert)):
+            self._pending_saves = max(self._pending_saves - 1, 0)
+            if isinstance(alert, lt.save_resume_data_alert):
+                try:
+                    key = hash_key(alert.handle)
+                    data = lt.write_resume_data_buf(alert.params) if hasattr(lt, 'write_resume_data_buf') else lt.bencode(alert.resume_data)
+                    self._write_atomic(self._resume_file(key), data)
+                except Exception as e: LOGGER.warning(f"Could not write resume data: {e}")
+            return
+        handle = getattr(alert, 'handle', None)
+        entry = self._torrents.get(hash_key(handle)) if handle is not None and handle.is_valid() else None
+        if entry is None: return
+        if isinstance(alert, lt.metadata_received_alert):
+            entry['metadata'] = True
+            try:
+                self._write_atomic(self._cache_file(hash_key(handle)), lt.bencode(lt.create_torrent(handle.torrent_file()).generate()))
+            except Exception as e: LOGGER.warning(f"Could not cache torrent metadata: {e}")
+        elif isinstance(alert, lt.torrent_finished_alert): entry['finished'] = True
+        elif isinstance(alert, (lt.torrent_error_alert, lt.metadata_failed_alert)):
+            entry['error'] = alert.message(); LOGGER.error(f"Torrent error: {alert.message()}")
+
+    def shutdown(self, timeout=10):
+        """Pauses the session and flushes resume data for every torrent so a restart can continue where it left off."""
+        self._ses.pause()
+        if self._save_all_resume_data(lt.save_resume_flags_t.flush_disk_cache):
+            deadline = time.time() + timeout
+            with self._lock:
+                while self._pending_saves > 0 and time.time() < deadline: self._lock.wait(deadline - time.time())
+        self._running = False
+        self.save_state()
+
+def get_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = TorrentEngine(TORRENT_STATE_FILE, TORRENT_RESUME_PATH, TORRENT_CACHE_PATH)
+            atexit.register(_engine.shutdown)
+            get_shaper().add_listener(_engine.set_rate_limits)
+            _register_metrics(_engine)
+        return _engine
+
+def _register_metrics(engine):
+    # Registered with the engine rather than at import, so scraping never starts a libtorrent session.
+    Gauge('securefetch_torrents', 'Torrents in the libtorrent session.', lambda: engine.stats()['torrents'])
+    Gauge('securefetch_torrent_peers', 'Connected peers (seeds included) across all torrents.', lambda: engine.stats()['peers'])
+    Gauge('securefetch_torrent_seeds', 'Connected seeds across all torrents.', lambda: engine.stats()['seeds'])
+    Gauge('securefetch_torrent_rate_bytes_per_second', 'Payload rate across all torrents.',
+          lambda: {direction: value for direction, value in engine.stats().items() if direction in ('down', 'up')}, ('direction',))
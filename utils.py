@@ -2,12 +2,27 @@
 
 import os
 import re
+import zlib
+import errno
+import hashlib
+import ctypes
+import ctypes.util
 import time
+import queue
+import tarfile
+import threading
 import requests
 import json
 import logging # NEW: Import logging
 from telegram.utils.helpers import escape_markdown as escape_markdown_v2
 
+from config import BUZZHEAVIER_API_URL
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 # NEW: Create a single, named logger for the entire application
 LOGGER = logging.getLogger("SecureFetchBot")
 
@@ -38,6 +53,28 @@ def setup_logger():
 
 DOWNLOAD_PATH = os.path.join(os.getcwd(), "downloads")
 
+_FALLOC_FL_KEEP_SIZE = 0x01
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+except (OSError, AttributeError, TypeError):
+    _libc = None
+
+def preallocate(fd, size, keep_size=False):
+    """Reserves disk blocks for the first `size` bytes of `fd`, so the file is laid out contiguously and a full
+    disk fails here instead of halfway through a download. keep_size leaves the apparent file size alone
+    (Linux only, used where the size on disk is the resume offset); otherwise the file is extended like ftruncate.
+    Raises OSError(ENOSPC) when the space is not there; silently does nothing where fallocate is unsupported."""
+    try:
+        if keep_size:
+            if _libc is not None and _libc.fallocate(fd, _FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        elif hasattr(os, 'posix_fallocate'): os.posix_fallocate(fd, 0, size)
+        else: os.ftruncate(fd, size)   # macOS and Windows: no block reservation, only the size
+    except OSError as e:
+        if e.errno == errno.ENOSPC: raise
+        if not keep_size: os.ftruncate(fd, size)
+
 def escape_markdown(text):
     return escape_markdown_v2(str(text), version=2)
 
@@ -54,6 +91,15 @@ def format_time(seconds):
     m, s = divmod(seconds, 60); h, m = divmod(m, 60)
     return f"{int(h):02d}:{int(m):02d}:{int(s):02d}"
 
+def parse_rate(text: str) -> int:
+    """Parses '0', '512K', '20M', '1.5G' (bytes per second, binary units) into an int; raises ValueError."""
+    text = text.strip().upper().rstrip('/S').rstrip('B')
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    multiplier = units.get(text[-1:], 1)
+    value = float(text[:-1] if text[-1:] in units else text)
+    if value < 0: raise ValueError("Rate cannot be negative")
+    return int(value * multiplier)
+
 def progress_bar(percentage):
     if percentage > 100: percentage = 100
     if percentage < 0: percentage = 0
@@ -72,12 +118,12 @@ def parse_filename(name):
     clean_name = ' '.join(name.split()).title()
     return f"{clean_name} ({' '.join(details)})" if details else clean_name
 
-def fetch_root_dir_id(account_id: str) -> str | None:
-    url = "https://buzzheavier.com/api/fs"
+def fetch_root_dir_id(account_id: str, client) -> str | None:
+    url = f"{BUZZHEAVIER_API_URL}/api/fs"
     headers = {"Authorization": f"Bearer {account_id}"}
     try:
         LOGGER.info("Fetching BuzzHeavier Root Directory ID...") # NEW
-        response = requests.get(url, headers=headers, timeout=10)
+        response = client.get(url, headers=headers, timeout=10)
         data = response.json()
         if response.status_code == 200 and data.get('code') == 200 and 'id' in data.get('data', {}):
             root_id = data['data']['id']
@@ -93,24 +139,394 @@ def fetch_root_dir_id(account_id: str) -> str | None:
         LOGGER.critical("Received invalid JSON from BuzzHeavier API.") # MODIFIED
     return None
 
-class UploadProgressTracker:
-    def __init__(self, file_object, callback, file_size):
-        self._file = file_object
-        self.size = file_size
-        self.read_so_far = 0
+def _account_tag(account_id):
+    # The cache file names the account it belongs to without storing the credential itself.
+    return hashlib.sha256(account_id.encode()).hexdigest()[:16]
+
+def cached_root_dir_id(account_id, path):
+    """Returns (root_id, age in seconds) from the file written by save_root_dir_id, or (None, None)."""
+    try:
+        with open(path, 'r') as f: data = json.load(f)
+        if data.get('account') == _account_tag(account_id) and data.get('id'): return data['id'], time.time() - float(data['fetched'])
+    except (OSError, ValueError, KeyError, TypeError): pass
+    return None, None
+
+def save_root_dir_id(account_id, root_id, path):
+    try:
+        temp_path = f"{path}.{os.getpid()}.tmp"   # worker processes may refresh it at the same time
+        with open(temp_path, 'w') as f: json.dump({'account': _account_tag(account_id), 'id': root_id, 'fetched': time.time()}, f)
+        os.replace(temp_path, path)
+    except OSError as e:
+        LOGGER.warning(f"Could not cache the BuzzHeavier Root ID: {e}")
+
+def resolve_root_dir_id(account_id, client, path, ttl, retry, on_ready):
+    """Calls on_ready(root_id) as soon as a root directory ID is known, without blocking the caller: right away with
+    the cached ID (even an expired one, the ID of an account's root folder practically never changes), then again
+    whenever a background fetch returns a different one. The fetch runs once the cache is older than `ttl` and
+    every `ttl` seconds after that; while the API is unreachable it is retried every `retry` seconds."""
+    current, age = cached_root_dir_id(account_id, path)
+    if current:
+        LOGGER.info(f"Using cached BuzzHeavier Root ID {current} ({age / 3600:.1f}h old).")
+        on_ready(current)
+
+    def revalidate(current, delay):
+        while True:
+            if delay > 0: time.sleep(delay)
+            root_id = fetch_root_dir_id(account_id, client)
+            if not root_id:
+                LOGGER.warning(f"BuzzHeavier Root ID not {'revalidated' if current else 'available yet'}; retrying in {retry}s.")
+                delay = retry; continue
+            save_root_dir_id(account_id, root_id, path); delay = ttl
+            if root_id != current: current = root_id; on_ready(root_id)
+
+    threading.Thread(target=revalidate, args=(current, ttl - age if current else 0), name="root-dir-id", daemon=True).start()
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, bursting up to `capacity`. Thread-safe.
+    A rate of 0 means unlimited for consume()/charge()."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_consume(self, amount=1):
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= amount:
+                self._tokens -= amount; return True
+            return False
+
+    def refund(self, amount=1):
+        """Gives back tokens taken by try_consume() for something that did not happen after all."""
+        with self._lock: self._tokens = min(self._tokens + amount, self.capacity)
+
+    def consume(self, amount):
+        """Blocks until the bucket is out of debt, then takes `amount`, which may push it into debt. Chunks
+        larger than the burst size therefore still average out to `rate`. Returns the seconds spent waiting."""
+        waited = 0
+        while True:
+            with self._lock:
+                if not self.rate: return waited
+                self._refill(time.monotonic())
+                if self._tokens >= 0:
+                    self._tokens -= amount; return waited
+                delay = min(-self._tokens / self.rate, 1)
+            time.sleep(delay); waited += delay
+
+    def charge(self, amount):
+        """Takes `amount` without waiting, for traffic that has already happened elsewhere."""
+        with self._lock:
+            if self.rate: self._refill(time.monotonic()); self._tokens -= amount
+
+    def set_rate(self, rate, capacity):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate; self.capacity = capacity; self._tokens = min(self._tokens, capacity)
+
+class Checksum:
+    """Incremental SHA-256 plus a fast non-cryptographic hash (XXH3-64 when the optional xxhash package is
+    installed, CRC32 otherwise), fed with the bytes a download or upload loop is moving anyway.
+    `expected` holds digests published by the source; expect() adds MD5 when that is the only one offered."""
+    def __init__(self, extra=()):
+        self.extra = tuple(extra); self.expected = {}
+        self.reset()
+
+    def reset(self):
+        self._sha256 = hashlib.sha256(); self._xxh = xxhash.xxh3_64() if xxhash else None; self._crc = 0
+        self._extra = {name: hashlib.new(name) for name in self.extra}
+        self.size = 0
+
+    def expect(self, digests):
+        self.expected = dict(digests or {})
+        if 'md5' in self.expected and 'sha256' not in self.expected and 'md5' not in self.extra:
+            self.extra += ('md5',); self.reset()
+
+    def update(self, data):
+        self._sha256.update(data)
+        if self._xxh is not None: self._xxh.update(data)
+        else: self._crc = zlib.crc32(data, self._crc)
+        for digest in self._extra.values(): digest.update(data)
+        self.size += len(data)
+
+    def hexdigests(self):
+        digests = {'sha256': self._sha256.hexdigest()}
+        if self._xxh is not None: digests['xxh3'] = self._xxh.hexdigest()
+        else: digests['crc32'] = f"{self._crc:08x}"
+        digests.update((name, digest.hexdigest()) for name, digest in self._extra.items())
+        return digests
+
+    def source_mismatches(self):
+        """Algorithms whose digest differs from the one the source published."""
+        digests = self.hexdigests()
+        return [name for name, value in self.expected.items() if name in digests and digests[name] != value]
+
+class _SampledProgress:
+    """Progress reporting shared by the upload bodies, which keep `read_so_far` and `size`: the callback gets
+    (read_so_far, size, start_time) at most every `report_every` bytes and 2 seconds, and always for the last byte."""
+    def _init_progress(self, callback, report_every):
         self._callback = callback
+        self._report_every = report_every; self._next_report = report_every
         self._start_time = time.time()
         self._last_update_time = 0
 
+    def _progress(self):
+        if not self._callback or (self.read_so_far < self._next_report and self.read_so_far < self.size): return
+        self._next_report = self.read_so_far + self._report_every
+        current_time = time.time()
+        if current_time - self._last_update_time > 2 or self.read_so_far >= self.size:
+            self._callback(self.read_so_far, self.size, self._start_time)
+            self._last_update_time = current_time
+
+class FileUploadSource(_SampledProgress):
+    """Upload body for a file on disk. Reads go through an unbuffered file into one reusable buffer, so no
+    bytes object is allocated per chunk, and progress is only sampled every `report_every` bytes.
+    The sendfile() fast path uses `raw` and `advance()` directly; it is only taken when no `checksum` is fed."""
+    def __init__(self, path, callback, block_size, report_every=8 * 1024 * 1024, throttle=None, checksum=None):
+        self.raw = open(path, 'rb', buffering=0)
+        self._throttle = throttle
+        self.checksum = checksum
+        if checksum is not None: checksum.reset()   # every upload attempt re-sends the file from byte 0
+        self.size = os.fstat(self.raw.fileno()).st_size
+        self.read_so_far = 0
+        self._view = memoryview(bytearray(block_size))
+        self._init_progress(callback, report_every)
+
     def read(self, size=-1):
-        chunk = self._file.read(size)
+        # The view aliases the shared buffer and is only valid until the next read(); http.client and
+        # urllib3 both sendall() a block before asking for the next one.
+        if size is None or size < 0 or size > len(self._view): size = len(self._view)
+        n = self.raw.readinto(self._view[:size]) or 0
+        if n:
+            if self.checksum is not None: self.checksum.update(self._view[:n])
+            self.advance(n)
+        return self._view[:n]
+
+    def advance(self, n):
+        self.read_so_far += n
+        if self._throttle: self._throttle(n)
+        self._progress()
+
+    def __len__(self):
+        return self.size
+
+    def close(self):
+        self.raw.close()
+
+class DiskWriter:
+    """Write-behind for downloads. Receiving threads take a buffer from a fixed pool (get_buffer), fill it from the
+    socket and submit() it with its file offset; one writer thread drains the buffers to `fd` with positional writes,
+    merging buffers that continue each other into a single pwritev of up to `max_write` bytes. A slow disk or a GC
+    pause only reaches the network once every buffer is waiting, memory stays at count * buffer_size, and no bytes
+    objects are allocated per chunk. `checksum`, if given, is fed the buffers in submission order, so it is only
+    meaningful for sequential writes."""
+    _STOP = object()
+
+    def __init__(self, fd, buffer_size, count, max_write, checksum=None, name="download"):
+        self._fd = fd
+        self._max_write = max_write
+        self.checksum = checksum
+        self.written = 0
+        self._free = queue.Queue()
+        for _ in range(count): self._free.put(bytearray(buffer_size))
+        self._pending = queue.Queue()
+        self._outstanding = 0
+        self._idle = threading.Condition()
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=f"writer-{name}", daemon=True)
+        self._thread.start()
+
+    def _raise(self):
+        if self._error is not None: raise self._error
+
+    def get_buffer(self):
+        """A free buffer; blocks while all of them are waiting to be written. Raises the writer's error, if any."""
+        while True:
+            self._raise()
+            try: return self._free.get(timeout=1)
+            except queue.Empty: continue
+
+    def release(self, buffer):
+        """Returns a buffer that ended up not being submitted."""
+        self._free.put(buffer)
+
+    def submit(self, buffer, length, offset, on_written=None):
+        """Queues buffer[:length] for writing at `offset`; on_written() is called on the writer thread once it is
+        in the file (not yet fsynced). The buffer must not be touched afterwards."""
+        self._raise()
+        with self._idle: self._outstanding += 1
+        self._pending.put((buffer, length, offset, on_written))
+
+    def flush(self):
+        """Waits until everything submitted so far has been written; raises the writer's error, if any."""
+        with self._idle:
+            while self._outstanding and not self._closed: self._idle.wait()
+        self._raise()
+
+    def close(self):
+        """Flushes and stops the writer thread. The file descriptor stays open; receiving threads that are still
+        running get an error from their next get_buffer() or submit()."""
+        try: self.flush()
+        finally:
+            self._pending.put(self._STOP); self._thread.join()
+            with self._idle:
+                self._closed = True; self._error = self._error or IOError("Download writer is closed")
+                self._idle.notify_all()
+
+    def _run(self):
+        held = None
+        while True:
+            item = held if held is not None else self._pending.get(); held = None
+            if item is self._STOP: return
+            batch = [item]; end = item[2] + item[1]; total = item[1]
+            while total < self._max_write:
+                try: following = self._pending.get_nowait()
+                except queue.Empty: break
+                if following is self._STOP or following[2] != end: held = following; break
+                batch.append(following); end += following[1]; total += following[1]
+            self._write(batch)
+
+    def _write(self, batch):
+        # After a failure the rest is only recycled, so flush() and the receiving threads see the error promptly.
+        if self._error is None:
+            try:
+                views = [memoryview(buffer)[:length] for buffer, length, _, _ in batch]
+                if self.checksum is not None:
+                    for view in views: self.checksum.update(view)
+                offset = batch[0][2]
+                while views:
+                    n = os.pwritev(self._fd, views, offset) if hasattr(os, 'pwritev') else os.pwrite(self._fd, views[0], offset)
+                    if n <= 0: raise IOError(f"Write at byte {offset} made no progress")
+                    offset += n; self.written += n
+                    while views and n >= len(views[0]): n -= len(views[0]); views.pop(0)
+                    if n: views[0] = views[0][n:]
+                for _, _, _, on_written in batch:
+                    if on_written: on_written()
+            except Exception as e:
+                self._error = e
+        for buffer, _, _, _ in batch: self._free.put(buffer)
+        with self._idle:
+            self._outstanding -= len(batch); self._idle.notify_all()
+
+class StreamStalled(IOError):
+    pass
+
+class StreamPipe(_SampledProgress):
+    """Bounded in-memory buffer between a download thread (feed) and an upload body (read)."""
+    def __init__(self, size, max_chunks, stall_timeout, callback=None, report_every=8 * 1024 * 1024, throttle=None, checksum=None):
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._throttle = throttle
+        self.checksum = checksum
+        self.size = size
+        self.read_so_far = 0
+        self._pending = memoryview(b'')
+        self._eof = False
+        self._error = None
+        self._stall_timeout = stall_timeout
+        self._init_progress(callback, report_every)
+        self.aborted = threading.Event()
+
+    def _put(self, item):
+        deadline = time.time() + self._stall_timeout
+        while not self.aborted.is_set():
+            try: self._queue.put(item, timeout=1); return
+            except queue.Full:
+                if time.time() > deadline: self.abort(); raise StreamStalled("Upload stopped draining the stream buffer")
+        raise StreamStalled("Stream was aborted by the upload side")
+
+    def feed(self, chunk):
+        self._put(chunk)
+
+    def finish(self, error=None):
+        self._error = error
+        try: self._put(None)
+        except StreamStalled: pass
+
+    def abort(self):
+        self.aborted.set()
+
+    def read(self, size=-1):
+        while not self._pending and not self._eof:
+            try: chunk = self._queue.get(timeout=self._stall_timeout)
+            except queue.Empty:
+                self.abort(); raise StreamStalled("Download stopped feeding the stream buffer")
+            if chunk is None:
+                self._eof = True
+                if self._error is not None:
+                    self.abort(); raise StreamStalled(f"Download side failed: {self._error}")
+            else:
+                self._pending = memoryview(chunk)
+        if size is None or size < 0: size = len(self._pending)
+        chunk, self._pending = self._pending[:size], self._pending[size:]
+        if chunk:
+            self.read_so_far += len(chunk)
+            if self.checksum is not None: self.checksum.update(chunk)
+            if self._throttle: self._throttle(len(chunk))
+            self._progress()
+        return chunk
+
+    def __len__(self):
+        return self.size
+
+class TarStream(_SampledProgress):
+    """File-like tar archive of the given (path, arcname) files, generated on the fly while it is read
+    so the archive is never staged on disk. Its size is known up front, so the PUT gets a Content-Length."""
+    def __init__(self, files, callback=None, block_size=1024 * 1024, report_every=8 * 1024 * 1024, throttle=None, checksum=None):
+        self._throttle = throttle
+        self.checksum = checksum
+        if checksum is not None: checksum.reset()
+        self._entries = []; size = 0
+        for path, arcname in files:
+            info = tarfile.TarInfo(arcname); info.size = os.path.getsize(path)
+            info.mtime = int(os.path.getmtime(path)); info.mode = 0o644
+            header = info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8', errors='surrogateescape')
+            self._entries.append((header, path, info.size))
+            size += len(header) + info.size + (-info.size % tarfile.BLOCKSIZE)
+        size += 2 * tarfile.BLOCKSIZE; size += -size % tarfile.RECORDSIZE
+        self.size = size
+        self.read_so_far = 0
+        self._view = memoryview(bytearray(block_size))
+        self._chunks = self._generate()
+        self._pending = memoryview(b'')
+        self._init_progress(callback, report_every)
+
+    def _generate(self):
+        produced = 0
+        for header, path, size in self._entries:
+            yield header; produced += len(header)
+            with open(path, 'rb', buffering=0) as f:
+                remaining = size
+                while remaining > 0:
+                    # read() hands out the whole chunk before asking for the next one, so the buffer can be reused.
+                    n = f.readinto(self._view[:min(len(self._view), remaining)])
+                    if not n: raise IOError(f"{path} shrank while it was being archived")
+                    remaining -= n; produced += n
+                    yield self._view[:n]
+            if size % tarfile.BLOCKSIZE:
+                padding = tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE
+                yield bytes(padding); produced += padding
+        yield bytes(self.size - produced)
+
+    def read(self, size=-1):
+        if not self._pending:
+            self._pending = memoryview(next(self._chunks, b''))
+        if size is None or size < 0: size = len(self._pending)
+        chunk, self._pending = self._pending[:size], self._pending[size:]
         if chunk:
             self.read_so_far += len(chunk)
-            current_time = time.time()
-            if current_time - self._last_update_time > 2:
-                self._callback(self.read_so_far, self.size, self._start_time)
-                self._last_update_time = current_time
+            if self.checksum is not None: self.checksum.update(chunk)
+            if self._throttle: self._throttle(len(chunk))
+            self._progress()
         return chunk
 
     def __len__(self):
         return self.size
+
+    def close(self):
+        self._chunks.close()
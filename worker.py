@@ -0,0 +1,58 @@
+# worker.py
+
+"""Worker process for JOB_QUEUE mode. Claims jobs the bot queued in DB_FILE and runs them with the same download
+and upload pools, slots and disk admission the bot uses in-process. The bot starts LOCAL_WORKERS of these itself;
+more can run on any host that shares DB_FILE and BuzzHeavier credentials:
+
+    JOB_QUEUE=1 DB_FILE=/srv/securefetch/bot.db WORKER_INDEX=3 python worker.py
+
+With METRICS_PORT set, each worker exports its own job, transfer and torrent metrics on METRICS_PORT + WORKER_INDEX.
+"""
+
+import os
+import sys
+
+from dotenv import load_dotenv
+
+from admission import DiskAdmission
+from jobqueue import QueueWorker
+from metrics import Gauge, start_metrics_server
+from netclient import init_client, get_client
+from scheduler import JobScheduler
+from shaper import get_shaper
+from store import Store
+from config import (DB_FILE, DOWNLOAD_WORKERS, UPLOAD_WORKERS, GLOBAL_JOB_SLOTS, PER_USER_JOB_SLOTS, DISK_FREE_FLOOR,
+                    DISK_RECHECK_INTERVAL, QUEUE_LEASE, QUEUE_POLL_INTERVAL, ROOT_ID_CACHE_FILE, ROOT_ID_TTL, ROOT_ID_RETRY,
+                    METRICS_HOST, METRICS_PORT, WORKER_INDEX)
+from utils import DOWNLOAD_PATH, resolve_root_dir_id, setup_logger, LOGGER
+
+load_dotenv()
+BUZZHEAVIER_ACCOUNT_ID = os.getenv("BUZZHEAVIER_ACCOUNT_ID")
+
+def start_metrics(scheduler, admission):
+    # Same series as the bot's, for this process; the bot's own port keeps serving the front-end's view.
+    Gauge('securefetch_jobs', 'Jobs in the scheduler by state.', scheduler.state_counts, ('state',))
+    Gauge('securefetch_disk_available_bytes', 'Free space left for new jobs after the floor and admitted reservations.', admission.available)
+    Gauge('securefetch_shaper_rate_bytes_per_second', 'Measured transfer rate over the shaper window.', lambda: get_shaper().rates(), ('direction',))
+    Gauge('securefetch_http_requests_total', 'Requests sent through the shared HTTP client.', lambda: get_client().stats()['requests'], kind='counter')
+    Gauge('securefetch_http_connections_total', 'Connections opened by the shared HTTP client.', lambda: get_client().stats()['connections'], kind='counter')
+    try: start_metrics_server(METRICS_HOST, METRICS_PORT + WORKER_INDEX)
+    except OSError as e: LOGGER.error(f"Could not serve metrics on port {METRICS_PORT + WORKER_INDEX} (is WORKER_INDEX unique on this host?): {e}")
+
+def main() -> None:
+    setup_logger()
+    LOGGER.info(f"Worker process {os.getpid()} started.")
+    if not BUZZHEAVIER_ACCOUNT_ID: LOGGER.critical("BUZZHEAVIER_ACCOUNT_ID not found in .env file."); sys.exit(1)
+    if not os.path.exists(DOWNLOAD_PATH): os.makedirs(DOWNLOAD_PATH, exist_ok=True)
+    admission = DiskAdmission(DOWNLOAD_PATH, DISK_FREE_FLOOR)
+    scheduler = JobScheduler(DOWNLOAD_WORKERS, UPLOAD_WORKERS, GLOBAL_JOB_SLOTS, PER_USER_JOB_SLOTS, GLOBAL_JOB_SLOTS,
+                             admission=admission, recheck_interval=DISK_RECHECK_INTERVAL)
+    if METRICS_PORT: start_metrics(scheduler, admission)
+    worker = QueueWorker(Store(DB_FILE), scheduler, GLOBAL_JOB_SLOTS, BUZZHEAVIER_ACCOUNT_ID, None, QUEUE_LEASE, QUEUE_POLL_INTERVAL)
+    # The worker claims nothing until it knows the root ID, so jobs stay available to workers that do.
+    resolve_root_dir_id(BUZZHEAVIER_ACCOUNT_ID, init_client(), ROOT_ID_CACHE_FILE, ROOT_ID_TTL, ROOT_ID_RETRY, worker.set_root_dir_id)
+    try: worker.run()
+    except KeyboardInterrupt: LOGGER.info("Worker process is shutting down.")
+
+if __name__ == '__main__':
+    main()